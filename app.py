@@ -1,17 +1,53 @@
 # ================= ENHANCED TELEGRAM TERMUX CONTROLLER =================
 
 import os
+import sys
+import atexit
+import asyncio
 import pty
 import threading
 import uuid
-import select
+import base64
+import selectors
+import heapq
+import itertools
+import queue
+import re
+import codecs
 import json
+import hmac
+import hashlib
+import sqlite3
+import gzip
+import io
+import mimetypes
+import tempfile
+import tarfile
+import shutil
 import time
+import urllib.parse
+import random
 import signal
+import resource
+import struct
+import ctypes
+import fcntl
+import termios
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from flask import Flask, request, render_template_string
+from flask import Flask, request
+import requests
+from requests.adapters import HTTPAdapter
 import telebot
 from telebot import types
+from telebot import apihelper
+from telebot.apihelper import ApiHTTPException, ApiTelegramException
+from telebot.handler_backends import BaseMiddleware, CancelUpdate
+try:
+    import brotli  # optional, adds Content-Encoding: br
+except ImportError:
+    brotli = None
 
 # ===================== CONFIGURATION =====================
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
@@ -21,7 +57,169 @@ MAIN_ADMIN_ID = int(os.environ.get("MAIN_ADMIN_ID"))
 # Use 9090 if PORT is not set (for local development)
 PORT = int(os.environ.get("PORT", 9090))
 BASE_DIR = os.getcwd()
-DATA_FILE = "bot_data.json"
+DATA_FILE = "bot_data.json"  # legacy store, migrated into STATE_DB on first start
+STATE_DB = os.environ.get("STATE_DB", "bot_state.db")
+HISTORY_LIMIT = int(os.environ.get("HISTORY_LIMIT", 200))  # commands kept per chat (0 = all)
+
+# Live output: one message is edited in place until it is full
+MESSAGE_LIMIT = 4096  # Telegram hard limit per message
+OUTPUT_FLUSH_INTERVAL = float(os.environ.get("OUTPUT_FLUSH_INTERVAL", 1.0))
+OUTPUT_FLUSH_BYTES = int(os.environ.get("OUTPUT_FLUSH_BYTES", 3500))
+OUTPUT_BUFFER_LIMIT = int(os.environ.get("OUTPUT_BUFFER_LIMIT", 64 * 1024))
+
+# Past this many chars, output is streamed to a temp file and sent as a document
+# (0 = off, the default: output keeps rolling over into new messages)
+OUTPUT_SPILL_THRESHOLD = int(os.environ.get("OUTPUT_SPILL_THRESHOLD", 0))
+OUTPUT_SPILL_GZIP = os.environ.get("OUTPUT_SPILL_GZIP", "0") == "1"
+OUTPUT_PREVIEW_CHARS = int(os.environ.get("OUTPUT_PREVIEW_CHARS", 1500))
+PTY_READ_SIZE = 64 * 1024
+
+# Live screen mode for full-screen programs (top, htop, watch)
+SCREEN_ROWS = int(os.environ.get("SCREEN_ROWS", 24))
+SCREEN_COLS = int(os.environ.get("SCREEN_COLS", 80))
+SCREEN_FPS = float(os.environ.get("SCREEN_FPS", 1))
+
+# Interactive programs: quiet time before a prompt is assumed, and the prefix
+# that starts a new command while a program is reading the chat
+PROMPT_SETTLE = float(os.environ.get("PROMPT_SETTLE", 0.15))
+COMMAND_ESCAPE = os.environ.get("COMMAND_ESCAPE", "!")
+
+# Expiry, in seconds (0 = never): editor links, chat activity shown in
+# /sessions, programs without input or output, and idle shell sessions
+EDIT_SESSION_TTL = int(os.environ.get("EDIT_SESSION_TTL", 3600))
+ACTIVITY_TTL = int(os.environ.get("ACTIVITY_TTL", 3600))
+IDLE_PROCESS_TTL = int(os.environ.get("IDLE_PROCESS_TTL", 1800))
+IDLE_PROCESS_ACTION = os.environ.get("IDLE_PROCESS_ACTION", "notify")  # or "kill"
+SHELL_SESSION_TTL = int(os.environ.get("SHELL_SESSION_TTL", 3600))
+
+# Seconds between SIGTERM and SIGKILL when a command is stopped
+STOP_GRACE = float(os.environ.get("STOP_GRACE", 3))
+
+# Command scheduler: running commands in total / per admin, and waiting commands
+MAX_RUNNING_COMMANDS = int(os.environ.get("MAX_RUNNING_COMMANDS", 8))
+MAX_COMMANDS_PER_ADMIN = int(os.environ.get("MAX_COMMANDS_PER_ADMIN", 3))
+MAX_QUEUED_COMMANDS = int(os.environ.get("MAX_QUEUED_COMMANDS", 50))
+
+# Optional limits applied to every command (0 = no limit)
+CHILD_RLIMIT_CPU = int(os.environ.get("CHILD_RLIMIT_CPU", 0))  # seconds of CPU
+CHILD_RLIMIT_AS = int(os.environ.get("CHILD_RLIMIT_AS", 0))  # MB of address space
+CHILD_NICE = int(os.environ.get("CHILD_NICE", 0))
+
+# Browser editor: bytes loaded per range request (large files load lazily)
+EDITOR_CHUNK = int(os.environ.get("EDITOR_CHUNK", 256 * 1024))
+
+# File browser: entries per page, bytes per page of a viewed file, and how many
+# directory listings (rescanned after BROWSE_CACHE_TTL seconds) and button tokens are kept
+BROWSE_PAGE_SIZE = int(os.environ.get("BROWSE_PAGE_SIZE", 20))
+VIEW_PAGE_BYTES = int(os.environ.get("VIEW_PAGE_BYTES", 3000))
+BROWSE_CACHE_SIZE = int(os.environ.get("BROWSE_CACHE_SIZE", 256))
+BROWSE_CACHE_TTL = float(os.environ.get("BROWSE_CACHE_TTL", 30))
+BROWSE_TOKEN_LIMIT = int(os.environ.get("BROWSE_TOKEN_LIMIT", 10000))
+
+# File transfers: /get sends documents of at most TRANSFER_PART_SIZE bytes (the
+# Bot API takes 50 MB), bots may download files up to TRANSFER_DOWNLOAD_LIMIT
+# (20 MB on api.telegram.org, 0 = no limit for a self-hosted Bot API server)
+TRANSFER_PART_SIZE = int(os.environ.get("TRANSFER_PART_SIZE", 49 * 1024 * 1024))
+TRANSFER_DOWNLOAD_LIMIT = int(os.environ.get("TRANSFER_DOWNLOAD_LIMIT", 20 * 1024 * 1024))
+TRANSFER_WORKERS = int(os.environ.get("TRANSFER_WORKERS", 2))
+TRANSFER_CHUNK = 1024 * 1024
+TRANSFER_GZIP_LEVEL = int(os.environ.get("TRANSFER_GZIP_LEVEL", 6))
+
+# Search index: /find and /grep look files up in a trigram index of BASE_DIR kept
+# in INDEX_DB and refreshed every INDEX_REFRESH_INTERVAL seconds; binary files and
+# files over INDEX_MAX_FILE_SIZE are found by name only
+INDEX_DB = os.environ.get("INDEX_DB", "search_index.db")
+INDEX_REFRESH_INTERVAL = float(os.environ.get("INDEX_REFRESH_INTERVAL", 60))
+INDEX_MAX_FILE_SIZE = int(os.environ.get("INDEX_MAX_FILE_SIZE", 1024 * 1024))
+INDEX_SKIP_DIRS = os.environ.get("INDEX_SKIP_DIRS", ".git,node_modules,__pycache__,.venv,venv,.cache").split(",")
+SEARCH_PAGE_SIZE = int(os.environ.get("SEARCH_PAGE_SIZE", 8))
+SEARCH_LINES_PER_FILE = 2
+SEARCH_CACHE_SIZE = int(os.environ.get("SEARCH_CACHE_SIZE", 100))
+SEARCH_RANK_WINDOW = int(os.environ.get("SEARCH_RANK_WINDOW", 200))  # grep candidates fetched (and ranked) at once
+
+# Log followers: /tail shows the last TAIL_LINES lines of a file in one message,
+# edited at most every TAIL_UPDATE_INTERVAL seconds; the tails of a chat take
+# turns at half its OUTBOUND_CHAT_RATE, so with N of them each one updates only
+# every N * 2 / OUTBOUND_CHAT_RATE seconds. TAIL_MAX_PER_CHAT bounds that: at
+# the defaults, 4 tails keep every message within 8 seconds of its file.
+# Without inotify, files are polled every TAIL_POLL_INTERVAL
+TAIL_LINES = int(os.environ.get("TAIL_LINES", 30))
+TAIL_LINE_CHARS = 300
+TAIL_UPDATE_INTERVAL = float(os.environ.get("TAIL_UPDATE_INTERVAL", 3))
+TAIL_POLL_INTERVAL = float(os.environ.get("TAIL_POLL_INTERVAL", 2))
+TAIL_MAX_PER_CHAT = max(1, int(os.environ.get("TAIL_MAX_PER_CHAT", 4)))
+TAIL_EVENT_BATCH = 0.25  # seconds file events queue up before they are read
+TAIL_BACKLOG_BYTES = 8 * 1024  # read from the end of the file when following starts
+TAIL_READ_LIMIT = 256 * 1024  # most read per update; a burst beyond it is skipped
+
+# Web pages: responses above this many bytes are compressed; editor assets
+# (Ace, Font Awesome) are served from ASSET_DIR when fetch_assets.py has filled
+# it, from cdnjs otherwise
+COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", 1024))
+ASSET_DIR = os.environ.get("ASSET_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets"))
+
+# Webhook: set WEBHOOK_URL to the public URL of this service (on Render, the
+# same value as RENDER_EXTERNAL_URL) to receive updates on /webhook/<secret>
+# instead of long polling. Unset, the bot polls.
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or hashlib.sha256(f"webhook:{BOT_TOKEN}".encode()).hexdigest()[:32]
+# Parallel deliveries Telegram may make; above 1 a chat's updates can arrive out of order
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", 1))
+WEBHOOK_QUEUE = int(os.environ.get("WEBHOOK_QUEUE", 1000))
+
+# Inbound updates: older ones are dropped after an outage, repeats of the same
+# command are collapsed, and every chat / user gets a token bucket
+INGRESS_MAX_AGE = int(os.environ.get("INGRESS_MAX_AGE", 120))  # seconds (0 = keep all)
+INGRESS_DEDUP_WINDOW = float(os.environ.get("INGRESS_DEDUP_WINDOW", 2))
+INGRESS_CHAT_RATE = float(os.environ.get("INGRESS_CHAT_RATE", 1))
+INGRESS_CHAT_BURST = int(os.environ.get("INGRESS_CHAT_BURST", 5))
+INGRESS_USER_RATE = float(os.environ.get("INGRESS_USER_RATE", 2))
+INGRESS_USER_BURST = int(os.environ.get("INGRESS_USER_BURST", 10))
+
+# Engine: "threads" runs PTY I/O and timers on a selectors thread, outbound
+# calls on OUTBOUND_WORKERS threads, polling on its own thread and the web
+# server with a thread per connection. "asyncio" runs all of that on one event
+# loop: loop.add_reader for PTYs, AsyncTeleBot coroutines for polling and
+# sends, and aiohttp in front of the Flask app, which runs on WEB_WORKERS
+# threads (python app.py; under gunicorn the web side stays gunicorn's).
+# Handlers keep their UPDATE_WORKERS threads either way.
+ENGINE = os.environ.get("ENGINE", "threads")
+WEB_WORKERS = int(os.environ.get("WEB_WORKERS", 4))
+WEB_MAX_BODY = 64 * 1024 * 1024  # largest request body (editor saves) under ENGINE=asyncio
+if ENGINE not in ("threads", "asyncio"):
+    raise SystemExit(f"❌ Unknown ENGINE {ENGINE!r}, use threads or asyncio")
+if ENGINE == "asyncio":
+    try:
+        import aiohttp
+        from aiohttp import web
+        from telebot import asyncio_helper
+        from telebot.async_telebot import AsyncTeleBot
+    except ImportError as e:
+        raise SystemExit(f"❌ ENGINE=asyncio needs aiohttp ({e}), see requirements.txt")
+
+# Handler threads; updates of one chat always run in order
+UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", 8))
+UPDATE_CHAT_QUEUE = int(os.environ.get("UPDATE_CHAT_QUEUE", 50))
+
+# Outbound Bot API calls (Telegram allows ~30 msg/s overall, ~1 msg/s per chat)
+OUTBOUND_WORKERS = int(os.environ.get("OUTBOUND_WORKERS", 4))
+OUTBOUND_GLOBAL_RATE = float(os.environ.get("OUTBOUND_GLOBAL_RATE", 30))
+OUTBOUND_GLOBAL_BURST = int(os.environ.get("OUTBOUND_GLOBAL_BURST", 5))
+OUTBOUND_CHAT_RATE = float(os.environ.get("OUTBOUND_CHAT_RATE", 1))
+OUTBOUND_CHAT_BURST = int(os.environ.get("OUTBOUND_CHAT_BURST", 3))
+OUTBOUND_CHAT_QUEUE = int(os.environ.get("OUTBOUND_CHAT_QUEUE", 100))
+OUTBOUND_MAX_RETRIES = int(os.environ.get("OUTBOUND_MAX_RETRIES", 5))
+
+# Bot API base URL, for a self-hosted Bot API server or benchmarks/fake_bot_api.py
+BOT_API_URL = os.environ.get("BOT_API_URL", "").rstrip("/")
+
+# Bot API transport: one shared keep-alive pool, timeouts in seconds, retries
+# for idempotent methods (backoff is the base of a jittered exponential)
+API_POOL_SIZE = int(os.environ.get("API_POOL_SIZE", OUTBOUND_WORKERS + TRANSFER_WORKERS + UPDATE_WORKERS + 2))
+API_CONNECT_TIMEOUT = float(os.environ.get("API_CONNECT_TIMEOUT", 5))
+API_READ_TIMEOUT = float(os.environ.get("API_READ_TIMEOUT", 20))
+API_RETRIES = int(os.environ.get("API_RETRIES", 2))
+API_RETRY_BACKOFF = float(os.environ.get("API_RETRY_BACKOFF", 0.2))
 
 # Debug info
 print(f"🔧 Configuration loaded:")
@@ -29,104 +227,2739 @@ print(f"   PORT: {PORT}")
 print(f"   BOT_TOKEN present: {'Yes' if BOT_TOKEN else 'No'}")
 print(f"   MAIN_ADMIN_ID: {MAIN_ADMIN_ID}")
 
-# ===================== INITIALIZE BOT =====================
-bot = telebot.TeleBot(BOT_TOKEN)
-app = Flask(__name__)
+# ===================== INITIALIZE BOT =====================
+class ChatOrderedBot(telebot.TeleBot):
+    """
+    TeleBot whose handlers run on a pool of UPDATE_WORKERS threads with one
+    FIFO lane per chat. Updates of a chat run strictly one after another, so
+    a command cannot race the input sent right after it; other chats are
+    served in parallel, round-robin, and a slow handler only holds up its
+    own chat. A lane holds at most UPDATE_CHAT_QUEUE waiting updates.
+    """
+
+    def __init__(self, token, workers=UPDATE_WORKERS, lane_limit=UPDATE_CHAT_QUEUE, **kwargs):
+        super().__init__(token, **kwargs)
+        self.lane_limit = lane_limit
+        self.lanes = {}  # chat_id -> deque of (task, args, kwargs); present while queued or running
+        self.ready = deque()  # chats with waiting work and no worker on them
+        self.cond = threading.Condition()
+        self.handled = 0
+        self.dropped = 0
+        for n in range(workers):
+            threading.Thread(target=self._work, name=f"updates-{n}", daemon=True).start()
+
+    @staticmethod
+    def _chat_of(update):
+        # Messages carry .chat, callback queries carry it on .message
+        chat = getattr(update, "chat", None) or getattr(getattr(update, "message", None), "chat", None)
+        return getattr(chat, "id", None)
+
+    def _exec_task(self, task, *args, **kwargs):
+        chat_id = self._chat_of(args[0]) if args else None
+        with self.cond:
+            lane = self.lanes.get(chat_id)
+            if lane is None:
+                lane = self.lanes[chat_id] = deque()
+                self.ready.append(chat_id)
+                self.cond.notify()
+            elif len(lane) >= self.lane_limit:
+                self.dropped += 1
+                return
+            lane.append((task, args, kwargs))
+
+    def _work(self):
+        while True:
+            with self.cond:
+                while not self.ready:
+                    self.cond.wait()
+                chat_id = self.ready.popleft()
+                task, args, kwargs = self.lanes[chat_id].popleft()
+            try:
+                task(*args, **kwargs)
+            except Exception as e:
+                if not self._handle_exception(e):
+                    print(f"⚠️ Handler error in chat {chat_id}: {e}")
+            with self.cond:
+                self.handled += 1
+                if self.lanes[chat_id]:
+                    self.ready.append(chat_id)  # back of the line: chats take turns
+                    self.cond.notify()
+                else:
+                    del self.lanes[chat_id]
+
+    def update_stats(self):
+        with self.cond:
+            waiting = sum(len(lane) for lane in self.lanes.values())
+            return {"lanes": len(self.lanes), "waiting": waiting, "handled": self.handled,
+                    "dropped": self.dropped}
+
+bot = ChatOrderedBot(BOT_TOKEN, use_class_middlewares=True)
+app = Flask(__name__)
+
+# ===================== ADMIN-WISE DATA =====================
+admins = set()
+
+# ===================== SESSION REGISTRY =====================
+class ProcessRecord:
+    """A running command. Byte counters are only bumped on the reactor thread."""
+    __slots__ = ("pid", "fd", "chat_id", "admin_id", "cmd", "started", "last_io", "bytes_in", "bytes_out")
+
+    def __init__(self, pid, fd, chat_id, admin_id, cmd):
+        self.pid = pid
+        self.fd = fd
+        self.chat_id = chat_id
+        self.admin_id = admin_id
+        self.cmd = cmd
+        self.started = self.last_io = time.time()
+        self.bytes_in = 0  # written to its stdin from the chat
+        self.bytes_out = 0  # read from its PTY
+
+    @property
+    def start_time(self):
+        return datetime.fromtimestamp(self.started).strftime("%H:%M:%S")
+
+class InputTarget:
+    """The PTY that plain messages of a chat are written to."""
+    __slots__ = ("fd", "chat_id", "admin_id", "secret_prompts", "waiting")
+
+    def __init__(self, fd, chat_id, admin_id, secret_prompts=True):
+        self.fd = fd
+        self.chat_id = chat_id
+        self.admin_id = admin_id
+        self.secret_prompts = secret_prompts  # echo off means a password prompt
+        self.waiting = False  # sitting at a prompt
+
+class EditSession:
+    __slots__ = ("path", "admin_id", "created")
+
+    def __init__(self, path, admin_id, created=None):
+        self.path = path
+        self.admin_id = admin_id
+        self.created = created or time.time()
+
+class SessionRegistry:
+    """
+    Process, shell session, input, activity and editor state shared by the
+    bot handlers, the reactor and the Flask threads. Every group has its own lock and
+    process records are indexed by chat, pid and admin, so no lookup scans.
+    A chat has at most one foreground process; a replaced or stopped one
+    stays indexed by pid until the reaper reports its exit.
+    """
+
+    def __init__(self):
+        self._proc_lock = threading.Lock()
+        self._by_chat = {}  # chat_id -> ProcessRecord
+        self._by_pid = {}  # pid -> ProcessRecord
+        self._by_admin = {}  # admin_id -> {chat_id: ProcessRecord}
+        self._shells = {}  # chat_id -> ShellSession, under _proc_lock too
+        self._input_lock = threading.Lock()
+        self._inputs = {}  # chat_id -> InputTarget
+        self._activity_lock = threading.Lock()
+        self._activity = {}  # admin_id -> {chat_id: timestamp}
+        self._edit_lock = threading.Lock()
+        self._edits = {}  # sid -> EditSession
+        self.store = None  # StateStore that editor sessions are written through to
+        self.expirer = None  # Expirer that gets a deadline for every new entry
+
+    # ---------- processes ----------
+    def add(self, record):
+        """Make record the chat's foreground process."""
+        with self._proc_lock:
+            self._unlink_chat(record.chat_id)
+            self._by_chat[record.chat_id] = record
+            self._by_pid[record.pid] = record
+            self._by_admin.setdefault(record.admin_id, {})[record.chat_id] = record
+        if IDLE_PROCESS_TTL:
+            self._watch("process", record.pid, record.last_io + IDLE_PROCESS_TTL)
+
+    def detach(self, chat_id):
+        """Drop the chat's foreground process from the chat/admin indexes and return it."""
+        with self._proc_lock:
+            return self._unlink_chat(chat_id)
+
+    def detach_all(self):
+        with self._proc_lock:
+            records = list(self._by_chat.values())
+            self._by_chat.clear()
+            self._by_admin.clear()
+        return records
+
+    def remove(self, pid):
+        """The process exited: forget it everywhere it is still indexed."""
+        with self._proc_lock:
+            record = self._by_pid.pop(pid, None)
+            if record is not None and self._by_chat.get(record.chat_id) is record:
+                self._unlink_chat(record.chat_id)
+        return record
+
+    def get_chat(self, chat_id):
+        return self._by_chat.get(chat_id)
+
+    def get_pid(self, pid):
+        return self._by_pid.get(pid)
+
+    def for_admin(self, admin_id):
+        with self._proc_lock:
+            return list(self._by_admin.get(admin_id, {}).values())
+
+    def process_counts(self):
+        """{admin_id: number of foreground processes}"""
+        with self._proc_lock:
+            return {admin_id: len(procs) for admin_id, procs in self._by_admin.items()}
+
+    def _unlink_chat(self, chat_id):
+        record = self._by_chat.pop(chat_id, None)
+        if record is not None:
+            procs = self._by_admin.get(record.admin_id)
+            if procs is not None and procs.get(chat_id) is record:
+                del procs[chat_id]
+                if not procs:
+                    del self._by_admin[record.admin_id]
+        return record
+
+    # ---------- shell sessions ----------
+    def open_shell(self, chat_id, factory):
+        """
+        The chat's shell session and whether it was just started: factory()
+        runs under the lock, so two /session on cannot both start one.
+        """
+        with self._proc_lock:
+            session = self._shells.get(chat_id)
+            if session is not None:
+                return session, False
+            session = self._shells[chat_id] = factory()
+            return session, True
+
+    def get_shell(self, chat_id):
+        return self._shells.get(chat_id)
+
+    def drop_shell(self, session):
+        """The session ended: forget it unless the chat has a newer one."""
+        with self._proc_lock:
+            if self._shells.get(session.chat_id) is session:
+                del self._shells[session.chat_id]
+
+    def shells(self):
+        with self._proc_lock:
+            return list(self._shells.values())
+
+    # ---------- chat input ----------
+    def attach(self, target):
+        with self._input_lock:
+            self._inputs[target.chat_id] = target
+
+    def release_input(self, target):
+        with self._input_lock:
+            if self._inputs.get(target.chat_id) is target:
+                del self._inputs[target.chat_id]
+
+    def input_target(self, chat_id):
+        return self._inputs.get(chat_id)
+
+    # ---------- activity ----------
+    def touch(self, admin_id, chat_id):
+        now = time.time()
+        with self._activity_lock:
+            chats = self._activity.setdefault(admin_id, {})
+            new = chat_id not in chats
+            chats[chat_id] = now
+        if new and ACTIVITY_TTL:
+            self._watch("activity", (admin_id, chat_id), now + ACTIVITY_TTL)
+
+    def last_active(self, admin_id, chat_id):
+        return self._activity.get(admin_id, {}).get(chat_id)
+
+    def drop_activity(self, admin_id, chat_id, seen):
+        """Forget one entry unless it was touched after seen; True when dropped."""
+        with self._activity_lock:
+            chats = self._activity.get(admin_id)
+            if chats is None or chats.get(chat_id) != seen:
+                return False
+            del chats[chat_id]
+            if not chats:
+                del self._activity[admin_id]
+            return True
+
+    def activity(self):
+        """Snapshot {admin_id: {chat_id: last active}}."""
+        with self._activity_lock:
+            return {admin_id: dict(chats) for admin_id, chats in self._activity.items()}
+
+    def forget(self, chat_id=None, older_than=None):
+        """Drop activity of a chat, of everything idle longer than older_than seconds, or all."""
+        dropped = 0
+        now = time.time()
+        with self._activity_lock:
+            for admin_id, chats in list(self._activity.items()):
+                for cid, last_active in list(chats.items()):
+                    if (chat_id is None or cid == chat_id) and (older_than is None or now - last_active > older_than):
+                        del chats[cid]
+                        dropped += 1
+                if not chats:
+                    del self._activity[admin_id]
+        return dropped
+
+    # ---------- editor ----------
+    def add_edit(self, path, admin_id):
+        sid = str(uuid.uuid4())
+        session = EditSession(path, admin_id)
+        with self._edit_lock:
+            self._edits[sid] = session
+        if self.store is not None:
+            self.store.save_edit(sid, session)
+        if EDIT_SESSION_TTL:
+            self._watch("edit", sid, session.created + EDIT_SESSION_TTL)
+        return sid
+
+    def restore_edit(self, sid, session):
+        with self._edit_lock:
+            self._edits[sid] = session
+
+    def get_edit(self, sid):
+        return self._edits.get(sid)
+
+    def pop_edit(self, sid):
+        with self._edit_lock:
+            session = self._edits.pop(sid, None)
+        if session is not None and self.store is not None:
+            self.store.drop_edit(sid)
+        return session
+
+    def attach_expirer(self, expirer):
+        """Start expiring entries, including the editor sessions restored at startup."""
+        self.expirer = expirer
+        with self._edit_lock:
+            edits = list(self._edits.items())
+        if EDIT_SESSION_TTL:
+            for sid, session in edits:
+                self._watch("edit", sid, session.created + EDIT_SESSION_TTL)
+
+    def _watch(self, kind, key, deadline):
+        if self.expirer is not None:
+            self.expirer.schedule(kind, key, deadline)
+
+    def stats(self):
+        with self._proc_lock:
+            procs, pids, shells = len(self._by_chat), len(self._by_pid), len(self._shells)
+        with self._activity_lock:
+            active = sum(len(chats) for chats in self._activity.values())
+        return {"processes": procs, "pids": pids, "shells": shells, "inputs": len(self._inputs),
+                "active": active, "edits": len(self._edits)}
+
+registry = SessionRegistry()
+
+# ===================== STATE STORE =====================
+class StateStore:
+    """
+    SQLite database in WAL mode holding admins, command history and editor
+    sessions. Every change is one small transaction, so a crash never leaves
+    a half-written file and a write costs a WAL append instead of rewriting
+    everything. Safe to use from any thread.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS admins (
+            user_id INTEGER PRIMARY KEY,
+            added REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS history (
+            id INTEGER PRIMARY KEY,
+            chat_id INTEGER NOT NULL,
+            admin_id INTEGER NOT NULL,
+            cmd TEXT NOT NULL,
+            started REAL NOT NULL,
+            duration REAL NOT NULL,
+            exit_code INTEGER,
+            cpu REAL,
+            max_rss_kb INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS history_chat ON history (chat_id, id);
+        CREATE TABLE IF NOT EXISTS edit_sessions (
+            sid TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            admin_id INTEGER NOT NULL,
+            created REAL NOT NULL
+        );
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # WAL + NORMAL: commits survive a crash of the bot, only an OS crash may lose the last ones
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+
+    def _write(self, sql, params=()):
+        with self.lock:
+            self.conn.execute(sql, params)
+
+    def _read(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    # ---------- admins ----------
+    def admins(self):
+        return {row[0] for row in self._read("SELECT user_id FROM admins")}
+
+    def add_admin(self, user_id):
+        self._write("INSERT OR IGNORE INTO admins (user_id, added) VALUES (?, ?)", (user_id, time.time()))
+
+    def remove_admin(self, user_id):
+        self._write("DELETE FROM admins WHERE user_id = ?", (user_id,))
+
+    # ---------- command history ----------
+    def record_command(self, chat_id, admin_id, cmd, started, duration, exit_code=None, cpu=None,
+                       max_rss_kb=None):
+        self._write("INSERT INTO history (chat_id, admin_id, cmd, started, duration, exit_code, cpu, max_rss_kb) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (chat_id, admin_id, cmd, started, duration, exit_code, cpu, max_rss_kb))
+        # Keep the table bounded; the index makes this a short range delete
+        if HISTORY_LIMIT:
+            self._write("DELETE FROM history WHERE chat_id = ? AND id <= "
+                        "(SELECT id FROM history WHERE chat_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                        (chat_id, chat_id, HISTORY_LIMIT))
+
+    def history(self, chat_id, limit=10):
+        """Newest first: (cmd, started, duration, exit_code)"""
+        return self._read("SELECT cmd, started, duration, exit_code FROM history WHERE chat_id = ? "
+                          "ORDER BY id DESC LIMIT ?", (chat_id, limit))
+
+    # ---------- editor sessions ----------
+    def save_edit(self, sid, session):
+        self._write("INSERT OR REPLACE INTO edit_sessions (sid, path, admin_id, created) VALUES (?, ?, ?, ?)",
+                    (sid, session.path, session.admin_id, session.created))
+
+    def drop_edit(self, sid):
+        self._write("DELETE FROM edit_sessions WHERE sid = ?", (sid,))
+
+    def edits(self):
+        return self._read("SELECT sid, path, admin_id, created FROM edit_sessions")
+
+    def import_json(self, path):
+        """One-time migration of the old bot_data.json; the file is renamed afterwards."""
+        with open(path, 'r') as f:
+            data = json.load(f)
+        for user_id in data.get('admins', []):
+            self.add_admin(int(user_id))
+        os.replace(path, path + ".migrated")
+
+# ===================== LOAD DATA =====================
+def load_data():
+    global admins, store
+    try:
+        store = StateStore(STATE_DB)
+    except sqlite3.Error as e:
+        print(f"⚠️ Cannot open {STATE_DB}: {e} (state will not survive a restart)")
+        store = StateStore(":memory:")
+    try:
+        if os.path.exists(DATA_FILE):
+            store.import_json(DATA_FILE)
+            print(f"📦 Migrated {DATA_FILE} into {STATE_DB}")
+    except Exception as e:
+        print(f"⚠️ Migrating {DATA_FILE} failed: {e}")
+    store.add_admin(MAIN_ADMIN_ID)  # Ensure main admin is always included
+    admins = store.admins()
+    registry.store = store
+    for sid, path, admin_id, created in store.edits():
+        registry.restore_edit(sid, EditSession(path, admin_id, created))
+
+# ===================== INITIAL LOAD =====================
+load_data()
+
+# ================= PTY REACTOR =================
+class PtyReactor:
+    """
+    Single I/O thread that owns every PTY master fd.
+    It sleeps in the selector until a fd is readable or a timer is due,
+    so idle sessions cost nothing and latency does not grow with their number.
+    """
+
+    def __init__(self):
+        self._sel = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._pending = []  # callbacks queued from other threads
+        self._timers = []  # heap of [deadline, seq, fn, args, cancelled]
+        self._seq = itertools.count()
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        os.set_blocking(self._wake_w, False)
+        self._sel.register(self._wake_r, selectors.EVENT_READ, None)
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="pty-reactor", daemon=True)
+            self._thread.start()
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w, b"\0")
+        except (BlockingIOError, OSError):
+            pass  # pipe already full, reactor will wake anyway
+
+    def call_soon(self, fn, *args):
+        """Run fn(*args) on the reactor thread. Safe to call from any thread."""
+        with self._lock:
+            self._pending.append((fn, args))
+        self._wake()
+
+    def call_later(self, delay, fn, *args):
+        """Run fn(*args) on the reactor thread after delay seconds."""
+        timer = [time.monotonic() + delay, next(self._seq), fn, args, False]
+        with self._lock:
+            heapq.heappush(self._timers, timer)
+        self._wake()
+        return timer
+
+    @staticmethod
+    def cancel(timer):
+        timer[4] = True
+
+    def add_reader(self, fd, callback):
+        if threading.current_thread() is self._thread:
+            self._watch(fd, 0, callback)
+        else:
+            self.call_soon(self._watch, fd, 0, callback)
+
+    def remove_reader(self, fd):
+        """Must be called on the reactor thread (from a reader callback)."""
+        self._watch(fd, 0, None)
+
+    def add_writer(self, fd, callback):
+        """Call callback whenever fd is writable. Must be called on the reactor thread."""
+        self._watch(fd, 1, callback)
+
+    def remove_writer(self, fd):
+        """Must be called on the reactor thread."""
+        self._watch(fd, 1, None)
+
+    def _watch(self, fd, which, callback):
+        # key.data is [reader, writer]; the fd is watched for whichever is set
+        try:
+            key = self._sel.get_key(fd)
+        except (KeyError, ValueError):
+            key = None
+        callbacks = list(key.data) if key is not None else [None, None]
+        callbacks[which] = callback
+        events = (selectors.EVENT_READ if callbacks[0] else 0) | (selectors.EVENT_WRITE if callbacks[1] else 0)
+        try:
+            if key is None:
+                if events:
+                    self._sel.register(fd, events, callbacks)
+            elif events:
+                self._sel.modify(fd, events, callbacks)
+            else:
+                self._sel.unregister(fd)
+        except (KeyError, ValueError, OSError):
+            pass  # fd already closed
+
+    def _next_timeout(self):
+        with self._lock:
+            if self._pending:
+                return 0
+            while self._timers and self._timers[0][4]:
+                heapq.heappop(self._timers)
+            if not self._timers:
+                return None
+            return max(0, self._timers[0][0] - time.monotonic())
+
+    def _run_callback(self, fn, args):
+        try:
+            fn(*args)
+        except Exception as e:
+            print(f"⚠️ Reactor callback error: {e}")
+
+    def _run(self):
+        while True:
+            for key, mask in self._sel.select(self._next_timeout()):
+                if key.data is None:
+                    try:
+                        while os.read(self._wake_r, 512):
+                            pass
+                    except (BlockingIOError, OSError):
+                        pass
+                    continue
+                if mask & selectors.EVENT_READ and key.data[0]:
+                    self._run_callback(key.data[0], ())
+                if mask & selectors.EVENT_WRITE:
+                    # The reader may have just closed the fd
+                    try:
+                        writer = self._sel.get_key(key.fd).data[1]
+                    except (KeyError, ValueError):
+                        writer = None
+                    if writer:
+                        self._run_callback(writer, ())
+
+            with self._lock:
+                pending, self._pending = self._pending, []
+                due = []
+                now = time.monotonic()
+                while self._timers and self._timers[0][0] <= now:
+                    due.append(heapq.heappop(self._timers))
+            for fn, args in pending:
+                self._run_callback(fn, args)
+            for timer in due:
+                if not timer[4]:
+                    self._run_callback(timer[2], timer[3])
+
+class AsyncioReactor:
+    """
+    PtyReactor on an asyncio event loop (ENGINE=asyncio): fds are watched
+    with loop.add_reader / add_writer and timers are loop timers, so PTYs,
+    pidfds, Bot API coroutines and web connections all share one thread.
+    Same interface and timer objects as PtyReactor.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._seq = itertools.count()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.loop.run_forever, name="pty-reactor", daemon=True)
+            self._thread.start()
+
+    def call_soon(self, fn, *args):
+        """Run fn(*args) on the loop thread. Safe to call from any thread."""
+        self.loop.call_soon_threadsafe(self._run_callback, fn, args)
+
+    def call_later(self, delay, fn, *args):
+        """Run fn(*args) on the loop thread after delay seconds."""
+        # loop.time() is time.monotonic(), so deadlines compare with PtyReactor timers
+        timer = [time.monotonic() + delay, next(self._seq), fn, args, False]
+        self.loop.call_soon_threadsafe(self.loop.call_at, timer[0], self._fire, timer)
+        return timer
+
+    cancel = staticmethod(PtyReactor.cancel)
+
+    def submit(self, coro):
+        """Schedule a coroutine on the loop. Safe to call from any thread."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def add_reader(self, fd, callback):
+        if threading.current_thread() is self._thread:
+            self._watch(self.loop.add_reader, fd, callback)
+        else:
+            self.loop.call_soon_threadsafe(self._watch, self.loop.add_reader, fd, callback)
+
+    def remove_reader(self, fd):
+        """Must be called on the loop thread (from a reader callback)."""
+        self._watch(self.loop.remove_reader, fd)
+
+    def add_writer(self, fd, callback):
+        """Call callback whenever fd is writable. Must be called on the loop thread."""
+        self._watch(self.loop.add_writer, fd, callback)
+
+    def remove_writer(self, fd):
+        """Must be called on the loop thread."""
+        self._watch(self.loop.remove_writer, fd)
+
+    def _watch(self, method, fd, callback=None):
+        try:
+            if callback is None:
+                method(fd)
+            else:
+                method(fd, self._run_callback, callback, ())
+        except (KeyError, ValueError, OSError):
+            pass  # fd already closed
+
+    def _fire(self, timer):
+        if not timer[4]:
+            self._run_callback(timer[2], timer[3])
+
+    _run_callback = PtyReactor._run_callback
+
+reactor = AsyncioReactor() if ENGINE == "asyncio" else PtyReactor()
+reactor.start()
+
+# ================= PROCESS REAPER =================
+def signal_name(signum):
+    """SIGTERM for 15; real-time signals have no enum member and read "signal 40"."""
+    try:
+        return signal.Signals(signum).name
+    except ValueError:
+        return f"signal {signum}"
+
+class ExitInfo:
+    """status is None when the child was reaped elsewhere and it is unknown."""
+
+    __slots__ = ("status", "cpu", "max_rss_kb", "duration")
+
+    def __init__(self, status, rusage, duration):
+        self.status = status
+        self.cpu = rusage.ru_utime + rusage.ru_stime
+        self.max_rss_kb = rusage.ru_maxrss  # kilobytes on Linux
+        self.duration = duration
+
+    @property
+    def code(self):
+        return None if self.status is None else os.waitstatus_to_exitcode(self.status)
+
+    def describe(self):
+        code = self.code
+        if code is None:
+            return f"❔ Exit status unknown • {self.duration:.1f}s"  # no rusage either
+        if code == 0:
+            head = "✅ Exit 0"
+        elif code < 0:
+            head = f"⚠️ Killed by {signal_name(-code)}"
+        else:
+            head = f"❌ Exit {code}"
+        return (f"{head} • {self.duration:.1f}s • CPU {self.cpu:.2f}s • "
+                f"max RSS {self.max_rss_kb / 1024:.1f} MB")
+
+class Reaper:
+    """
+    Collects every child with os.wait4, so no zombies are left behind and
+    exit status plus CPU time and max RSS are known. A pidfd per child wakes
+    the reactor on exit; without pidfd support, SIGCHLD and a slow poll do.
+    Callbacks run on the reactor thread.
+    """
+
+    POLL_INTERVAL = 1.0
+
+    def __init__(self):
+        self.children = {}  # pid -> [on_exit, start, pidfd]
+        self.kills = {}  # pid -> SIGKILL timer of a group being stopped
+        self.poll_timer = None
+        self.use_pidfd = hasattr(os, "pidfd_open")
+        if not self.use_pidfd and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGCHLD, lambda *_: reactor.call_soon(self.poll))
+
+    def watch(self, pid, on_exit):
+        """Call on_exit(ExitInfo) once pid has exited. Safe from any thread."""
+        reactor.call_soon(self._watch, pid, on_exit, time.monotonic())
+
+    def _watch(self, pid, on_exit, start):
+        pidfd = None
+        if self.use_pidfd:
+            try:
+                pidfd = os.pidfd_open(pid)
+            except OSError:
+                self.use_pidfd = False  # kernel without pidfd
+        self.children[pid] = [on_exit, start, pidfd]
+        if pidfd is not None:
+            reactor.add_reader(pidfd, lambda: self._reap(pid))
+        elif self.poll_timer is None:
+            self.poll_timer = reactor.call_later(self.POLL_INTERVAL, self._poll_tick)
+        self._reap(pid)  # it may be gone already
+
+    def running(self, pid):
+        return pid in self.children
+
+    def poll(self):
+        for pid in list(self.children):
+            self._reap(pid)
+
+    def _poll_tick(self):
+        self.poll_timer = None
+        self.poll()
+        if any(child[2] is None for child in self.children.values()):
+            self.poll_timer = reactor.call_later(self.POLL_INTERVAL, self._poll_tick)
+
+    def _reap(self, pid):
+        try:
+            wpid, status, rusage = os.wait4(pid, os.WNOHANG)
+        except ChildProcessError:
+            wpid, status, rusage = pid, None, None  # reaped by someone else
+        if wpid == 0:
+            return
+        on_exit, start, pidfd = self.children.pop(pid)
+        if pid in self.kills and not self._group_alive(pid):
+            # Nothing left to kill, and the pid may now be handed out again
+            reactor.cancel(self.kills.pop(pid))
+        if pidfd is not None:
+            reactor.remove_reader(pidfd)
+            os.close(pidfd)
+        if rusage is None:
+            rusage = resource.struct_rusage((0,) * 16)
+        on_exit(ExitInfo(status, rusage, time.monotonic() - start))
+
+    def terminate(self, pid, grace=STOP_GRACE):
+        """
+        SIGTERM the whole process group now and SIGKILL it after grace
+        seconds if it is still running. Never blocks the caller.
+        """
+        try:
+            os.killpg(pid, signal.SIGTERM)
+        except OSError:
+            return False
+        reactor.call_soon(self._arm_kill, pid, grace)
+        return True
+
+    def _arm_kill(self, pid, grace):
+        if pid not in self.children and not self._group_alive(pid):
+            return  # already reaped with its whole group
+        if pid not in self.kills:
+            self.kills[pid] = reactor.call_later(grace, self._kill_group, pid)
+
+    def _kill_group(self, pid):
+        del self.kills[pid]
+        # Members of the group may outlive the leader. Once the leader is
+        # reaped, only signal a group that still exists: an empty group's
+        # id may already belong to a new process.
+        if pid not in self.children and not self._group_alive(pid):
+            return
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except OSError:
+            pass  # nothing left in the group
+
+    @staticmethod
+    def _group_alive(pgid):
+        try:
+            os.killpg(pgid, 0)
+        except ProcessLookupError:
+            return False
+        except OSError:
+            return True  # EPERM: it exists
+        return True
+
+reaper = Reaper()
+recent_exits = deque(maxlen=10)  # (chat_id, cmd, ExitInfo) of finished commands
+
+# ================= BOT API TRANSPORT =================
+class MultipartBody:
+    """
+    multipart/form-data body for telebot's files dict that is read from the
+    files as it is sent (requests builds the whole body in memory). Files are
+    rewound first, so a repeated request sends them again.
+    """
+
+    def __init__(self, files):
+        self.boundary = uuid.uuid4().hex
+        self.pieces = deque()
+        self.length = 0
+        for field, value in files.items():
+            filename, fileobj = value if isinstance(value, tuple) else (getattr(value, "name", field), value)
+            if isinstance(fileobj, (bytes, bytearray, str)):
+                fileobj = io.BytesIO(fileobj.encode() if isinstance(fileobj, str) else fileobj)
+            if getattr(fileobj, "seekable", lambda: False)():
+                fileobj.seek(0)
+            filename = os.path.basename(str(filename)).replace('"', "%22").replace("\r", " ").replace("\n", " ")
+            head = (f"--{self.boundary}\r\nContent-Disposition: form-data; name=\"{field}\"; "
+                    f"filename=\"{filename}\"\r\nContent-Type: application/octet-stream\r\n\r\n").encode()
+            self._add(head)
+            self._add(fileobj, self._remaining(fileobj))
+            self._add(b"\r\n")
+        self._add(f"--{self.boundary}--\r\n".encode())
+
+    @staticmethod
+    def _remaining(fileobj):
+        if hasattr(fileobj, "__len__"):
+            return len(fileobj)
+        try:
+            return os.fstat(fileobj.fileno()).st_size - fileobj.tell()
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            data = fileobj.read()
+            fileobj.seek(0)
+            return len(data)
+
+    def _add(self, piece, length=None):
+        self.pieces.append([piece, len(piece) if length is None else length])
+        self.length += self.pieces[-1][1]
+
+    @property
+    def content_type(self):
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.length
+        out = []
+        while size > 0 and self.pieces:
+            piece = self.pieces[0]
+            if isinstance(piece[0], bytes):
+                data, piece[0] = piece[0][:size], piece[0][size:]
+            else:
+                data = piece[0].read(min(size, piece[1]))
+                if not data:
+                    raise IOError(f"file ended {piece[1]} bytes early")
+            piece[1] -= len(data)
+            if piece[1] <= 0:
+                self.pieces.popleft()
+            size -= len(data)
+            out.append(data)
+        return b"".join(out)
+
+class BotApiTransport:
+    """
+    Request sender for telebot (apihelper.CUSTOM_REQUEST_SENDER). All threads
+    share one keep-alive connection pool instead of telebot's per-thread
+    sessions that are rebuilt every 10 minutes, so a Bot API call normally
+    reuses a warm TLS connection. Long polls keep their long read timeout,
+    everything else gets API_READ_TIMEOUT. Idempotent methods are retried
+    with jittered backoff on network errors and 5xx answers, any method when
+    the connection could not even be opened. Latency is recorded per method.
+    """
+
+    IDEMPOTENT = {"getUpdates", "getMe", "getFile", "getChat", "editMessageText", "deleteMessage",
+                  "setWebhook", "deleteWebhook", "getWebhookInfo", "answerCallbackQuery"}
+    SAMPLES = 256  # latencies kept per method for percentiles
+
+    def __init__(self, pool_size=API_POOL_SIZE):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.lock = threading.Lock()
+        self.methods = {}  # name -> {"calls", "errors", "retries", "samples"}
+
+    def request(self, method, url, params=None, files=None, timeout=None, proxies=None):
+        name = url.rsplit("/", 1)[-1]
+        read_timeout = timeout[1] if timeout else API_READ_TIMEOUT
+        if name != "getUpdates":
+            read_timeout = max(API_READ_TIMEOUT, 60) if files else API_READ_TIMEOUT
+        retries = API_RETRIES if name in self.IDEMPOTENT else 0
+
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            data = headers = None
+            if files:
+                # Streamed from the files, rebuilt (and so rewound) for every attempt
+                data = MultipartBody(files)
+                headers = {"Content-Type": data.content_type}
+            try:
+                response = self.session.request(method, url, params=params, data=data, headers=headers,
+                                                proxies=proxies, timeout=(API_CONNECT_TIMEOUT, read_timeout))
+            except requests.exceptions.ConnectTimeout:
+                # Nothing reached Telegram, so even a send is safe to repeat
+                error = True
+                if attempt >= API_RETRIES:
+                    self._record(name, started, error, attempt)
+                    raise
+            except requests.exceptions.RequestException:
+                error = True
+                if attempt >= retries:
+                    self._record(name, started, error, attempt)
+                    raise
+            else:
+                error = response.status_code >= 500
+                if not error or attempt >= retries:
+                    self._record(name, started, error, attempt)
+                    return response
+            attempt += 1
+            # Full jitter keeps retrying threads from hitting the API in lockstep
+            time.sleep(random.uniform(0, API_RETRY_BACKOFF * 2 ** attempt))
+
+    def _record(self, name, started, error, retries):
+        elapsed = time.monotonic() - started
+        with self.lock:
+            entry = self.methods.get(name)
+            if entry is None:
+                entry = self.methods[name] = {"calls": 0, "errors": 0, "retries": 0,
+                                              "samples": deque(maxlen=self.SAMPLES)}
+            entry["calls"] += 1
+            entry["errors"] += bool(error)
+            entry["retries"] += retries
+            if name != "getUpdates":  # long polls wait on purpose
+                entry["samples"].append(elapsed)
+
+    def stats(self):
+        """{method: {"calls", "errors", "retries", "p50_ms", "p99_ms"}}"""
+        result = {}
+        with self.lock:
+            for name, entry in self.methods.items():
+                samples = sorted(entry["samples"])
+                pick = lambda p: samples[min(len(samples) - 1, int(len(samples) * p))] * 1000 if samples else 0.0
+                result[name] = {"calls": entry["calls"], "errors": entry["errors"], "retries": entry["retries"],
+                                "p50_ms": pick(0.5), "p99_ms": pick(0.99)}
+        return result
+
+api_transport = BotApiTransport()
+apihelper.CUSTOM_REQUEST_SENDER = api_transport.request
+if BOT_API_URL:
+    apihelper.API_URL = BOT_API_URL + "/bot{0}/{1}"
+    apihelper.FILE_URL = BOT_API_URL + "/file/bot{0}/{1}"
+
+# ================= OUTBOUND DISPATCHER =================
+PRIORITY_INTERACTIVE = 0  # replies to buttons and commands
+PRIORITY_BULK = 1  # command output
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def wait_time(self, now):
+        """Seconds until a token is available (0 if one is available now)."""
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+class OutboundJob:
+    __slots__ = ("method", "chat_id", "kwargs", "priority", "key", "on_done",
+                 "transfer", "tries", "done", "result", "error")
+
+    def __init__(self, method, chat_id, kwargs, priority, key, on_done, transfer=False):
+        self.method = method
+        self.chat_id = chat_id
+        self.kwargs = kwargs
+        self.priority = priority
+        self.key = key
+        self.on_done = on_done
+        self.transfer = transfer
+        self.tries = 0
+        self.done = None
+        self.result = None
+        self.error = None
+
+class ChatLane:
+    """
+    Pending jobs of one chat, interactive ones first. Jobs without a chat
+    (callback answers) share a lane with no bucket: they only count against
+    the global rate and run in parallel, since their order does not matter.
+    """
+
+    def __init__(self, rate=None, burst=None):
+        self.queues = (deque(), deque())  # indexed by priority
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.paused_until = 0.0
+        self.busy = False
+
+    def __len__(self):
+        return len(self.queues[0]) + len(self.queues[1])
+
+    def peek(self):
+        return self.queues[0][0] if self.queues[0] else self.queues[1][0]
+
+    def pop(self):
+        return self.queues[0].popleft() if self.queues[0] else self.queues[1].popleft()
+
+class OutboundDispatcher:
+    """
+    Every outbound Bot API call goes through here. Calls of one chat run in
+    order, different chats run in parallel on a small worker pool. Per-chat and
+    global token buckets keep us under the Telegram limits, 429 responses pause
+    the chat for retry_after, and interactive replies jump ahead of bulk output.
+    Uploads (transfer=True) keep their place in the chat's order but run on
+    their own transfer workers, so a slow 50 MB document never holds one of
+    the workers that deliver everyone else's messages.
+    """
+
+    def __init__(self, client, workers=OUTBOUND_WORKERS, transfer_workers=TRANSFER_WORKERS,
+                 global_rate=OUTBOUND_GLOBAL_RATE,
+                 global_burst=OUTBOUND_GLOBAL_BURST, chat_rate=OUTBOUND_CHAT_RATE,
+                 chat_burst=OUTBOUND_CHAT_BURST, chat_queue=OUTBOUND_CHAT_QUEUE):
+        self.client = client
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_queue = chat_queue
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.cond = threading.Condition()
+        self.lanes = {}  # chat_id -> ChatLane, in round-robin order
+        self.keyed = {}  # coalescing key -> queued job
+        self.queued = 0
+        self.counters = {"sent": 0, "failed": 0, "dropped": 0, "coalesced": 0, "rate_limited": 0}
+        for i in range(workers):
+            threading.Thread(target=self._worker, name=f"outbound-{i}", daemon=True).start()
+        for i in range(transfer_workers):
+            threading.Thread(target=self._worker, args=(True,), name=f"outbound-transfer-{i}", daemon=True).start()
+
+    def submit(self, method, chat_id=None, priority=PRIORITY_BULK, key=None,
+               on_done=None, wait=False, transfer=False, **kwargs):
+        """
+        Queue client.<method>(**kwargs). chat_id is passed through and picks the lane.
+        A job with the same key as a queued one replaces its arguments instead.
+        With wait=True, blocks and returns the API result (or raises).
+        transfer=True runs it on the transfer workers instead of the shared ones.
+        """
+        if chat_id is not None:
+            kwargs["chat_id"] = chat_id
+        with self.cond:
+            if key is not None and key in self.keyed:
+                self.keyed[key].kwargs = kwargs
+                self.counters["coalesced"] += 1
+                return None
+
+            job = OutboundJob(method, chat_id, kwargs, priority, key, on_done, transfer)
+            if wait:
+                job.done = threading.Event()
+            lane = self.lanes.get(chat_id)
+            if lane is None:
+                lane = self.lanes[chat_id] = (ChatLane() if chat_id is None
+                                              else ChatLane(self.chat_rate, self.chat_burst))
+            lane.queues[priority].append(job)
+            self.queued += 1
+            if key is not None:
+                self.keyed[key] = job
+            dropped = None
+            if len(lane.queues[PRIORITY_BULK]) > self.chat_queue:
+                dropped = lane.queues[PRIORITY_BULK].popleft()
+                self.counters["dropped"] += 1
+                dropped.error = RuntimeError("dropped: outbound queue full")
+                self._finish(dropped)
+            self._notify()
+
+        if dropped is not None:
+            self._complete(dropped)
+        if wait:
+            job.done.wait()
+            if job.error is not None:
+                raise job.error
+            return job.result
+        return None
+
+    def stats(self):
+        with self.cond:
+            return dict(self.counters, queued=self.queued)
+
+    def _notify(self):
+        # Called with self.cond held. Shared and transfer workers wait on the same condition
+        self.cond.notify_all()
+
+    def _finish(self, job):
+        # Called with self.cond held
+        self.queued -= 1
+        if job.key is not None and self.keyed.get(job.key) is job:
+            del self.keyed[job.key]
+
+    @staticmethod
+    def _complete(job):
+        if job.on_done is not None:
+            try:
+                job.on_done(job.result)
+            except Exception as e:
+                print(f"⚠️ Outbound callback error: {e}")
+        if job.done is not None:
+            job.done.set()
+
+    def _take(self, accept=(False,)):
+        """
+        Next runnable job, or the number of seconds to wait for one. accept
+        holds the job.transfer values the caller runs: (False,) for the
+        shared workers, (True,) for the transfer workers.
+        """
+        now = time.monotonic()
+        wait = self.global_bucket.wait_time(now)
+        if wait > 0:
+            return None, wait
+        wait = None
+        chosen = None
+        idle = []
+        for chat_id, lane in self.lanes.items():
+            if lane.busy:
+                continue
+            if not len(lane):
+                # Forget the lane once its bucket has refilled
+                if lane.bucket is None or (lane.bucket.wait_time(now) == 0
+                                           and lane.bucket.tokens >= lane.bucket.burst):
+                    idle.append(chat_id)
+                continue
+            if lane.peek().transfer not in accept:
+                continue  # the other kind of worker serves this lane's head
+            lane_wait = lane.paused_until - now
+            if lane.bucket is not None:
+                lane_wait = max(lane_wait, lane.bucket.wait_time(now))
+            if lane_wait > 0:
+                wait = lane_wait if wait is None else min(wait, lane_wait)
+                continue
+            if chosen is None or lane.peek().priority < chosen[1].peek().priority:
+                chosen = (chat_id, lane)
+                if lane.peek().priority == PRIORITY_INTERACTIVE:
+                    break
+        for chat_id in idle:
+            del self.lanes[chat_id]
+        if chosen is None:
+            return None, wait
+
+        chat_id, lane = chosen
+        job = lane.pop()
+        if job.key is not None and self.keyed.get(job.key) is job:
+            del self.keyed[job.key]  # later submits queue a fresh job
+        if lane.bucket is not None:
+            lane.busy = True
+            lane.bucket.take()
+        self.global_bucket.take()
+        # Move the lane to the back for round-robin fairness
+        del self.lanes[chat_id]
+        self.lanes[chat_id] = lane
+        return job, None
+
+    def _worker(self, transfer=False):
+        while True:
+            with self.cond:
+                while True:
+                    job, wait = self._take((transfer,))
+                    if job is not None:
+                        break
+                    self.cond.wait(wait)
+            self._run(job)
+
+    # What the client raises: error answers of the API, HTTP errors without a
+    # JSON answer, and network failures (retried, nothing was delivered)
+    API_ERROR = ApiTelegramException
+    HTTP_ERROR = ApiHTTPException
+    NETWORK_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+    @staticmethod
+    def _http_status(error):
+        return error.result.status_code
+
+    def _run(self, job):
+        self._rewind(job)
+        try:
+            job.result = getattr(self.client, job.method)(**job.kwargs)
+        except Exception as e:
+            self._settle(job, e)
+        else:
+            self._settle(job, None)
+
+    @staticmethod
+    def _rewind(job):
+        job.tries += 1
+        for value in job.kwargs.values():
+            if hasattr(value, "seek"):
+                value.seek(0)  # rewind uploads when retrying
+
+    def _classify(self, job, e):
+        """(seconds until a retry or None, whether it was a 429) for a failed call."""
+        backoff = min(2 ** job.tries, 30)
+        if isinstance(e, self.API_ERROR):
+            if e.error_code == 429:
+                job.error = e
+                return (e.result_json.get("parameters") or {}).get("retry_after", 1), True
+            if e.error_code >= 500:
+                job.error = e
+                return backoff, False
+            if "message is not modified" not in e.description:
+                job.error = e
+            return None, False
+        job.error = e
+        if isinstance(e, self.NETWORK_ERRORS):
+            return backoff, False
+        if isinstance(e, self.HTTP_ERROR):
+            return (backoff if self._http_status(e) >= 500 else None), False
+        # A bug, not the network: repeating it would only repeat its side effects
+        print(f"⚠️ {job.method} to {job.chat_id} raised {e!r}, not retrying")
+        return None, False
+
+    def _settle(self, job, error):
+        """Retry the job later or finish it, after a call that raised error (or None)."""
+        retry_after, limited = (None, False) if error is None else self._classify(job, error)
+        with self.cond:
+            lane = self.lanes.get(job.chat_id)
+            if lane is None:  # the chat-less lane is not held busy and may have been dropped
+                lane = self.lanes[job.chat_id] = ChatLane()
+            lane.busy = False
+            if limited:
+                self.counters["rate_limited"] += 1
+            finished = retry_after is None or job.tries >= OUTBOUND_MAX_RETRIES
+            if finished:
+                self._finish(job)
+                if job.error is not None:
+                    self.counters["failed"] += 1
+                else:
+                    self.counters["sent"] += 1
+            else:
+                job.error = None
+                lane.paused_until = time.monotonic() + retry_after
+                lane.queues[job.priority].appendleft(job)
+            self._notify()
+
+        if finished:
+            if job.error is not None:
+                print(f"⚠️ {job.method} to {job.chat_id} failed: {job.error}")
+            self._complete(job)
+
+class UploadView:
+    """
+    One attempt's view of a file being uploaded through aiohttp, which closes
+    what it sent. The caller's file object stays open for a retry, and the
+    size is known up front, so the request still has a Content-Length.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.size = len(file) if hasattr(file, "__len__") else os.fstat(file.fileno()).st_size
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        return self.file.seek(pos, whence)
+
+    def tell(self):
+        return self.file.tell()
+
+    def close(self):
+        pass  # the caller closes the file
+
+class AsyncOutboundDispatcher(OutboundDispatcher):
+    """
+    OutboundDispatcher for ENGINE=asyncio: the same lanes, buckets, coalescing
+    and retries, but every call is a coroutine of the async client on the
+    reactor loop instead of a job for a worker thread. A slow call holds no
+    thread, so how many chats send at once is bounded only by the buckets.
+    Uploads still run at most transfer_workers at a time.
+    """
+
+    UPLOAD_TIMEOUT = 3600  # aiohttp's timeout covers the whole request, not one read
+
+    def __init__(self, client, loop, transfer_workers=TRANSFER_WORKERS, **limits):
+        self.loop = loop
+        self.wakeup = asyncio.Event()
+        self.transfer_limit = transfer_workers
+        self.transfers = 0  # uploads in flight
+        self.API_ERROR = asyncio_helper.ApiTelegramException
+        self.HTTP_ERROR = asyncio_helper.ApiHTTPException
+        self.NETWORK_ERRORS = (asyncio_helper.RequestTimeout, aiohttp.ClientError, asyncio.TimeoutError)
+        super().__init__(client, workers=0, transfer_workers=0, **limits)
+        asyncio.run_coroutine_threadsafe(self._pump(), loop)
+
+    @staticmethod
+    def _http_status(error):
+        return error.result.status
+
+    def _notify(self):
+        # Called with self.cond held, from any thread
+        self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    async def _pump(self):
+        """Starts each job as a task as soon as its lane and the buckets allow."""
+        while True:
+            self.wakeup.clear()  # before _take, so a submit racing it wakes us again
+            with self.cond:
+                job, wait = self._take((False, True) if self.transfers < self.transfer_limit else (False,))
+                if job is not None and job.transfer:
+                    self.transfers += 1
+            if job is not None:
+                self.loop.create_task(self._run_async(job))
+                continue
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run_async(self, job):
+        self._rewind(job)
+        kwargs = {key: UploadView(value) if hasattr(value, "read") else value
+                  for key, value in job.kwargs.items()}
+        if job.transfer:
+            kwargs["timeout"] = self.UPLOAD_TIMEOUT
+        started = time.monotonic()
+        try:
+            job.result = await getattr(self.client, job.method)(**kwargs)
+            error = None
+        except Exception as e:
+            error = e
+        # Same per-method latencies in /status as the threaded transport keeps
+        first, *rest = job.method.split("_")
+        failed = isinstance(error, self.NETWORK_ERRORS + (self.HTTP_ERROR,)) or getattr(error, "error_code", 0) >= 500
+        api_transport._record(first + "".join(word.title() for word in rest), started, failed, 0)
+        if job.transfer:
+            with self.cond:
+                self.transfers -= 1
+        self._settle(job, error)
+
+if ENGINE == "asyncio":
+    class UploadPayload(aiohttp.payload.IOBasePayload):
+        """Streams an UploadView from a worker thread, like aiohttp does an open file."""
+
+        @property
+        def size(self):
+            return self._value.size
+
+    aiohttp.payload.PAYLOAD_REGISTRY.register(UploadPayload, UploadView)
+    asyncio_helper.REQUEST_TIMEOUT = API_READ_TIMEOUT
+    if BOT_API_URL:
+        asyncio_helper.API_URL = apihelper.API_URL
+        asyncio_helper.FILE_URL = apihelper.FILE_URL
+    async_bot = AsyncTeleBot(BOT_TOKEN)
+    dispatcher = AsyncOutboundDispatcher(async_bot, reactor.loop)
+
+    @atexit.register
+    def close_async_session():
+        # aiohttp warns about a session still open when the interpreter exits
+        if asyncio_helper.session_manager.session is not None and reactor.loop.is_running():
+            try:
+                reactor.submit(async_bot.close_session()).result(5)
+            except Exception:
+                pass
+else:
+    dispatcher = OutboundDispatcher(bot)
+
+def send_text(chat_id, text, priority=PRIORITY_INTERACTIVE, wait=False, **kwargs):
+    return dispatcher.submit("send_message", chat_id, priority=priority, wait=wait, text=text, **kwargs)
+
+def answer_callback(callback_query_id, text=None):
+    dispatcher.submit("answer_callback_query", priority=PRIORITY_INTERACTIVE,
+                      callback_query_id=callback_query_id, text=text)
+
+# ================= INGRESS GUARD =================
+class IngressGuard(BaseMiddleware):
+    """
+    Runs before every message and callback handler. Drops updates that are
+    older than INGRESS_MAX_AGE (a backlog replayed after an outage), that
+    exceed the per-chat or per-user rate, or that repeat the same command
+    within INGRESS_DEDUP_WINDOW seconds. Input for an attached program is
+    neither rate limited nor collapsed, and stop requests are never dropped.
+    Callbacks are only collapsed when Telegram delivers the same query
+    twice, so tapping a button again always works; a dropped callback is
+    still answered, so the button stops spinning.
+    """
+
+    NOTICE_INTERVAL = 10  # seconds between "slow down" notices per chat
+    MAX_BUCKETS = 10000
+    ALWAYS_PASS = {"/stop", "🛑 stop"}
+
+    def __init__(self):
+        super().__init__()
+        self.update_types = ["message", "callback_query"]
+        self.lock = threading.Lock()
+        self.chat_buckets = {}
+        self.user_buckets = {}
+        self.recent = {}  # (chat_id, text) -> time it was last let through
+        self.notices = {}  # (chat_id, reason) -> time of the last notice
+        self.counters = {"passed": 0, "stale": 0, "rate_limited": 0, "collapsed": 0}
+
+    def pre_process(self, update, data):
+        to_input = False
+        if isinstance(update, types.CallbackQuery):
+            chat_id, user_id, sent = update.message.chat.id, update.from_user.id, None
+            key = ("callback", update.id)
+        else:
+            chat_id = update.chat.id
+            user_id = update.from_user.id if update.from_user else chat_id
+            key, sent = update.text, update.date
+            # The same test shell() uses to route a message to the attached program
+            to_input = (key is not None and not key.startswith("/")
+                        and not (COMMAND_ESCAPE and key.strip().startswith(COMMAND_ESCAPE))
+                        and registry.input_target(chat_id) is not None)
+
+        reason = self.check(chat_id, user_id, key, sent, to_input)
+        if reason is None:
+            return None
+        if isinstance(update, types.CallbackQuery):
+            answer_callback(update.id)  # stop the button spinner
+        self._notify(chat_id, reason)
+        return CancelUpdate()
+
+    def post_process(self, update, data, exception):
+        pass
+
+    def check(self, chat_id, user_id, key, sent=None, to_input=False):
+        """Returns why the update is dropped, or None to let it through."""
+        now = time.time()
+        if sent is not None and INGRESS_MAX_AGE and now - sent > INGRESS_MAX_AGE:
+            return self._count("stale")
+        if to_input or key in self.ALWAYS_PASS:
+            return self._count(None)
+
+        with self.lock:
+            collapse = (chat_id, key) if key else None
+            last = self.recent.get(collapse) if collapse else None
+            if last is not None and now - last < INGRESS_DEDUP_WINDOW:
+                reason = "collapsed"
+            else:
+                mono = time.monotonic()
+                chat_bucket = self._bucket(self.chat_buckets, chat_id, INGRESS_CHAT_RATE, INGRESS_CHAT_BURST)
+                user_bucket = self._bucket(self.user_buckets, user_id, INGRESS_USER_RATE, INGRESS_USER_BURST)
+                if chat_bucket.wait_time(mono) or user_bucket.wait_time(mono):
+                    reason = "rate_limited"
+                else:
+                    chat_bucket.take()
+                    user_bucket.take()
+                    reason = None
+                    if collapse:
+                        if len(self.recent) >= self.MAX_BUCKETS:
+                            self._prune(self.recent, lambda seen: now - seen >= INGRESS_DEDUP_WINDOW)
+                        self.recent[collapse] = now
+        return self._count(reason)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def _count(self, reason):
+        with self.lock:
+            self.counters[reason or "passed"] += 1
+        return reason
+
+    def _bucket(self, buckets, key, rate, burst):
+        bucket = buckets.get(key)
+        if bucket is None:
+            if len(buckets) >= self.MAX_BUCKETS:
+                mono = time.monotonic()
+                self._prune(buckets, lambda b: b.wait_time(mono) == 0 and b.tokens >= b.burst)
+            bucket = buckets[key] = TokenBucket(rate, burst)
+        return bucket
+
+    @staticmethod
+    def _prune(table, expired):
+        for key in [key for key, value in table.items() if expired(value)]:
+            del table[key]
+
+    def _notify(self, chat_id, reason):
+        if reason == "collapsed":
+            return  # the first copy is already being answered
+        now = time.time()
+        with self.lock:
+            if now - self.notices.get((chat_id, reason), 0) < self.NOTICE_INTERVAL:
+                return
+            self.notices[(chat_id, reason)] = now
+            if len(self.notices) > self.MAX_BUCKETS:
+                self._prune(self.notices, lambda sent: now - sent >= self.NOTICE_INTERVAL)
+        if reason == "stale":
+            send_text(chat_id, "⏭️ Skipped messages sent while the bot was offline. Send them again if still needed.")
+        else:
+            send_text(chat_id, "🐢 Too many messages, some were ignored. Slow down a little.")
+
+ingress_guard = IngressGuard()
+bot.setup_middleware(ingress_guard)
+
+# ================= PTY TEXT STREAM =================
+_PLAIN_RUN = re.compile(r"[^\x00-\x1f\x7f-\x9f]+")
+_CSI_PARAMS = re.compile(r"[\x20-\x3f]*")
+_STRING_END = re.compile(r"[\x07\x1b]")
+_MD_SPECIAL = re.compile(r"([_*\[\]()~`>#+\-=|{}.!\\])")
+
+def md_escape(text):
+    """Escape plain text for MarkdownV2."""
+    return _MD_SPECIAL.sub(r"\\\1", text)
+
+def md_code_block(text):
+    """Wrap text in a MarkdownV2 pre block; only ` and \\ need escaping there."""
+    return "```\n" + text.replace("\\", "\\\\").replace("`", "\\`") + "\n```"
+
+class EscapeTokenizer:
+    """
+    Splits raw PTY bytes into printable runs and terminal control events:
+    incremental UTF-8 decoding (characters split across reads survive) and
+    the ESC/CSI/OSC syntax, with its state kept between reads so a sequence
+    split across two chunks still parses. feed() yields (kind, data, params):
+
+        TEXT     data is a run of printable characters
+        CONTROL  data is one control character (\n, \r, \b, \t, bell, ...)
+        ESCAPE   data is the final character of a two-character ESC sequence
+        CSI      data is the final character, params the parameter bytes
+
+    OSC/DCS strings (window titles etc.), ended by BEL or ESC \\, and
+    charset designations are consumed without an event.
+    """
+
+    TEXT, CONTROL, ESCAPE, CSI = range(4)
+    _GROUND, _ESC, _CSI, _STRING, _STRING_ESC, _CHARSET = range(6)
+
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.state = self._GROUND
+        self.params = ""
+
+    def feed(self, data, final=False):
+        text = self.decoder.decode(data, final)
+        i, n = 0, len(text)
+        while i < n:
+            state = self.state
+            if state == self._GROUND:
+                m = _PLAIN_RUN.match(text, i)
+                if m:
+                    i = m.end()
+                    yield self.TEXT, m.group(), ""
+                    continue
+                ch = text[i]
+                i += 1
+                if ch == "\x1b":
+                    self.state = self._ESC
+                elif ch == "\x9b":
+                    self.state, self.params = self._CSI, ""
+                else:
+                    yield self.CONTROL, ch, ""
+            elif state == self._ESC:
+                ch = text[i]
+                i += 1
+                if ch == "[":
+                    self.state, self.params = self._CSI, ""
+                elif ch in "]PX^_":
+                    self.state = self._STRING  # OSC/DCS: window titles etc.
+                elif "\x20" <= ch <= "\x2f":
+                    self.state = self._CHARSET
+                else:
+                    self.state = self._GROUND
+                    yield self.ESCAPE, ch, ""
+            elif state == self._CSI:
+                m = _CSI_PARAMS.match(text, i)
+                self.params += m.group()
+                i = m.end()
+                if i < n:
+                    self.state = self._GROUND
+                    i += 1
+                    yield self.CSI, text[i - 1], self.params
+            elif state == self._STRING:
+                m = _STRING_END.search(text, i)
+                if m is None:
+                    i = n
+                else:
+                    i = m.end()
+                    self.state = self._GROUND if m.group() == "\x07" else self._STRING_ESC
+            elif state == self._STRING_ESC:
+                self.state = self._GROUND if text[i] == "\\" else self._STRING
+                i += 1
+            else:  # _CHARSET: intermediates then one final char
+                if not "\x20" <= text[i] <= "\x2f":
+                    self.state = self._GROUND
+                i += 1
+
+class PtyTextStream:
+    """
+    Turns raw PTY bytes of one process into chat-friendly text: escape
+    sequences are dropped (see EscapeTokenizer) and carriage returns
+    overwrite the current line, so progress bars collapse into their last
+    state. feed() returns completed lines; partial() is the line being drawn.
+    """
+
+    MAX_LINE = 4096
+
+    def __init__(self):
+        self.tokens = EscapeTokenizer()
+        self.line = ""
+        self.col = 0
+
+    def partial(self):
+        return self.line
+
+    def finish(self):
+        """Flush everything at EOF, including an unterminated last line."""
+        out = self.feed(b"", final=True)
+        out += self.line
+        self.line, self.col = "", 0
+        return out
+
+    def feed(self, data, final=False):
+        out = []
+        for kind, value, params in self.tokens.feed(data, final):
+            if kind == EscapeTokenizer.TEXT:
+                self._write(value)
+            elif kind == EscapeTokenizer.CONTROL:
+                if value == "\n":
+                    out.append(self.line + "\n")
+                    self.line, self.col = "", 0
+                elif value == "\r":
+                    self.col = 0
+                elif value == "\b":
+                    self.col = max(0, self.col - 1)
+                elif value == "\t":
+                    self._write("\t")
+                # Other control characters (bell, shift-in/out, ...) are dropped
+            elif kind == EscapeTokenizer.CSI:
+                self._csi(value, params)
+            if len(self.line) > self.MAX_LINE:
+                out.append(self.line + "\n")
+                self.line, self.col = "", 0
+        return "".join(out)
+
+    def _write(self, run):
+        line, col = self.line, self.col
+        if col > len(line):
+            line += " " * (col - len(line))
+        self.line = line[:col] + run + line[col + len(run):]
+        self.col = col + len(run)
+
+    def _csi(self, final, params):
+        num = int(params) if params.isascii() and params.isdigit() else None
+        if final == "K":
+            # Erase in line: to the end (0), from the start (1) or all (2)
+            if not num:
+                self.line = self.line[:self.col]
+            elif num == 1:
+                self.line = " " * self.col + self.line[self.col:]
+            elif num == 2:
+                self.line = ""
+        elif final == "C":
+            self.col += num or 1
+        elif final == "D":
+            self.col = max(0, self.col - (num or 1))
+        elif final == "G":
+            self.col = max(0, (num or 1) - 1)
+        # Colors, cursor addressing and modes have no meaning in a chat message
+
+# ================= TERMINAL SCREEN =================
+class TerminalScreen:
+    """
+    Minimal VT100/xterm screen model: a rows x cols grid of characters with
+    cursor addressing, erase, scroll regions, insert/delete and the
+    alternate screen. Rows touched since the last render are kept in dirty.
+    Colors and other attributes are ignored.
+    """
+
+    def __init__(self, rows, cols):
+        self.rows = rows
+        self.cols = cols
+        self.tokens = EscapeTokenizer()
+        self.reset()
+
+    def reset(self):
+        self.grid = [[" "] * self.cols for _ in range(self.rows)]
+        self.row = self.col = 0
+        self.top, self.bottom = 0, self.rows - 1
+        self.wrap_pending = False
+        self.saved = (0, 0)
+        self.dirty = set(range(self.rows))
+
+    def display(self):
+        return "\n".join("".join(line).rstrip() for line in self.grid).rstrip("\n")
+
+    def feed(self, data):
+        for kind, value, params in self.tokens.feed(data):
+            if kind == EscapeTokenizer.TEXT:
+                self._print(value)
+            elif kind == EscapeTokenizer.CSI:
+                self._csi(value, params)
+            elif kind == EscapeTokenizer.CONTROL:
+                if value in "\n\x0b\x0c":
+                    self._linefeed()
+                elif value == "\r":
+                    self._move(self.row, 0)
+                elif value == "\b":
+                    self._move(self.row, self.col - 1)
+                elif value == "\t":
+                    self._move(self.row, (self.col // 8 + 1) * 8)
+            # Otherwise an ESCAPE
+            elif value == "7":
+                self.saved = (self.row, self.col)
+            elif value == "8":
+                self._move(*self.saved)
+            elif value == "D":
+                self._linefeed()
+            elif value == "E":
+                self._move(self.row, 0)
+                self._linefeed()
+            elif value == "M":
+                if self.row == self.top:
+                    self._scroll_down(1)
+                else:
+                    self._move(self.row - 1, self.col)
+            elif value == "c":
+                self.reset()
+
+    def _print(self, run):
+        while run:
+            if self.wrap_pending:
+                self.wrap_pending = False
+                self.col = 0
+                self._linefeed()
+            line = self.grid[self.row]
+            piece = run[:self.cols - self.col]
+            line[self.col:self.col + len(piece)] = piece
+            self.dirty.add(self.row)
+            run = run[len(piece):]
+            if self.col + len(piece) >= self.cols:
+                self.col = self.cols - 1
+                self.wrap_pending = True
+            else:
+                self.col += len(piece)
+
+    def _move(self, row, col):
+        self.row = min(max(row, 0), self.rows - 1)
+        self.col = min(max(col, 0), self.cols - 1)
+        self.wrap_pending = False
+
+    def _blank(self):
+        return [" "] * self.cols
+
+    def _linefeed(self):
+        if self.row == self.bottom:
+            self._scroll_up(1)
+        elif self.row < self.rows - 1:
+            self.row += 1
+
+    def _scroll_up(self, n, at=None):
+        at = self.top if at is None else at
+        for _ in range(min(n, self.bottom - at + 1)):
+            del self.grid[at]
+            self.grid.insert(self.bottom, self._blank())
+        self.dirty.update(range(at, self.bottom + 1))
+
+    def _scroll_down(self, n, at=None):
+        at = self.top if at is None else at
+        for _ in range(min(n, self.bottom - at + 1)):
+            del self.grid[self.bottom]
+            self.grid.insert(at, self._blank())
+        self.dirty.update(range(at, self.bottom + 1))
+
+    def _erase(self, row, start, end):
+        self.grid[row][start:end] = [" "] * (end - start)
+        self.dirty.add(row)
+
+    def _csi(self, final, params):
+        private = params[:1] in ("?", ">", "=", "!")
+        nums = [int(x) if x.isascii() and x.isdigit() else 0
+                for x in params.lstrip("?>=!").split(";")]
+
+        def arg(i, default=1):
+            return nums[i] if i < len(nums) and nums[i] else default
+
+        row, col = self.row, self.col
+        if final in "hl" and private:
+            if any(mode in (47, 1047, 1049) for mode in nums):
+                # Alternate screen: programs redraw it in full, so start blank
+                if final == "h" and 1049 in nums:
+                    self.saved = (row, col)
+                self.grid = [self._blank() for _ in range(self.rows)]
+                self.dirty.update(range(self.rows))
+                if final == "l" and 1049 in nums:
+                    self._move(*self.saved)
+        elif final == "A":
+            self._move(row - arg(0), col)
+        elif final in "Be":
+            self._move(row + arg(0), col)
+        elif final in "Ca":
+            self._move(row, col + arg(0))
+        elif final == "D":
+            self._move(row, col - arg(0))
+        elif final == "E":
+            self._move(row + arg(0), 0)
+        elif final == "F":
+            self._move(row - arg(0), 0)
+        elif final in "G`":
+            self._move(row, arg(0) - 1)
+        elif final == "d":
+            self._move(arg(0) - 1, col)
+        elif final in "Hf":
+            self._move(arg(0) - 1, arg(1) - 1)
+        elif final == "J":
+            mode = arg(0, 0)
+            if mode == 0:
+                self._erase(row, col, self.cols)
+                rows = range(row + 1, self.rows)
+            elif mode == 1:
+                self._erase(row, 0, col + 1)
+                rows = range(0, row)
+            else:
+                rows = range(self.rows)
+            for r in rows:
+                self._erase(r, 0, self.cols)
+        elif final == "K":
+            mode = arg(0, 0)
+            start, end = {0: (col, self.cols), 1: (0, col + 1)}.get(mode, (0, self.cols))
+            self._erase(row, start, end)
+        elif final == "L":
+            if self.top <= row <= self.bottom:
+                self._scroll_down(arg(0), at=row)
+        elif final == "M":
+            if self.top <= row <= self.bottom:
+                self._scroll_up(arg(0), at=row)
+        elif final == "@":
+            line = self.grid[row]
+            line[col:col] = [" "] * arg(0)
+            del line[self.cols:]
+            self.dirty.add(row)
+        elif final == "P":
+            line = self.grid[row]
+            n = min(arg(0), self.cols - col)
+            del line[col:col + n]
+            line.extend([" "] * n)
+            self.dirty.add(row)
+        elif final == "X":
+            self._erase(row, col, min(self.cols, col + arg(0)))
+        elif final == "S":
+            self._scroll_up(arg(0))
+        elif final == "T" and not private:
+            self._scroll_down(arg(0))
+        elif final == "r" and not private:
+            top, bottom = arg(0) - 1, arg(1, self.rows) - 1
+            if 0 <= top < bottom < self.rows:
+                self.top, self.bottom = top, bottom
+                self._move(0, 0)
+        elif final == "s" and not private:
+            self.saved = (row, col)
+        elif final == "u" and not private:
+            self._move(*self.saved)
+        # SGR (m), mode switches and queries change nothing we render
+
+# ================= OUTPUT AGGREGATOR =================
+class LiveMessage:
+    """
+    A chat message that is sent once and then edited in place.
+    Queued edits collapse into the newest text. Runs on the reactor thread.
+    """
+
+    def __init__(self, chat_id, parse_mode="MarkdownV2", reply_markup=None):
+        self.chat_id = chat_id
+        self.parse_mode = parse_mode
+        self.reply_markup = reply_markup  # sent with every edit, or Telegram drops it
+        self.id = None
+        self.text = None
+        self.sending = False
+
+    def update(self, text):
+        if text == self.text:
+            return
+        self.text = text
+        if self.id is not None:
+            dispatcher.submit("edit_message_text", self.chat_id, key=("live", id(self)), text=text,
+                              message_id=self.id, parse_mode=self.parse_mode, reply_markup=self.reply_markup)
+        elif not self.sending:
+            self.sending = True
+            dispatcher.submit("send_message", self.chat_id, text=text, parse_mode=self.parse_mode,
+                              reply_markup=self.reply_markup,
+                              on_done=lambda msg: reactor.call_soon(self._sent, text, msg))
+
+    def _sent(self, text, msg):
+        self.sending = False
+        if msg is None:
+            self.text = None  # send failed, the next update retries
+            return
+        self.id = msg.message_id
+        if self.text != text:
+            # Updated while the first send was in flight
+            latest, self.text = self.text, None
+            self.update(latest)
+
+class OutputAggregator:
+    """
+    Buffers the output of one process and keeps editing a single "live"
+    message with it. The message is rolled over once it reaches the
+    Telegram limit, so a command costs at most two API calls per flush
+    window whatever it prints. Past OUTPUT_SPILL_THRESHOLD the output goes
+    to a temp file instead, the live message shows a head/tail preview and
+    the file is sent as a document on exit. Runs on the reactor thread.
+    """
+
+    BODY_LIMIT = MESSAGE_LIMIT - len("```\n\n```") - 120  # room for the exit status line
+
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        self.text = ""  # content of the current live message
+        self.full = False
+        self.pending = []
+        self.pending_len = 0
+        self.skipped = 0
+        self.live = LiveMessage(chat_id)
+        self.timer = None
+        self.last_flush = 0.0
+        self.total = 0
+        self.seen = []  # everything printed until the spill starts
+        self.spill = None
+        self.spill_raw = None  # file under the gzip stream, which does not close it
+        self.spill_path = None
+        self.spill_name = None
+        self.preview_head = ""
+        self.tail = deque()
+        self.tail_len = 0
+        self.partial = ""  # line still being drawn (progress bars, prompts)
+        self.footer = None  # exit status, shown under the last message
+
+    def feed(self, data, partial=""):
+        self.partial = partial
+        if not data:
+            pass
+        elif self.spill is not None:
+            self.total += len(data)
+            self.spill.write(data)
+            self._keep_tail(data)
+        elif OUTPUT_SPILL_THRESHOLD and self.total + len(data) > OUTPUT_SPILL_THRESHOLD:
+            self.total += len(data)
+            self._start_spill(data)
+        else:
+            self.total += len(data)
+            if OUTPUT_SPILL_THRESHOLD:
+                self.seen.append(data)
+            self.pending.append(data)
+            self.pending_len += len(data)
+            if self.pending_len > OUTPUT_BUFFER_LIMIT:
+                # Output outruns the rate limit: keep the newest part only
+                data = "".join(self.pending)
+                cut = len(data) - OUTPUT_BUFFER_LIMIT
+                self.skipped += cut
+                self.pending, self.pending_len = [data[cut:]], OUTPUT_BUFFER_LIMIT
+        self._schedule()
+
+    def _schedule(self):
+        # Flush after the time window, or after half of it once enough is buffered
+        window = OUTPUT_FLUSH_INTERVAL
+        if self.pending_len >= OUTPUT_FLUSH_BYTES:
+            window /= 2
+        due = max(self.last_flush + window, time.monotonic())
+        if self.timer is None or self.timer[0] > due:
+            if self.timer is not None:
+                reactor.cancel(self.timer)
+            self.timer = reactor.call_later(due - time.monotonic(), self.flush)
+
+    def _start_spill(self, data):
+        seen = "".join(self.seen) + data
+        self.seen = None
+        self.spill_name = "output.log.gz" if OUTPUT_SPILL_GZIP else "output.log"
+        fd, self.spill_path = tempfile.mkstemp(prefix="termux-bot-", suffix="-" + self.spill_name)
+        if OUTPUT_SPILL_GZIP:
+            self.spill_raw = os.fdopen(fd, "wb")
+            self.spill = gzip.open(self.spill_raw, "wt", encoding="utf-8")
+        else:
+            self.spill = os.fdopen(fd, "w", encoding="utf-8")
+        self.spill.write(seen)
+        self.preview_head = seen[:OUTPUT_PREVIEW_CHARS]
+        self._keep_tail(seen)
+        # Everything is in the file now; the live message turns into the preview
+        self.pending, self.pending_len, self.skipped = [], 0, 0
+        self.text = ""
+
+    def _keep_tail(self, data):
+        self.tail.append(data)
+        self.tail_len += len(data)
+        while self.tail_len - len(self.tail[0]) >= OUTPUT_PREVIEW_CHARS:
+            self.tail_len -= len(self.tail.popleft())
+
+    def _preview(self, done):
+        size = md_escape(f"{self.total / 1024:.1f} KB")
+        if done:
+            header = f"📦 *Output: {size}* — full log attached"
+        else:
+            header = f"📦 *Output: {size} so far* — full log will be attached"
+        tail = ("".join(self.tail) + self.partial)[-OUTPUT_PREVIEW_CHARS:]
+        gap = self.total - len(self.preview_head) - len(tail)
+        if gap > 0:
+            body = f"{self.preview_head}\n...\n{tail}"
+        else:
+            body = self.preview_head + tail[-gap:]
+        text = f"{header}\n{md_code_block(body)}"
+        if done and self.footer:
+            text += f"\n{self.footer}"
+        return text
+
+    def flush(self):
+        self.timer = None
+        self.last_flush = time.monotonic()
+        if self.spill is not None:
+            self._push(self._preview(done=False))
+            return
+
+        data = "".join(self.pending)
+        self.pending, self.pending_len = [], 0
+        if self.skipped:
+            data = f"\n... [{self.skipped} chars skipped] ...\n" + data
+            self.skipped = 0
+
+        rolled = False
+        while data:
+            if self.full:
+                if rolled:
+                    break
+                self.live = LiveMessage(self.chat_id)
+                self.text = ""
+                self.full = False
+                rolled = True
+            room = self.BODY_LIMIT - len(self.text)
+            if len(data) <= room:
+                self.text += data
+                data = ""
+                break
+            # Roll over at a line boundary when there is one
+            cut = data.rfind("\n", 0, room) + 1
+            if not cut and not self.text:
+                cut = room
+            self.text += data[:cut]
+            data = data[cut:]
+            self.full = True
+            self._push()  # message is full, send its final state
+
+        if data:
+            # Carry what did not fit to the next window
+            self.pending, self.pending_len = [data], len(data)
+            self.timer = reactor.call_later(OUTPUT_FLUSH_INTERVAL, self.flush)
+        self._push()
+
+    def flush_now(self):
+        """Flush without waiting for the window, e.g. when a prompt appeared."""
+        if self.timer is not None:
+            reactor.cancel(self.timer)
+        self.flush()
+
+    def close(self, footer=None):
+        # Final flush; anything left keeps draining at the normal rate
+        if footer:
+            self.footer = md_escape(footer)
+        if self.timer is not None:
+            reactor.cancel(self.timer)
+        if self.spill is None:
+            self.flush()
+            return
+
+        self.timer = None
+        self.spill.close()
+        if self.spill_raw is not None:
+            self.spill_raw.close()
+        self._push(self._preview(done=True))
+        path = self.spill_path
+        doc = open(path, "rb")
+
+        def done(_):
+            doc.close()
+            os.unlink(path)
+
+        dispatcher.submit("send_document", self.chat_id, on_done=done, transfer=True, document=doc,
+                          visible_file_name=self.spill_name)
+
+    def _push(self, text=None):
+        if text is None:
+            body = self.text
+            room = self.BODY_LIMIT - len(body)
+            if self.partial and room > 0 and not self.full:
+                body += self.partial[-room:]
+            text = md_code_block(body) if body.strip() else ""
+            if self.footer and not self.pending:
+                text = f"{text}\n{self.footer}" if text else self.footer
+            if not text:
+                return
+        self.live.update(text)
+
+# ================= LIVE SCREEN =================
+class LiveScreen:
+    """
+    Renders the screen of a full-screen program into one message, at most
+    SCREEN_FPS times a second and only when a rendered cell changed.
+    Runs on the reactor thread.
+    """
+
+    def __init__(self, chat_id, title, rows=SCREEN_ROWS, cols=SCREEN_COLS):
+        self.screen = TerminalScreen(rows, cols)
+        self.live = LiveMessage(chat_id)
+        self.title = title
+        self.timer = None
+        self.last_frame = 0.0
+        self.shown = ""
+
+    def feed(self, data):
+        self.screen.feed(data)
+        if self.screen.dirty and self.timer is None:
+            delay = max(0, self.last_frame + 1 / SCREEN_FPS - time.monotonic())
+            self.timer = reactor.call_later(delay, self.render)
+
+    def render(self, status="🟢 live"):
+        self.timer = None
+        self.last_frame = time.monotonic()
+        self.screen.dirty.clear()
+        frame = self.screen.display()
+        if not frame.strip():
+            if self.live.id is None:
+                return
+            if status != "🟢 live":
+                frame = self.shown  # program left the alternate screen on exit
+        self.shown = frame
+        # LiveMessage skips the edit when the frame text did not change
+        header = md_escape(f"🖥️ {self.title} • {status}")
+        self.live.update(f"{header}\n{md_code_block(frame)}")
+
+    def close(self, footer=None):
+        if self.timer is not None:
+            reactor.cancel(self.timer)
+        self.render(status=footer or "⏹️ exited")
+
+# ================= INTERACTIVE INPUT =================
+def tty_input_mode(fd):
+    """
+    How the program on a PTY reads input: "raw" when it handles keys itself
+    (readline REPLs, editors), "secret" for line input with echo off
+    (password prompts) and "line" otherwise. None once the PTY is gone.
+    """
+    try:
+        lflag = termios.tcgetattr(fd)[3]
+    except (termios.error, OSError):
+        return None
+    if not lflag & termios.ICANON:
+        return "raw"
+    if not lflag & termios.ECHO:
+        return "secret"
+    return "line"
+
+class PromptWatch:
+    """
+    Notices when the program behind a chat waits for a reply: its output has
+    been quiet for PROMPT_SETTLE seconds and the terminal is in raw or
+    no-echo mode, or the last line is left unfinished ("[Y/n] ", ">>> ").
+    The output is flushed right away then, so REPL round trips do not wait
+    for the flush window. Runs on the reactor thread.
+    """
+
+    def __init__(self, target, view, stream):
+        self.target = target
+        self.view = view
+        self.stream = stream
+        self.timer = None
+        self.warned = False
+
+    def poke(self):
+        """New output arrived; look again once it settles."""
+        if self.timer is not None:
+            reactor.cancel(self.timer)
+        self.timer = reactor.call_later(PROMPT_SETTLE, self._settle)
+
+    def cancel(self):
+        if self.timer is not None:
+            reactor.cancel(self.timer)
+            self.timer = None
+        self.target.waiting = False
+
+    def _settle(self):
+        self.timer = None
+        mode = tty_input_mode(self.target.fd)
+        if mode == "secret" and not self.target.secret_prompts:
+            mode = "line"
+        if mode is None or (mode == "line" and not self.stream.partial().strip()):
+            return
+        self.target.waiting = True
+        self.view.flush_now()
+        if mode == "secret" and not self.warned:
+            self.warned = True
+            send_text(self.target.chat_id, "🔑 Hidden input: your reply will be deleted from the chat.")
+
+def send_input(chat_id, text, message_id=None):
+    """Write a chat message to the stdin of the attached program (reactor thread)."""
+    target = registry.input_target(chat_id)
+    if target is None:
+        send_text(chat_id, "⚠️ The program has already exited, send the command again.")
+        return
+    fd = target.fd
+    mode = tty_input_mode(fd)
+
+    if len(text) == 2 and text[0] == "^" and "@" <= text[1].upper() <= "_":
+        data = bytes([ord(text[1].upper()) - 64])  # ^C, ^D, ^Z ...
+    else:
+        # Programs that read keys themselves expect Enter as CR
+        data = text.encode() + (b"\r" if mode == "raw" else b"\n")
+    if mode == "secret" and target.secret_prompts and message_id is not None:
+        dispatcher.submit("delete_message", chat_id, message_id=message_id)
+
+    target.waiting = False
+    try:
+        written = os.write(fd, data)
+    except BlockingIOError:
+        send_text(chat_id, "⚠️ The program is not reading input right now.")
+    except OSError as e:
+        send_text(chat_id, f"⚠️ Cannot send input: {e}")
+    else:
+        record = registry.get_chat(chat_id)
+        if record is not None and record.fd == fd:
+            record.bytes_in += written
+            record.last_io = time.time()
+
+# ================= ENHANCED PTY RUNNER =================
+def apply_child_limits():
+    """Runs in the forked child before exec."""
+    if CHILD_NICE:
+        os.nice(CHILD_NICE)
+    if CHILD_RLIMIT_CPU:
+        resource.setrlimit(resource.RLIMIT_CPU, (CHILD_RLIMIT_CPU, CHILD_RLIMIT_CPU + 5))
+    if CHILD_RLIMIT_AS:
+        limit = CHILD_RLIMIT_AS * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+def run_cmd(cmd, admin_id, chat_id, screen=False):
+    pid, fd = pty.fork()
+    if pid == 0:
+        # Child process
+        try:
+            os.chdir(BASE_DIR)
+            apply_child_limits()
+            if screen:
+                # Full-screen programs size themselves from the terminal
+                fcntl.ioctl(0, termios.TIOCSWINSZ, struct.pack("HHHH", SCREEN_ROWS, SCREEN_COLS, 0, 0))
+                os.environ["TERM"] = "xterm"
+            os.execvp("bash", ["bash", "-c", cmd])
+        finally:
+            os._exit(127)
+
+    # Parent process
+    record = ProcessRecord(pid, fd, chat_id, admin_id, cmd)
+    registry.add(record)
+    registry.touch(admin_id, chat_id)
+    os.set_blocking(fd, False)
+
+    if screen:
+        stream = watch = None
+        view = LiveScreen(chat_id, cmd)
+    else:
+        stream = PtyTextStream()
+        view = OutputAggregator(chat_id)
+    # Chat messages now go to this program's stdin
+    target = InputTarget(fd, chat_id, admin_id)
+    registry.attach(target)
+    watch = PromptWatch(target, view, stream) if stream is not None else None
+    pty_open = [True]
+
+    def close_pty():
+        if pty_open[0]:
+            pty_open[0] = False
+            reactor.remove_reader(fd)
+            if watch is not None:
+                watch.cancel()
+            registry.release_input(target)
+            os.close(fd)
+            if stream is not None:
+                view.feed(stream.finish())
+
+    def on_readable():
+        """Read one chunk; returns False once nothing more can be read."""
+        try:
+            raw = os.read(fd, PTY_READ_SIZE)
+        except BlockingIOError:
+            return False
+        except OSError:
+            raw = b""  # EIO: child side of the PTY is gone
+
+        if not raw:
+            close_pty()
+            return False
+
+        record.bytes_out += len(raw)
+        record.last_io = time.time()
+        if stream is None:
+            view.feed(raw)
+            return True
+        view.feed(stream.feed(raw), stream.partial())
+        watch.poke()
+        return True
+
+    def on_exit(info):
+        # Drain what the child printed last; a background job may keep the PTY
+        # open, so stop after a bounded number of reads
+        for _ in range(16):
+            if not pty_open[0] or not on_readable():
+                break
+        close_pty()
+        view.close(info.describe())
+        recent_exits.append((chat_id, cmd, info))
+        store.record_command(chat_id, admin_id, cmd, record.started, info.duration, info.code,
+                             info.cpu, info.max_rss_kb)
+        scheduler.release(admin_id)
+
+        # Activity only ends with the chat's current process
+        if registry.get_chat(chat_id) is record:
+            registry.forget(chat_id)
+        registry.remove(pid)
+
+    reactor.add_reader(fd, on_readable)
+    reaper.watch(pid, on_exit)
+
+# ================= COMMAND SCHEDULER =================
+class CommandScheduler:
+    """
+    Admission control in front of run_cmd. At most MAX_RUNNING_COMMANDS run
+    at once and at most MAX_COMMANDS_PER_ADMIN per admin; the rest wait in
+    per-admin FIFO queues that are served round-robin, so one busy admin
+    cannot starve the others.
+    """
+
+    def __init__(self, max_running=MAX_RUNNING_COMMANDS, max_per_admin=MAX_COMMANDS_PER_ADMIN,
+                 max_queued=MAX_QUEUED_COMMANDS):
+        self.max_running = max_running
+        self.max_per_admin = max_per_admin
+        self.max_queued = max_queued
+        self.lock = threading.Lock()
+        self.running = {}  # admin_id -> number of running commands
+        self.total = 0
+        self.queues = {}  # admin_id -> deque of (chat_id, cmd, screen), in round-robin order
+        self.queued = 0
+
+    def submit(self, admin_id, chat_id, cmd, screen=False):
+        """
+        Start the command now or queue it. Returns 0 when it started,
+        its queue position when queued, or None when the queue is full.
+        """
+        with self.lock:
+            if self._has_slot(admin_id) and not self.queues.get(admin_id):
+                self._claim(admin_id)
+                position = 0
+            elif self.queued >= self.max_queued:
+                return None
+            else:
+                self.queues.setdefault(admin_id, deque()).append((chat_id, cmd, screen))
+                self.queued += 1
+                position = self.queued
+        if position == 0:
+            self._start(admin_id, chat_id, cmd, screen)
+        return position
+
+    def release(self, admin_id):
+        """A command of admin_id finished; start whatever may run now."""
+        with self.lock:
+            self.total -= 1
+            self.running[admin_id] -= 1
+            if not self.running[admin_id]:
+                del self.running[admin_id]
+            ready = []
+            progress = True
+            while progress and self.total < self.max_running:
+                progress = False
+                for queued_admin in list(self.queues):
+                    queue_ = self.queues[queued_admin]
+                    if self._has_slot(queued_admin):
+                        ready.append((queued_admin,) + queue_.popleft())
+                        self._claim(queued_admin)
+                        self.queued -= 1
+                        progress = True
+                        # Served admins go to the back of the line
+                        del self.queues[queued_admin]
+                        if queue_:
+                            self.queues[queued_admin] = queue_
+                        break
+        for queued_admin, chat_id, cmd, screen in ready:
+            send_text(chat_id, "▶️ Starting queued command")
+            self._start(queued_admin, chat_id, cmd, screen)
+
+    def cancel(self, chat_id=None):
+        """Drop queued commands of a chat (all chats for None); returns how many."""
+        dropped = 0
+        with self.lock:
+            for admin_id, queue_ in list(self.queues.items()):
+                kept = deque(item for item in queue_ if chat_id is not None and item[0] != chat_id)
+                dropped += len(queue_) - len(kept)
+                if kept:
+                    self.queues[admin_id] = kept
+                else:
+                    del self.queues[admin_id]
+            self.queued -= dropped
+        return dropped
+
+    def stats(self):
+        with self.lock:
+            return {"running": self.total, "queued": self.queued}
+
+    def _has_slot(self, admin_id):
+        return self.total < self.max_running and self.running.get(admin_id, 0) < self.max_per_admin
+
+    def _claim(self, admin_id):
+        self.total += 1
+        self.running[admin_id] = self.running.get(admin_id, 0) + 1
+
+    def _start(self, admin_id, chat_id, cmd, screen):
+        if not screen:
+            send_text(chat_id, md_code_block(f"$ {cmd}"), parse_mode="MarkdownV2")
+        try:
+            run_cmd(cmd, admin_id, chat_id, screen=screen)
+        except OSError as e:
+            send_text(chat_id, f"❌ Cannot start command: {e}")
+            self.release(admin_id)
+
+scheduler = CommandScheduler()
+
+# ================= PERSISTENT SHELL SESSIONS =================
+class ShellSession:
+    """
+    One long-lived interactive bash per chat, opted into with /session on.
+    Commands are written to its PTY instead of forking a new bash each time,
+    so cd, exports and activated virtualenvs carry over between messages.
+    A PROMPT_COMMAND hook prints an invisible OSC marker carrying $? after
+    every command; that marker ends the command's output message.
+    """
+
+    MARKER_PREFIX = b"\x1b]777;done;"
+
+    def __init__(self, chat_id, admin_id):
+        self.chat_id = chat_id
+        self.admin_id = admin_id
+        nonce = uuid.uuid4().hex[:12]
+        self.marker = re.compile(re.escape(self.MARKER_PREFIX) + rb"(\d+);" + nonce.encode() + rb"\x07")
+        self.ready = False
+        self.current = None  # (cmd, started, stream, view, watch) of the running command
+        self.pending = deque()
+        self.carry = b""
+        self.outbox = bytearray()  # command bytes the PTY has not taken yet
+        self.started = self.last_used = time.time()
+
+        pid, fd = pty.fork()
+        if pid == 0:
+            try:
+                os.chdir(BASE_DIR)
+                apply_child_limits()
+                os.environ.update(PS1="", PS2="", PROMPT_COMMAND=f'printf "\\033]777;done;%s;{nonce}\\007" $?')
+                # No echo: the chat already shows what was typed
+                attrs = termios.tcgetattr(0)
+                attrs[3] &= ~termios.ECHO
+                termios.tcsetattr(0, termios.TCSANOW, attrs)
+                os.execvp("bash", ["bash", "--noprofile", "--norc", "--noediting", "-i"])
+            finally:
+                os._exit(127)
+
+        self.pid = pid
+        self.fd = fd
+        os.set_blocking(fd, False)
+        reactor.add_reader(fd, self._on_readable)
+        reaper.watch(pid, self._on_exit)
+        if SHELL_SESSION_TTL:
+            expirer.schedule("shell", self, self.started + SHELL_SESSION_TTL)
+
+    def run(self, cmd):
+        """Queue cmd behind whatever the session is running; safe from any thread."""
+        reactor.call_soon(self._enqueue, cmd)
+
+    def interrupt(self):
+        """Ctrl-C the foreground job, leaving the shell itself alive."""
+        try:
+            pgrp = os.tcgetpgrp(self.fd)
+        except OSError:
+            return False
+        if pgrp == self.pid:
+            return False
+        try:
+            os.killpg(pgrp, signal.SIGINT)
+        except ProcessLookupError:
+            return False
+        return True
+
+    def close(self):
+        """Hang up the shell (bash passes SIGHUP on to its jobs)."""
+        try:
+            os.killpg(self.pid, signal.SIGHUP)
+        except ProcessLookupError:
+            return
+        reaper.terminate(self.pid)
+
+    def busy(self):
+        return self.current is not None
 
-# ===================== ADMIN-WISE DATA =====================
-edit_sessions = {}
-processes = {}  # Structure: {admin_id: {chat_id: (pid, fd, start_time, cmd)}}
-input_wait = {}  # Structure: {admin_id: {chat_id: fd}}
-active_sessions = {}  # Structure: {admin_id: {chat_id: timestamp}}
-admins = set()
+    def _enqueue(self, cmd):
+        self.pending.append(cmd)
+        self._next()
+
+    def _next(self):
+        if not self.ready or self.current or not self.pending or self.fd is None:
+            return
+        cmd = self.pending.popleft()
+        stream = PtyTextStream()
+        view = OutputAggregator(self.chat_id)
+        # The shell runs with echo off, so that says nothing about passwords here
+        target = InputTarget(self.fd, self.chat_id, self.admin_id, secret_prompts=False)
+        registry.attach(target)
+        self.current = (cmd, time.time(), stream, view, PromptWatch(target, view, stream))
+        registry.touch(self.admin_id, self.chat_id)
+        line = cmd.strip("\n")
+        if "\n" in line:
+            # One compound command, so PROMPT_COMMAND prints one marker for all
+            # of its lines (and later lines are not read as input by earlier ones)
+            line = "{\n" + line + "\n}"
+        self.outbox += line.encode() + b"\n"
+        self._drain()
+
+    def _drain(self):
+        """Write what the PTY takes now; the rest goes out when it is writable again."""
+        if self.fd is None:
+            return
+        try:
+            while self.outbox:
+                del self.outbox[:os.write(self.fd, self.outbox)]
+        except BlockingIOError:
+            reactor.add_writer(self.fd, self._drain)
+            return
+        except OSError as e:
+            self.outbox.clear()
+            reactor.remove_writer(self.fd)
+            if self.current:
+                self._finish(f"⚠️ Cannot send the command: {e}")
+            self._next()
+            return
+        reactor.remove_writer(self.fd)
+
+    def _on_readable(self):
+        """Read one chunk; returns False once nothing more can be read."""
+        try:
+            raw = os.read(self.fd, PTY_READ_SIZE)
+        except BlockingIOError:
+            return False
+        except OSError:
+            raw = b""
+        if not raw:
+            self._close_pty()
+            return False
+
+        data = self.carry + raw
+        self.carry = b""
+        pos = 0
+        for match in self.marker.finditer(data):
+            self._output(data[pos:match.start()])
+            self._done(int(match.group(1)))
+            pos = match.end()
+        rest = data[pos:]
 
-# ===================== HELPER =====================
-def get_admin_dict(admin_id, dict_obj):
+        # Hold back what may be the start of a marker split across reads
+        esc = rest.rfind(b"\x1b")
+        if esc != -1 and b"\x07" not in rest[esc:]:
+            tail = rest[esc:]
+            if self.MARKER_PREFIX.startswith(tail[:len(self.MARKER_PREFIX)]):
+                self.carry = tail
+                rest = rest[:esc]
+        self._output(rest)
+        return True
+
+    def _output(self, data):
+        if not data or not self.current:
+            return  # Nothing is waiting for it (shell startup noise)
+        _, _, stream, view, watch = self.current
+        view.feed(stream.feed(data), stream.partial())
+        watch.poke()
+
+    def _done(self, code):
+        if not self.ready:
+            self.ready = True  # First prompt: the shell is up
+        elif self.current:
+            self._finish(f"{'✅' if code == 0 else '❌'} Exit {code}", code)
+        self._next()
+
+    def _finish(self, status, code=None):
+        cmd, started, stream, view, watch = self.current
+        self.current = None
+        self.last_used = time.time()
+        duration = self.last_used - started
+        watch.cancel()
+        registry.release_input(watch.target)
+        view.feed(stream.finish())
+        view.close(f"{status} • {duration:.1f}s")
+        store.record_command(self.chat_id, self.admin_id, cmd, started, duration, code)
+
+    def _close_pty(self):
+        if self.fd is not None:
+            reactor.remove_reader(self.fd)
+            reactor.remove_writer(self.fd)
+            self.outbox.clear()
+            os.close(self.fd)
+            self.fd = None
+
+    def _on_exit(self, info):
+        for _ in range(16):
+            if self.fd is None or not self._on_readable():
+                break
+        if self.current:
+            self._finish("🔌 Session ended")
+        self._close_pty()
+        registry.drop_shell(self)
+        send_text(self.chat_id, f"🐚 Shell session closed ({info.describe()})")
+
+# ================= EXPIRY =================
+class Expirer:
     """
-    Returns the dictionary for a specific admin.
-    If it doesn't exist, initialize it.
+    Deadlines for editor links, chat activity, idle programs and idle shell
+    sessions, kept in one heap and swept on the reactor thread. A sweep only
+    pops what is due, so it costs O(expired) however many sessions are
+    live. Touching an entry does not move its deadline; when it comes due
+    the handler looks at the entry again and hands back a later deadline
+    if it was used in the meantime.
     """
-    if admin_id not in dict_obj:
-        dict_obj[admin_id] = {}
-    return dict_obj[admin_id]
 
-# ===================== LOAD / SAVE DATA =====================
-def load_data():
-    global admins
-    try:
-        if os.path.exists(DATA_FILE):
-            with open(DATA_FILE, 'r') as f:
-                data = json.load(f)
-                admins = set(data.get('admins', []))
-        admins.add(MAIN_ADMIN_ID)  # Ensure main admin is always included
-    except Exception as e:
-        print(f"⚠️ Load data failed: {e}")
-        admins = {MAIN_ADMIN_ID}
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.heap = []  # (deadline, seq, kind, key), wall-clock deadlines
+        self.seq = itertools.count()
+        self.handlers = {}  # kind -> fn(key, now): new deadline, True when expired, None when gone
+        self.armed = None
+        self.timer = None
+        self.sweeps = 0
+        self.last_sweep_ms = 0.0
+        self.expired = {}
 
-def save_data():
-    try:
-        data = {'admins': list(admins)}
-        with open(DATA_FILE, 'w') as f:
-            json.dump(data, f)
-    except Exception as e:
-        print(f"⚠️ Save data failed: {e}")
+    def register(self, kind, handler):
+        self.handlers[kind] = handler
+        self.expired[kind] = 0
 
-# ===================== INITIAL LOAD =====================
-load_data()
+    def schedule(self, kind, key, deadline):
+        """Safe from any thread."""
+        with self.lock:
+            heapq.heappush(self.heap, (deadline, next(self.seq), kind, key))
+            if self.armed is not None and self.armed <= deadline:
+                return
+            self.armed = deadline
+        reactor.call_soon(self._arm)
 
-# ================= ENHANCED PTY RUNNER =================
-def run_cmd(cmd, admin_id, chat_id):
-    def task():
-        # Ensure admin dict exists
-        proc_dict = get_admin_dict(admin_id, processes)
-        sess_dict = get_admin_dict(admin_id, active_sessions)
-        input_dict = get_admin_dict(admin_id, input_wait)
-        
-        pid, fd = pty.fork()
-        if pid == 0:
-            # Child process
-            os.chdir(BASE_DIR)
-            os.execvp("bash", ["bash", "-c", cmd])
-        else:
-            # Parent process
-            start_time = datetime.now().strftime("%H:%M:%S")
-            proc_dict[chat_id] = (pid, fd, start_time, cmd)
-            sess_dict[chat_id] = time.time()
+    def _arm(self):
+        with self.lock:
+            deadline = self.heap[0][0] if self.heap else None
+            self.armed = deadline
+        if self.timer is not None:
+            reactor.cancel(self.timer)
+            self.timer = None
+        if deadline is not None:
+            self.timer = reactor.call_later(max(0, deadline - time.time()), self._sweep)
 
+    def _sweep(self):
+        self.timer = None
+        started = time.perf_counter()
+        now = time.time()
+        due = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                due.append(heapq.heappop(self.heap))
+        for _, _, kind, key in due:
             try:
-                while True:
-                    rlist, _, _ = select.select([fd], [], [], 0.1)
-                    if fd in rlist:
-                        try:
-                            out = os.read(fd, 1024).decode(errors="ignore")
-                        except OSError:
-                            break
+                result = self.handlers[kind](key, now)
+            except Exception as e:
+                print(f"⚠️ Expiry of {kind} failed: {e}")
+                continue
+            if result is True:
+                self.expired[kind] += 1
+            elif result:
+                with self.lock:
+                    heapq.heappush(self.heap, (result, next(self.seq), kind, key))
+        self.sweeps += 1
+        self.last_sweep_ms = (time.perf_counter() - started) * 1000
+        self._arm()
 
-                        if out:
-                            display_out = out if len(out) < 2000 else out[:2000] + "\n... [OUTPUT TRUNCATED]"
-                            bot.send_message(chat_id, f"```\n{display_out}\n```", parse_mode="Markdown")
+    def stats(self):
+        with self.lock:
+            pending = len(self.heap)
+        return {"pending": pending, "sweeps": self.sweeps, "last_sweep_ms": self.last_sweep_ms,
+                "expired": dict(self.expired)}
 
-                        # Check if process is waiting for input
-                        if out.strip().endswith(":"):
-                            input_dict[chat_id] = fd
+def expire_edit(sid, now):
+    session = registry.get_edit(sid)
+    if session is None:
+        return None  # saved already
+    deadline = session.created + EDIT_SESSION_TTL
+    if deadline > now:
+        return deadline
+    registry.pop_edit(sid)
+    return True
 
-                    # Check if process is still alive
-                    try:
-                        os.kill(pid, 0)
-                    except OSError:
-                        break
+def expire_activity(key, now):
+    admin_id, chat_id = key
+    last_active = registry.last_active(admin_id, chat_id)
+    if last_active is None:
+        return None
+    if last_active + ACTIVITY_TTL > now:
+        return last_active + ACTIVITY_TTL
+    return registry.drop_activity(admin_id, chat_id, last_active) or last_active + ACTIVITY_TTL
 
-                    time.sleep(0.1)
-            finally:
-                # Cleanup after process ends
-                if chat_id in proc_dict:
-                    del proc_dict[chat_id]
-                if chat_id in input_dict:
-                    del input_dict[chat_id]
-                if chat_id in sess_dict:
-                    del sess_dict[chat_id]
+def expire_process(pid, now):
+    record = registry.get_pid(pid)
+    if record is None or registry.get_chat(record.chat_id) is not record:
+        return None  # exited or already being stopped
+    if record.last_io + IDLE_PROCESS_TTL > now:
+        return record.last_io + IDLE_PROCESS_TTL
+    idle = max(1, int((now - record.last_io) / 60))
+    short_cmd = record.cmd[:40].replace("`", "'")
+    if IDLE_PROCESS_ACTION == "kill" and registry.detach(record.chat_id) is record:
+        reaper.terminate(pid)
+        send_text(record.chat_id, f"💤 Stopped `{short_cmd}`: no input or output for {idle} min.",
+                  parse_mode="Markdown")
+    else:
+        send_text(record.chat_id, f"💤 `{short_cmd}` has had no input or output for {idle} min. /stop ends it.",
+                  parse_mode="Markdown")
+    return True
 
-    threading.Thread(target=task, daemon=True).start()
+def expire_shell(session, now):
+    if registry.get_shell(session.chat_id) is not session:
+        return None
+    if session.busy() or session.last_used + SHELL_SESSION_TTL > now:
+        return max(session.last_used, now) + SHELL_SESSION_TTL
+    send_text(session.chat_id, f"💤 Closing the shell session after {max(1, int(SHELL_SESSION_TTL / 60))} idle min.")
+    session.close()
+    return True
+
+expirer = Expirer()
+expirer.register("edit", expire_edit)
+expirer.register("activity", expire_activity)
+expirer.register("process", expire_process)
+expirer.register("shell", expire_shell)
+registry.attach_expirer(expirer)
 
 # ================= ADMIN MANAGEMENT =================
 def is_admin(chat_id):
@@ -156,16 +2989,1302 @@ def main_menu_keyboard():
     )
     return markup
 
+# ================= FILE ACCESS =================
+def resolve_path(path):
+    """Absolute, symlink-free path of path (relative to BASE_DIR), or None when it leaves BASE_DIR."""
+    base = os.path.realpath(BASE_DIR)
+    real = os.path.realpath(os.path.join(base, path))
+    try:
+        if os.path.commonpath([base, real]) != base:
+            return None
+    except ValueError:
+        return None
+    return real
+
+def file_etag(st):
+    """ETag of a file version: any write or replace changes inode, size or mtime."""
+    return f'"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+def write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+def copy_range(src_fd, dst_fd, offset, length):
+    """Appends length bytes from offset of src_fd to dst_fd, kernel-side where the OS allows."""
+    while length > 0:
+        try:
+            n = os.copy_file_range(src_fd, dst_fd, length, offset)
+        except (AttributeError, OSError):
+            chunk = os.pread(src_fd, min(length, 1024 * 1024), offset)
+            write_all(dst_fd, chunk)
+            n = len(chunk)
+        if n <= 0:
+            break
+        offset += n
+        length -= n
+
+def write_patched(path, patches):
+    """
+    Rewrites path with patches applied: (offset, length, data bytes), sorted and
+    non-overlapping, offsets into the current file. Unchanged ranges are copied,
+    the result replaces the file atomically and keeps its mode. Returns the new stat.
+    """
+    st = os.stat(path)
+    dst, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f".{os.path.basename(path)}.")
+    try:
+        src = os.open(path, os.O_RDONLY)
+        try:
+            pos = 0
+            for offset, length, data in patches:
+                copy_range(src, dst, pos, offset - pos)
+                write_all(dst, data)
+                pos = offset + length
+            copy_range(src, dst, pos, st.st_size - pos)
+        finally:
+            os.close(src)
+        os.fchmod(dst, st.st_mode & 0o7777)
+        os.fsync(dst)
+        os.close(dst)
+        dst = None
+        os.replace(tmp, path)
+    except BaseException:
+        if dst is not None:
+            os.close(dst)
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    return os.stat(path)
+
+# ================= FILE BROWSER =================
+class DirCache:
+    """
+    Sorted listings (folders first) of recently browsed directories. A listing
+    is scanned again when the directory's mtime changes (entries added, removed
+    or renamed) or after ttl seconds, since file sizes change without it.
+    """
+
+    def __init__(self, size=BROWSE_CACHE_SIZE, ttl=BROWSE_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.listings = {}  # path -> (dir mtime_ns, scanned at, entries), least recently used first
+        self.hits = 0
+        self.misses = 0
+
+    def listing(self, path):
+        """[(name, is_dir, size, mtime)] of path; raises OSError like os.scandir."""
+        mtime = os.stat(path).st_mtime_ns
+        now = time.monotonic()
+        with self.lock:
+            cached = self.listings.pop(path, None)
+            if cached is not None and cached[0] == mtime and now - cached[1] < self.ttl:
+                self.listings[path] = cached
+                self.hits += 1
+                return cached[2]
+            self.misses += 1
+        entries = self._scan(path)
+        with self.lock:
+            self.listings[path] = (mtime, now, entries)
+            while len(self.listings) > self.size:
+                del self.listings[next(iter(self.listings))]
+        return entries
+
+    def drop(self, path):
+        with self.lock:
+            self.listings.pop(path, None)
+
+    @staticmethod
+    def _scan(path):
+        folders, files = [], []
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    st = entry.stat()  # follows symlinks, like ls -L
+                except OSError:
+                    continue  # dangling symlink
+                if entry.is_dir():
+                    folders.append((entry.name, True, 0, st.st_mtime))
+                else:
+                    files.append((entry.name, False, st.st_size, st.st_mtime))
+        folders.sort(key=lambda e: e[0].lower())
+        files.sort(key=lambda e: e[0].lower())
+        return folders + files
+
+    def stats(self):
+        with self.lock:
+            return {"cached": len(self.listings), "hits": self.hits, "misses": self.misses}
+
+class PathTokens:
+    """
+    Short tokens standing in for paths in callback_data (64 bytes at most).
+    A token is a hash of the path, so the same path always gets the same one.
+    """
+
+    def __init__(self, limit=BROWSE_TOKEN_LIMIT):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.paths = {}  # token -> path, oldest first
+
+    def token(self, path):
+        digest = hashlib.blake2b(path.encode("utf-8", "surrogateescape"), digest_size=6).digest()
+        token = base64.urlsafe_b64encode(digest).decode()
+        with self.lock:
+            self.paths.pop(token, None)
+            self.paths[token] = path
+            while len(self.paths) > self.limit:
+                del self.paths[next(iter(self.paths))]
+        return token
+
+    def path(self, token):
+        with self.lock:
+            return self.paths.get(token)
+
+dir_cache = DirCache()
+path_tokens = PathTokens()
+
+def human_size(n):
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024 or unit == "GB":
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+
+def display_path(path):
+    rel = os.path.relpath(path, os.path.realpath(BASE_DIR))
+    return "~" if rel == "." else f"~/{rel}"
+
+def browse_page(path, page=0):
+    """(MarkdownV2 text, keyboard) for one page of a directory listing."""
+    entries = dir_cache.listing(path)
+    pages = max(1, -(-len(entries) // BROWSE_PAGE_SIZE))
+    page = min(max(0, page), pages - 1)
+    shown = entries[page * BROWSE_PAGE_SIZE:(page + 1) * BROWSE_PAGE_SIZE]
+    folders = sum(1 for entry in entries if entry[1])
+
+    lines = [f"📁 *{md_escape(display_path(path))}*",
+             md_escape(f"{folders} folders, {len(entries) - folders} files · page {page + 1}/{pages}"), ""]
+    markup = types.InlineKeyboardMarkup()
+    for name, is_dir, size, mtime in shown:
+        stamp = datetime.fromtimestamp(mtime).strftime("%Y-%m-%d %H:%M")
+        token = path_tokens.token(os.path.join(path, name))
+        if is_dir:
+            lines.append(md_escape(f"📁 {name}/  {stamp}"))
+            markup.add(types.InlineKeyboardButton(f"📁 {name}/", callback_data=f"fb:{token}:0"))
+        else:
+            lines.append(md_escape(f"📄 {name}  {human_size(size)}  {stamp}"))
+            markup.add(types.InlineKeyboardButton(f"📄 {name}", callback_data=f"fv:{token}:0"))
+    if not entries:
+        lines.append(md_escape("(empty)"))
+
+    here = path_tokens.token(path)
+    nav = []
+    if path != os.path.realpath(BASE_DIR):
+        nav.append(types.InlineKeyboardButton("⬆️ Up", callback_data=f"fb:{path_tokens.token(os.path.dirname(path))}:0"))
+    if page > 0:
+        nav.append(types.InlineKeyboardButton("◀️", callback_data=f"fb:{here}:{page - 1}"))
+    nav.append(types.InlineKeyboardButton("🔄", callback_data=f"fb:{here}:{page}:r"))
+    if page < pages - 1:
+        nav.append(types.InlineKeyboardButton("▶️", callback_data=f"fb:{here}:{page + 1}"))
+    markup.row(*nav)
+    return "\n".join(lines), markup
+
+_CONTROL_CHARS = re.compile(r"[\x00-\x08\x0b-\x1f\x7f]")
+
+def view_page(path, offset=0):
+    """
+    (MarkdownV2 text, keyboard) for VIEW_PAGE_BYTES of a file from offset.
+    Only that page is read; offsets are moved to whole UTF-8 characters.
+    """
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        offset = min(max(0, offset), max(0, size - 1))
+        f.seek(offset)
+        data = f.read(VIEW_PAGE_BYTES + 3)
+
+    # Start on a character boundary, end before a character split by the page end
+    skip = 0
+    while skip < min(3, len(data)) and 0x80 <= data[skip] < 0xC0:
+        skip += 1
+    start = offset + skip
+    data = data[skip:skip + VIEW_PAGE_BYTES]
+    decoder = codecs.getincrementaldecoder("utf-8")("replace")
+    text = decoder.decode(data, final=start + len(data) >= size)
+    end = start + len(data) - len(decoder.getstate()[0])
+
+    # Escaping can double the text; keep the message under the Telegram limit
+    text = _CONTROL_CHARS.sub("·", text)
+    while len(md_code_block(text)) > MESSAGE_LIMIT - 300:
+        text = text[:len(text) * 3 // 4]
+        end = start + len(text.encode("utf-8", "replace"))
+
+    header = md_escape(f"📄 {display_path(path)}\n{human_size(size)} · bytes {start}–{end} of {size}")
+    token = path_tokens.token(path)
+    nav = []
+    if start > 0:
+        nav.append(types.InlineKeyboardButton("⏮", callback_data=f"fv:{token}:0"))
+        nav.append(types.InlineKeyboardButton("◀️", callback_data=f"fv:{token}:{max(0, start - VIEW_PAGE_BYTES)}"))
+    if end < size:
+        nav.append(types.InlineKeyboardButton("▶️", callback_data=f"fv:{token}:{end}"))
+        nav.append(types.InlineKeyboardButton("⏭", callback_data=f"fv:{token}:{max(0, size - VIEW_PAGE_BYTES)}"))
+    markup = types.InlineKeyboardMarkup()
+    if nav:
+        markup.row(*nav)
+    markup.row(types.InlineKeyboardButton("⬆️ Folder", callback_data=f"fb:{path_tokens.token(os.path.dirname(path))}:0"))
+    return f"{header}\n{md_code_block(text or ' ')}", markup
+
+def show_browser_page(cid, data, message_id=None):
+    """
+    Renders a browser callback ("fb:<token>:<page>" or "fv:<token>:<offset>",
+    then optional flags: r = rescan, n = new message) into message_id, or into
+    a new message. Returns an error text or None.
+    """
+    kind, token, number, *flags = data.split(":")
+    path = path_tokens.path(token)
+    if path is None or resolve_path(path) != path:
+        return "❌ This button has expired, open /files again"
+    if "r" in flags:
+        dir_cache.drop(path)
+    if "n" in flags:
+        message_id = None
+    try:
+        if kind == "fb":
+            text, markup = browse_page(path, int(number))
+        else:
+            text, markup = view_page(path, int(number))
+    except (OSError, ValueError) as e:
+        return f"❌ Cannot open: {e}"
+    if message_id is None:
+        send_text(cid, text, parse_mode="MarkdownV2", reply_markup=markup)
+    else:
+        dispatcher.submit("edit_message_text", cid, priority=PRIORITY_INTERACTIVE, key=("browse", cid, message_id),
+                          text=text, message_id=message_id, parse_mode="MarkdownV2", reply_markup=markup)
+    return None
+
+# ================= FILE TRANSFERS =================
+# /get sends a file, or a directory as tar.gz, as documents of at most
+# TRANSFER_PART_SIZE; documents sent to the bot are saved under BASE_DIR.
+# Both directions stream in TRANSFER_CHUNK pieces, so memory stays flat.
+transfer_slots = threading.BoundedSemaphore(TRANSFER_WORKERS)
+transfer_stats = {"running": 0, "sent_bytes": 0, "received_bytes": 0, "failed": 0}
+transfer_lock = threading.Lock()
+
+class FileWindow:
+    """length bytes of a file from offset, as a file object to upload as one part."""
+
+    def __init__(self, path, offset, length):
+        self.file = open(path, "rb")
+        self.offset = offset
+        self.length = length
+        self.pos = 0
+
+    def __len__(self):
+        return self.length
+
+    def seekable(self):
+        return True
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        self.pos = pos if whence == os.SEEK_SET else self.length + pos
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        left = self.length - self.pos
+        size = left if size is None or size < 0 else min(size, left)
+        data = os.pread(self.file.fileno(), size, self.offset + self.pos)
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+class PartWriter:
+    """
+    Write-only file object that cuts its stream into part files of part_size
+    bytes in a temp directory. A full part is handed to on_part(path, index,
+    last) once the next byte arrives (or on close), so the last one is known.
+    """
+
+    def __init__(self, part_size, on_part):
+        self.part_size = part_size
+        self.on_part = on_part
+        self.dir = tempfile.mkdtemp(prefix="transfer-")
+        self.file = None
+        self.size = 0
+        self.index = 0
+        self.ready = None  # (path, index) of a full part waiting to be sent
+        self.total = 0
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            if self.file is None:
+                self._open()
+            n = min(len(view), self.part_size - self.size)
+            self.file.write(view[:n])
+            self.size += n
+            view = view[n:]
+            if self.size >= self.part_size:
+                self._close_part()
+        self.total += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _open(self):
+        if self.ready is not None:
+            self._send(last=False)
+        self.index += 1
+        self.file = open(os.path.join(self.dir, f"part{self.index}"), "wb")
+        self.size = 0
+
+    def _close_part(self):
+        self.file.close()
+        self.ready = (self.file.name, self.index)
+        self.file = None
+
+    def _send(self, last):
+        path, index = self.ready
+        self.ready = None
+        try:
+            self.on_part(path, index, last)
+        finally:
+            os.unlink(path)
+
+    def close(self):
+        if self.file is not None:
+            self._close_part()
+        if self.ready is not None:
+            self._send(last=True)
+        os.rmdir(self.dir)
+
+    def abort(self):
+        if self.file is not None:
+            self.file.close()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+def count_transfer(key, n):
+    with transfer_lock:
+        transfer_stats[key] += n
+
+def run_transfer(cid, func, *args):
+    """Runs a transfer on its own thread, at most TRANSFER_WORKERS at a time."""
+    def work():
+        with transfer_slots:
+            count_transfer("running", 1)
+            try:
+                func(cid, *args)
+            except Exception as e:
+                count_transfer("failed", 1)
+                send_text(cid, f"❌ Transfer failed: {e}")
+            finally:
+                count_transfer("running", -1)
+    threading.Thread(target=work, name="transfer", daemon=True).start()
+
+def send_document_part(cid, fileobj, name, caption):
+    dispatcher.submit("send_document", cid, priority=PRIORITY_BULK, wait=True, transfer=True,
+                      document=fileobj, visible_file_name=name, caption=caption)
+    count_transfer("sent_bytes", len(fileobj) if hasattr(fileobj, "__len__") else os.fstat(fileobj.fileno()).st_size)
+
+def send_file(cid, path):
+    """Sends a file as one document, or as name.part001, name.part002, ... past TRANSFER_PART_SIZE."""
+    name = os.path.basename(path)
+    size = os.path.getsize(path)
+    parts = max(1, -(-size // TRANSFER_PART_SIZE))
+    started = time.monotonic()
+    for index in range(parts):
+        offset = index * TRANSFER_PART_SIZE
+        window = FileWindow(path, offset, min(TRANSFER_PART_SIZE, size - offset))
+        try:
+            if parts == 1:
+                send_document_part(cid, window, name, f"📄 {name} ({human_size(size)})")
+            else:
+                send_document_part(cid, window, f"{name}.part{index + 1:03d}", f"📦 {name} — part {index + 1}/{parts}")
+        finally:
+            window.close()
+    if parts > 1:
+        elapsed = max(time.monotonic() - started, 1e-6)
+        send_text(cid, f"✅ Sent {name} ({human_size(size)}) in {parts} parts at {human_size(size / elapsed)}/s\n"
+                       f"Join them with: cat {name}.part* > {name}")
+
+def send_directory(cid, path):
+    """Streams path as a tar.gz through PartWriter; only the current part touches the disk."""
+    name = f"{os.path.basename(path.rstrip(os.sep)) or 'base'}.tar.gz"
+    started = time.monotonic()
+    skipped = []
+
+    def on_part(part_path, index, last):
+        with open(part_path, "rb") as f:
+            if last and index == 1:
+                send_document_part(cid, f, name, f"🗜️ {name}")
+            else:
+                send_document_part(cid, f, f"{name}.part{index:03d}",
+                                   f"📦 {name} — part {index}{' (last)' if last else ''}")
+
+    writer = PartWriter(TRANSFER_PART_SIZE, on_part)
+    try:
+        with gzip.GzipFile(filename="", mode="wb", fileobj=writer, compresslevel=TRANSFER_GZIP_LEVEL, mtime=0) as gz:
+            with tarfile.open(fileobj=gz, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+                base = os.path.dirname(path)
+                for root, dirs, files in os.walk(path):
+                    dirs.sort()
+                    for entry in [root] + [os.path.join(root, f) for f in sorted(files)]:
+                        try:
+                            tar.add(entry, arcname=os.path.relpath(entry, base), recursive=False)
+                        except OSError:
+                            skipped.append(os.path.relpath(entry, base))
+        writer.close()
+    except BaseException:
+        writer.abort()
+        raise
+    elapsed = max(time.monotonic() - started, 1e-6)
+    note = f"\n⚠️ Skipped {len(skipped)} unreadable: {', '.join(skipped[:5])}" if skipped else ""
+    join = f"\nJoin the parts with: cat {name}.part* > {name}" if writer.index > 1 else ""
+    send_text(cid, f"✅ Sent {name}: {human_size(writer.total)} compressed in {writer.index} part(s), "
+                   f"{human_size(writer.total / elapsed)}/s{join}{note}")
+
+class PendingUploads:
+    """Uploads waiting for the sender to confirm that they overwrite a file, by token."""
+
+    def __init__(self, limit=100):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.uploads = {}  # token -> (chat_id, document, path), oldest first
+
+    def add(self, cid, document, path):
+        token = uuid.uuid4().hex[:12]
+        with self.lock:
+            self.uploads[token] = (cid, document, path)
+            while len(self.uploads) > self.limit:
+                del self.uploads[next(iter(self.uploads))]
+        return token
+
+    def pop(self, cid, token):
+        """(document, path), or None when the token is unknown, expired or from another chat."""
+        with self.lock:
+            upload = self.uploads.get(token)
+            if upload is None or upload[0] != cid:
+                return None
+            del self.uploads[token]
+        return upload[1:]
+
+pending_uploads = PendingUploads()
+
+def place_upload(tmp, path, overwrite):
+    """Moves the finished temp file to path; without overwrite, never replaces an existing file."""
+    if overwrite:
+        os.replace(tmp, path)
+        return
+    try:
+        os.link(tmp, path)  # unlike rename, fails when path exists
+    except FileExistsError:
+        raise FileExistsError(f"{display_path(path)} already exists") from None
+    except OSError:
+        # No hard links here (Android shared storage): check, then rename
+        if os.path.lexists(path):
+            raise FileExistsError(f"{display_path(path)} already exists") from None
+        os.replace(tmp, path)
+    else:
+        os.unlink(tmp)
+
+def receive_document(cid, document, path, overwrite=False):
+    """
+    Downloads a document from the Bot API straight into path (temp file +
+    rename). An existing file is only replaced with overwrite=True.
+    """
+    info = bot.get_file(document.file_id)
+    started = time.monotonic()
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.")
+    try:
+        if os.path.isabs(info.file_path) and os.path.isfile(info.file_path):
+            # A self-hosted Bot API server in --local mode hands out its own paths
+            src = os.open(info.file_path, os.O_RDONLY)
+            try:
+                size = os.fstat(src).st_size
+                copy_range(src, fd, 0, size)
+            finally:
+                os.close(src)
+        else:
+            url = (apihelper.FILE_URL or "https://api.telegram.org/file/bot{0}/{1}").format(BOT_TOKEN, info.file_path)
+            size = 0
+            with api_transport.session.get(url, stream=True, timeout=(API_CONNECT_TIMEOUT, max(API_READ_TIMEOUT, 60))) as response:
+                response.raise_for_status()
+                for chunk in response.iter_content(TRANSFER_CHUNK):
+                    write_all(fd, chunk)
+                    size += len(chunk)
+        os.fsync(fd)
+        os.close(fd)
+        fd = None
+        place_upload(tmp, path, overwrite)
+    except BaseException:
+        if fd is not None:
+            os.close(fd)
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    count_transfer("received_bytes", size)
+    elapsed = max(time.monotonic() - started, 1e-6)
+    send_text(cid, f"✅ Saved {display_path(path)} ({human_size(size)}, {human_size(size / elapsed)}/s)")
+
+# ================= SEARCH INDEX =================
+# /find and /grep answer from an SQLite FTS5 table with the trigram tokenizer,
+# so a substring of 3+ characters is an index lookup instead of a walk over
+# BASE_DIR. The index keeps no positions (detail=column: half the size, and a
+# query is an AND of the substring's trigrams), so it yields candidates that
+# are checked against the actual text. A background thread rescans the tree
+# every INDEX_REFRESH_INTERVAL seconds and only re-reads files whose size or
+# mtime changed; the index lives in INDEX_DB and survives restarts.
+try:
+    from re import _parser as sre_parse  # Python 3.11+
+except ImportError:
+    import sre_parse
+
+class SearchIndex:
+    """
+    The index database is only opened by open() (start() and refresh() call
+    it), so importing the module leaves the filesystem alone.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS files (
+            id INTEGER PRIMARY KEY,
+            path TEXT UNIQUE NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL
+        );
+        CREATE VIRTUAL TABLE IF NOT EXISTS docs USING fts5(path, body, tokenize='trigram', detail=column);
+    """
+    BATCH = 500  # files per write transaction
+
+    def __init__(self, path, root=BASE_DIR):
+        self.path = path
+        self.root = os.path.realpath(root)
+        self.skip_dirs = set(INDEX_SKIP_DIRS)
+        self.skip_files = {os.path.realpath(db) + suffix for db in (path, STATE_DB)
+                           for suffix in ("", "-wal", "-shm", "-journal")}
+        self.write_lock = threading.Lock()
+        self.read_lock = threading.Lock()
+        self.thread = None
+        self.scans = 0
+        self.last_scan = None  # (seconds, files changed)
+        self.building = True  # until the first scan is done
+        self.error = None
+        self.writer = self.reader = None
+
+    def open(self):
+        """Opens (and creates) the database once; False if search is unavailable."""
+        with self.write_lock:
+            if self.reader is None and self.error is None:
+                try:
+                    self.writer = self._connect(self.path)
+                    self.writer.executescript(self.SCHEMA)
+                    self.reader = self._connect(self.path)
+                    self.building = self.reader.execute("SELECT count(*) FROM files").fetchone()[0] == 0
+                except sqlite3.Error as e:
+                    # FTS5 and its trigram tokenizer need SQLite 3.34+
+                    self.error = str(e)
+                    print(f"⚠️ Search index disabled: {e}")
+        return self.error is None
+
+    @staticmethod
+    def _connect(path):
+        conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def start(self):
+        if self.open() and self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="search-index", daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"⚠️ Search index refresh failed: {e}")
+            time.sleep(INDEX_REFRESH_INTERVAL)
+
+    # ---------- updates ----------
+    def _walk(self):
+        """(relative path, size, mtime_ns) of every regular file under root, outside skipped folders."""
+        stack = [self.root]
+        while stack:
+            try:
+                it = os.scandir(stack.pop())
+            except OSError:
+                continue
+            with it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if entry.name not in self.skip_dirs:
+                                stack.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False) and entry.path not in self.skip_files:
+                            st = entry.stat(follow_symlinks=False)
+                            yield os.path.relpath(entry.path, self.root), st.st_size, st.st_mtime_ns
+                    except OSError:
+                        continue
+
+    def _read_text(self, rel):
+        """Content to index; "" for binary, unreadable and oversized files, which are found by name only."""
+        try:
+            with open(os.path.join(self.root, rel), "rb") as f:
+                data = f.read(INDEX_MAX_FILE_SIZE + 1)
+        except OSError:
+            return ""
+        if len(data) > INDEX_MAX_FILE_SIZE or b"\0" in data[:8192]:
+            return ""
+        return data.decode("utf-8", "replace")
+
+    def refresh(self):
+        """One mtime scan: new and changed files are (re)indexed, vanished ones dropped."""
+        if not self.open():
+            return
+        started = time.monotonic()
+        with self.read_lock:
+            known = {path: (id_, size, mtime) for id_, path, size, mtime
+                     in self.reader.execute("SELECT id, path, size, mtime_ns FROM files")}
+        changed, total = [], 0
+        for rel, size, mtime in self._walk():
+            old = known.pop(rel, None)
+            if old is None or old[1] != size or old[2] != mtime:
+                changed.append((old and old[0], rel, size, mtime))
+                if len(changed) >= self.BATCH:
+                    self._write(changed, [])
+                    total += len(changed)
+                    changed = []
+        self._write(changed, [old[0] for old in known.values()])
+        total += len(changed) + len(known)
+        self.scans += 1
+        self.last_scan = (time.monotonic() - started, total)
+        self.building = False
+
+    def _write(self, changed, removed):
+        if not changed and not removed:
+            return
+        bodies = [self._read_text(rel) for _, rel, _, _ in changed]  # read before taking the lock
+        with self.write_lock:
+            self.writer.execute("BEGIN")
+            try:
+                for id_ in removed:
+                    self.writer.execute("DELETE FROM files WHERE id = ?", (id_,))
+                    self.writer.execute("DELETE FROM docs WHERE rowid = ?", (id_,))
+                for (id_, rel, size, mtime), body in zip(changed, bodies):
+                    if id_ is None:
+                        id_ = self.writer.execute("INSERT INTO files (path, size, mtime_ns) VALUES (?, ?, ?)",
+                                                  (rel, size, mtime)).lastrowid
+                    else:
+                        self.writer.execute("UPDATE files SET size = ?, mtime_ns = ? WHERE id = ?", (size, mtime, id_))
+                        self.writer.execute("DELETE FROM docs WHERE rowid = ?", (id_,))
+                    self.writer.execute("INSERT INTO docs (rowid, path, body) VALUES (?, ?, ?)", (id_, rel, body))
+                self.writer.execute("COMMIT")
+            except BaseException:
+                self.writer.execute("ROLLBACK")
+                raise
+
+    # ---------- queries ----------
+    @staticmethod
+    def _match(column, literals):
+        """FTS5 query for rows whose column has every trigram of every literal."""
+        trigrams = {text[i:i + 3] for text in literals for i in range(len(text) - 2)}
+        return " AND ".join(f'{column} : "{gram.replace(chr(34), chr(34) * 2)}"' for gram in sorted(trigrams))
+
+    def find(self, text):
+        """Paths containing text (any case), best first: exact name, name prefix, name substring, shallow paths."""
+        needle = text.lower()
+        with self.read_lock:
+            if len(text) >= 3:
+                rows = self.reader.execute("SELECT path FROM docs WHERE docs MATCH ?",
+                                           (self._match("path", [text]),)).fetchall()
+            else:
+                rows = self.reader.execute("SELECT path FROM files WHERE instr(lower(path), ?)", (needle,)).fetchall()
+
+        def score(path):
+            name = os.path.basename(path).lower()
+            return name != needle, not name.startswith(needle), needle not in name, path.count("/"), len(path), path
+        return sorted((path for path, in rows if needle in path.lower()), key=score)
+
+    def grep(self, literals, after=0, limit=None):
+        """
+        Ids of the next limit files after id after (in id order) that contain
+        every literal (any case), most recently modified first. The scan walks
+        the index in id order and stops at limit, so a page never costs a pass
+        over every candidate.
+        """
+        # The trigrams only narrow the search down; SQLite's lower() folds ASCII
+        # only, so ASCII literals are also checked there, before Python sees a row
+        checks = [text.lower() for text in literals if text.isascii()]
+        sql = ("SELECT docs.rowid, files.mtime_ns FROM docs JOIN files ON files.id = docs.rowid "
+               "WHERE docs MATCH ? AND docs.rowid > ?" + " AND instr(lower(body), ?)" * len(checks)
+               + " ORDER BY docs.rowid LIMIT ?")
+        with self.read_lock:
+            rows = self.reader.execute(sql, (self._match("body", literals), after, *checks,
+                                             limit or SEARCH_RANK_WINDOW)).fetchall()
+        return [id_ for id_, _ in sorted(rows, key=lambda row: -row[1])], (rows[-1][0] if rows else None)
+
+    def document(self, rowid):
+        with self.read_lock:
+            return self.reader.execute("SELECT path, body FROM docs WHERE rowid = ?", (rowid,)).fetchone()
+
+    def stats(self):
+        files = 0
+        if self.reader is not None:
+            with self.read_lock:
+                files = self.reader.execute("SELECT count(*) FROM files").fetchone()[0]
+        return {"files": files, "scans": self.scans, "last_scan": self.last_scan,
+                "building": self.building, "error": self.error}
+
+search_index = SearchIndex(INDEX_DB)
+
+def required_literals(pattern):
+    """Literal runs of 3+ characters that every match of the regex contains, longest first."""
+    runs = []
+
+    def walk(items):
+        current = []
+        for op, av in items:
+            if op is sre_parse.LITERAL:
+                current.append(chr(av))
+                continue
+            runs.append("".join(current))
+            current = []
+            if op is sre_parse.SUBPATTERN:
+                walk(av[-1])
+            elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and av[0] >= 1:
+                walk(av[2])
+        runs.append("".join(current))
+
+    walk(sre_parse.parse(pattern))
+    return sorted({run for run in runs if len(run) >= 3}, key=len, reverse=True)
+
+class SearchResults:
+    """
+    Hits of one /find or /grep. Grep candidates come from the index
+    SEARCH_RANK_WINDOW at a time and are checked against the regex (and their
+    matching lines collected) only as far as the pages asked for so far need,
+    so total counts the candidates seen, not hits.
+    """
+
+    def __init__(self, kind, query, regex=False):
+        self.kind = kind
+        self.query = query
+        self.hits = []  # (path, first matching line, its byte offset, [(line number, line)], matches)
+        self.candidates = deque()
+        self.lock = threading.Lock()
+        if kind == "find":
+            self.hits = [(path, None, 0, [], 0) for path in search_index.find(query)]
+        else:
+            pattern = query if regex else re.escape(query)
+            literals = required_literals(pattern)
+            if not literals:
+                raise ValueError("the search needs 3+ characters in a row that every match contains")
+            flags = re.MULTILINE if any(c.isupper() for c in query) else re.MULTILINE | re.IGNORECASE  # smart case
+            self.regex = re.compile(pattern, flags)
+            self.literals = literals[:3]
+        self.total = len(self.hits)
+        self.after = 0  # id of the last grep candidate fetched; None once the index has no more
+
+    def _fetch(self):
+        ids, self.after = search_index.grep(self.literals, self.after)
+        self.candidates.extend(ids)
+        self.total += len(ids)
+
+    def page(self, number):
+        """(hits on page number, whether a later page may have hits)."""
+        end = (number + 1) * SEARCH_PAGE_SIZE
+        with self.lock:
+            while len(self.hits) <= end and (self.candidates or self.kind == "grep" and self.after is not None):
+                if self.candidates:
+                    self._check(self.candidates.popleft())
+                else:
+                    self._fetch()
+            more = len(self.hits) > end or bool(self.candidates) or self.kind == "grep" and self.after is not None
+            return self.hits[number * SEARCH_PAGE_SIZE:end], more
+
+    def _check(self, rowid):
+        row = search_index.document(rowid)
+        if row is None:
+            return
+        path, body = row
+        lines, count, first = [], 0, None
+        line_no, line_start = 1, 0
+        for match in self.regex.finditer(body):
+            if match.start() < line_start:
+                count += 1  # another match on a line already counted
+                continue
+            line_no += body.count("\n", line_start, match.start())
+            line_start = body.rfind("\n", 0, match.start()) + 1
+            line_end = body.find("\n", match.start())
+            if first is None:
+                first = (line_no, len(body[:line_start].encode("utf-8", "replace")))
+            if len(lines) < SEARCH_LINES_PER_FILE:
+                lines.append((line_no, body[line_start:line_end if line_end >= 0 else None].strip()[:100]))
+            count += 1
+            line_start = len(body) if line_end < 0 else line_end + 1
+            line_no += 1
+        if count:
+            self.hits.append((path, first[0], first[1], lines, count))
+
+class SearchCache:
+    """Recent SearchResults for the page buttons; the same search always gets the same token."""
+
+    def __init__(self, size=SEARCH_CACHE_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        self.results = {}  # token -> SearchResults, oldest first
+
+    def add(self, results):
+        key = f"{results.kind}:{results.query}".encode("utf-8", "surrogateescape")
+        token = base64.urlsafe_b64encode(hashlib.blake2b(key, digest_size=6).digest()).decode()
+        with self.lock:
+            self.results.pop(token, None)
+            self.results[token] = results
+            while len(self.results) > self.size:
+                del self.results[next(iter(self.results))]
+        return token
+
+    def get(self, token):
+        with self.lock:
+            return self.results.get(token)
+
+search_cache = SearchCache()
+
+def search_page(token, results, number):
+    """(MarkdownV2 text, keyboard) for one page of search results."""
+    hits, more = results.page(number)
+    if results.kind == "find":
+        found = f"{results.total} files"
+    else:
+        found = f"{results.total}{'' if results.after is None else '+'} files to check"
+    header = [md_escape(f"{'📄' if results.kind == 'find' else '🔍'} /{results.kind} ") + f"*{md_escape(results.query)}*",
+              md_escape(f"{found} · page {number + 1}" + (" · index still building" if search_index.building else ""))]
+    blocks = []
+    markup = types.InlineKeyboardMarkup()
+    for path, line_no, offset, lines, count in hits:
+        where = f"{path}:{line_no}" if line_no else path
+        block = [md_escape(f"• {where}" + (f" ({count} matches)" if count > 1 else ""))]
+        block += [md_escape(f"   {n}: {text}") for n, text in lines]
+        blocks.append(block)
+        file_token = path_tokens.token(os.path.join(search_index.root, path))
+        markup.add(types.InlineKeyboardButton(f"📄 {os.path.basename(where)}",
+                                              callback_data=f"fv:{file_token}:{offset}:n"))
+    if not hits:
+        blocks.append([md_escape("No matches")])
+
+    # Drop matching lines (never paths) from the end until the page fits
+    text = "\n\n".join(["\n".join(header)] + ["\n".join(block) for block in blocks])
+    while len(text) > MESSAGE_LIMIT - 100 and any(len(block) > 1 for block in blocks):
+        longest = max(blocks, key=len)
+        longest.pop()
+        text = "\n\n".join(["\n".join(header)] + ["\n".join(block) for block in blocks])
+
+    nav = []
+    if number > 0:
+        nav.append(types.InlineKeyboardButton("◀️", callback_data=f"sq:{token}:{number - 1}"))
+    if more:
+        nav.append(types.InlineKeyboardButton("▶️", callback_data=f"sq:{token}:{number + 1}"))
+    if nav:
+        markup.row(*nav)
+    return text, markup
+
+def show_search_page(cid, data, message_id=None):
+    """Renders "sq:<token>:<page>" into message_id, or into a new message. Returns an error text or None."""
+    _, token, number = data.split(":")
+    results = search_cache.get(token)
+    if results is None:
+        return "❌ These results have expired, search again"
+    text, markup = search_page(token, results, int(number))
+    if message_id is None:
+        send_text(cid, text, parse_mode="MarkdownV2", reply_markup=markup)
+    else:
+        dispatcher.submit("edit_message_text", cid, priority=PRIORITY_INTERACTIVE, key=("search", cid, message_id),
+                          text=text, message_id=message_id, parse_mode="MarkdownV2", reply_markup=markup)
+    return None
+
+# ================= LOG FOLLOWER =================
+# /tail follows files the way tail -F does, without a process or a thread per
+# file: one inotify fd on the reactor thread watches every followed file and
+# its folder (for rotation), and each follower edits one message at most every
+# few seconds. Events only schedule the next update; the new data is read then.
+IN_MODIFY = 0x002
+IN_ATTRIB = 0x004
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_MASK_ADD = 0x20000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+class Inotify:
+    """inotify(7) through ctypes. callback(mask, name) runs on the reactor thread."""
+
+    EVENT = struct.Struct("iIII")  # wd, mask, cookie, name length
+
+    def __init__(self):
+        libc = ctypes.CDLL(None, use_errno=True)
+        self._add_watch = libc.inotify_add_watch  # AttributeError where there is no inotify
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self._rm_watch = libc.inotify_rm_watch
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self.watches = {}  # wd -> set of callbacks
+        self.events = 0
+        reactor.add_reader(self.fd, self._read)
+
+    def watch(self, path, mask, callback):
+        # Masks of one inode add up (IN_MASK_ADD), so a callback may see events it did not ask for
+        wd = self._add_watch(self.fd, os.fsencode(path), mask | IN_MASK_ADD)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), path)
+        self.watches.setdefault(wd, set()).add(callback)
+        return wd
+
+    def unwatch(self, wd, callback):
+        callbacks = self.watches.get(wd)
+        if callbacks is None:
+            return
+        callbacks.discard(callback)
+        if not callbacks:
+            del self.watches[wd]
+            self._rm_watch(self.fd, wd)  # fails harmlessly when the file is gone
+
+    def _read(self):
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        # Let events queue up in the kernel for a while: a busy log then costs
+        # a few wakeups a second instead of one per write
+        reactor.remove_reader(self.fd)
+        reactor.call_later(TAIL_EVENT_BATCH, reactor.add_reader, self.fd, self._read)
+        offset, seen = 0, set()
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+            name = data[offset + self.EVENT.size:offset + self.EVENT.size + length].rstrip(b"\0")
+            offset += self.EVENT.size + length
+            self.events += 1
+            if (wd, mask, name) in seen:
+                continue
+            seen.add((wd, mask, name))
+            if mask & IN_Q_OVERFLOW:
+                targets = set().union(*self.watches.values())  # events were lost: everyone checks
+            else:
+                targets = self.watches.get(wd, ())
+            for callback in list(targets):
+                try:
+                    callback(mask, name or None)
+                except Exception as e:
+                    print(f"⚠️ inotify callback error: {e}")
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+
+class StatPoller:
+    """Stands in for Inotify where there is none: every watcher is called every TAIL_POLL_INTERVAL."""
+
+    def __init__(self):
+        self.watches = {}  # handle -> callback
+        self.handles = itertools.count()
+        self.timer = None
+        self.events = 0
+
+    def watch(self, path, mask, callback):
+        handle = next(self.handles)
+        self.watches[handle] = callback
+        if self.timer is None:
+            self.timer = reactor.call_later(TAIL_POLL_INTERVAL, self._tick)
+        return handle
+
+    def unwatch(self, handle, callback):
+        self.watches.pop(handle, None)
+
+    def _tick(self):
+        self.timer = None
+        for callback in list(self.watches.values()):
+            self.events += 1
+            callback(0, None)
+        if self.watches:
+            self.timer = reactor.call_later(TAIL_POLL_INTERVAL, self._tick)
+
+class LogFollower:
+    """
+    One /tail: the last TAIL_LINES lines (matching the filter, if any) of a
+    file in one message. Follows the name like tail -F: a truncated file is
+    read again from the start, and when the name points at a new file
+    (logrotate), the rest of the old one is read before switching. Runs on
+    the reactor thread.
+    """
+
+    def __init__(self, manager, follower_id, chat_id, path, regex=None):
+        self.manager = manager
+        self.id = follower_id
+        self.chat_id = chat_id
+        self.path = path
+        self.name = os.fsencode(os.path.basename(path))
+        self.regex = regex
+        self.lines = deque(maxlen=TAIL_LINES)
+        self.partial = b""
+        self.skip_line = False  # the next line is cut (read from the middle of the file)
+        self.file = None
+        self.inode = None
+        self.pos = 0
+        self.file_wd = None
+        self.dir_wd = None
+        self.timer = None
+        self.last_update = 0.0
+        self.read_lines = 0
+        self.matched = 0
+        self.skipped = 0
+        self.stopped = False
+        markup = types.InlineKeyboardMarkup()
+        markup.add(types.InlineKeyboardButton("⏹️ Stop", callback_data=f"ts:{follower_id}"))
+        self.live = LiveMessage(chat_id, reply_markup=markup)
+
+    def start(self):
+        watcher = self.manager.watcher
+        self.dir_wd = watcher.watch(os.path.dirname(self.path), IN_CREATE | IN_MOVED_TO, self._on_dir_event)
+        self._open(backlog=True)
+        self._render()
+
+    def _open(self, backlog=False):
+        try:
+            self.file = open(self.path, "rb")
+        except OSError:
+            self.file = None
+            return
+        st = os.fstat(self.file.fileno())
+        self.inode = (st.st_dev, st.st_ino)
+        self.pos = max(0, st.st_size - TAIL_BACKLOG_BYTES) if backlog else 0
+        self.skip_line = self.pos > 0
+        self.partial = b""
+        try:
+            self.file_wd = self.manager.watcher.watch(self.path, IN_MODIFY | IN_ATTRIB | IN_MOVE_SELF | IN_DELETE_SELF,
+                                                      self._on_file_event)
+        except OSError:
+            self.file_wd = None  # rotated away already; the folder watch sees the new file
+        self._drain()
+
+    def _close(self):
+        if self.file_wd is not None:
+            self.manager.watcher.unwatch(self.file_wd, self._on_file_event)
+            self.file_wd = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def _on_file_event(self, mask, name):
+        self._wake()
+
+    def _on_dir_event(self, mask, name):
+        if name is None or name == self.name:
+            self._wake()
+
+    def _wake(self):
+        if self.timer is None and not self.stopped:
+            at = self.manager.slot(self.chat_id, self.last_update + TAIL_UPDATE_INTERVAL)
+            self.timer = reactor.call_later(max(0, at - time.monotonic()), self._update)
+
+    def _update(self):
+        self.timer = None
+        self.check()
+        self._render()
+
+    def check(self):
+        """Reads what was added since the last check, following truncation and rotation."""
+        if self.file is not None:
+            self._drain()
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return  # moved away, not recreated yet: keep the old file until it is
+        if (st.st_dev, st.st_ino) != self.inode:
+            if self.file is not None:
+                self._close()
+                self._note("rotated")
+            self._open()
+
+    def _drain(self):
+        size = os.fstat(self.file.fileno()).st_size
+        if size < self.pos:
+            self._note("truncated")
+            self.pos, self.partial, self.skip_line = 0, b"", False
+        if size - self.pos > TAIL_READ_LIMIT:
+            # Only the last lines are shown: skip what a burst wrote beyond that
+            self.skipped += size - TAIL_READ_LIMIT - self.pos
+            self.pos, self.partial, self.skip_line = size - TAIL_READ_LIMIT, b"", True
+        if size > self.pos:
+            data = os.pread(self.file.fileno(), size - self.pos, self.pos)
+            self.pos += len(data)
+            self._feed(data)
+
+    def _feed(self, data):
+        *complete, self.partial = (self.partial + data).split(b"\n")
+        if len(self.partial) > TAIL_READ_LIMIT:
+            complete.append(self.partial)  # no newline in sight: show it as a line
+            self.partial = b""
+        if self.skip_line and complete:
+            complete.pop(0)
+            self.skip_line = False
+        for raw in complete:
+            line = raw.decode("utf-8", "replace").rstrip("\r")
+            self.read_lines += 1
+            if self.regex is not None and not self.regex.search(line):
+                continue
+            self.matched += 1
+            self.lines.append(_CONTROL_CHARS.sub("·", line[:TAIL_LINE_CHARS]))
+
+    def _note(self, event):
+        self.lines.append(f"── {event} ──")
+
+    def _render(self, status=None):
+        self.last_update = time.monotonic()
+        if status is None:
+            status = "🟢 following" if self.file is not None else "⏳ waiting for the file"
+        header = md_escape(f"📜 {display_path(self.path)} • {status}")
+        if self.regex is not None:
+            header += f"\n🔍 `{self.regex.pattern.replace(chr(92), chr(92) * 2).replace('`', chr(92) + '`')}`"
+        counts = f"{self.read_lines} lines read"
+        if self.regex is not None:
+            counts += f", {self.matched} matched"
+        if self.skipped:
+            counts += f", {human_size(self.skipped)} skipped"
+        if not self.stopped:
+            counts += f" • updates every {self.manager.update_interval(self.chat_id):g}s"
+        footer = md_escape(counts)
+
+        # Newest lines that fit in one message
+        room = MESSAGE_LIMIT - len(header) - len(footer) - 20
+        shown = []
+        for line in reversed(self.lines):
+            room -= len(line) + line.count("\\") + line.count("`") + 1
+            if room < 0:
+                break
+            shown.append(line)
+        body = "\n".join(reversed(shown)) or " "
+        self.live.update(f"{header}\n{md_code_block(body)}\n{footer}")
+
+    def stop(self, status="⏹️ stopped"):
+        if self.stopped:
+            return
+        self.stopped = True
+        if self.timer is not None:
+            reactor.cancel(self.timer)
+            self.timer = None
+        if self.file is not None:
+            self._drain()
+        self._close()
+        if self.dir_wd is not None:
+            self.manager.watcher.unwatch(self.dir_wd, self._on_dir_event)
+        self.live.reply_markup = None
+        self._render(status)
+
+class TailManager:
+    """Every chat's LogFollowers, sharing one watcher and the chat's send rate."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.followers = {}  # id -> LogFollower
+        self.ids = itertools.count(1)
+        self.watcher = None
+        self.next_slot = {}  # chat_id -> monotonic time of its next free update slot (reactor thread)
+
+    def _ensure_watcher(self):
+        if self.watcher is None:
+            try:
+                self.watcher = Inotify()
+            except (OSError, AttributeError) as e:
+                print(f"⚠️ inotify unavailable ({e}), /tail polls every {TAIL_POLL_INTERVAL:g}s")
+                self.watcher = StatPoller()
+
+    def follow(self, chat_id, path, regex=None):
+        with self.lock:
+            if sum(1 for f in self.followers.values() if f.chat_id == chat_id) >= TAIL_MAX_PER_CHAT:
+                raise ValueError(f"this chat already follows {TAIL_MAX_PER_CHAT} files, the most that "
+                                 f"still update every {self._interval(TAIL_MAX_PER_CHAT):g}s; "
+                                 f"stop one with /tail first")
+            follower = LogFollower(self, next(self.ids), chat_id, path, regex)
+            self.followers[follower.id] = follower
+        reactor.call_soon(self._start, follower)
+        return follower
+
+    def _start(self, follower):
+        self._ensure_watcher()
+        try:
+            follower.start()
+        except OSError as e:
+            follower.stopped = True
+            follower._close()
+            with self.lock:
+                self.followers.pop(follower.id, None)
+            send_text(follower.chat_id, f"❌ Cannot follow {display_path(follower.path)}: {e}")
+
+    def stop(self, chat_id, follower_id=None):
+        """Stops one follower of the chat, or all of them; returns how many."""
+        with self.lock:
+            stopped = [f for f in self.followers.values()
+                       if f.chat_id == chat_id and follower_id in (None, f.id)]
+            for follower in stopped:
+                del self.followers[follower.id]
+        for follower in stopped:
+            reactor.call_soon(follower.stop)
+        return len(stopped)
+
+    def following(self, chat_id):
+        with self.lock:
+            return [f for f in self.followers.values() if f.chat_id == chat_id]
+
+    @staticmethod
+    def _interval(count):
+        return max(TAIL_UPDATE_INTERVAL, count * 2 / OUTBOUND_CHAT_RATE)
+
+    def update_interval(self, chat_id):
+        """Seconds between two updates of one tail, given how many the chat follows."""
+        with self.lock:
+            count = sum(1 for f in self.followers.values() if f.chat_id == chat_id)
+        return self._interval(max(1, count))
+
+    def slot(self, chat_id, earliest):
+        """
+        When a follower of the chat may update, at earliest. Updates of one
+        chat get slots spaced to half its send rate, so many tails take turns
+        instead of bunching up in the dispatcher. Reactor thread only.
+        """
+        at = max(earliest, self.next_slot.get(chat_id, 0), time.monotonic())
+        self.next_slot[chat_id] = at + 2 / OUTBOUND_CHAT_RATE
+        return at
+
+    def stats(self):
+        with self.lock:
+            count = len(self.followers)
+        kind = type(self.watcher).__name__ if self.watcher else "idle"
+        return {"following": count, "watcher": kind, "events": self.watcher.events if self.watcher else 0}
+
+tails = TailManager()
+
 # ================= TELEGRAM HANDLERS =================
 @bot.message_handler(commands=["start"])
 def start(m):
     cid = m.chat.id
     
     if not is_admin(cid):
-        bot.send_message(cid, "❌ You are not authorized to use this bot.")
+        send_text(cid, "❌ You are not authorized to use this bot.")
         return
     
-    welcome_msg = """
+    welcome_msg = f"""
 ━━━━━━━━━━━━━━━━━━━━━━
         𝗧𝗘𝗥𝗠𝗨𝗫  𝗕𝗢𝗧
 ━━━━━━━━━━━━━━━━━━━━━━
@@ -180,39 +4299,50 @@ def start(m):
 
 📌 𝗤𝘂𝗶𝗰𝗸 𝗖𝗼𝗺𝗺𝗮𝗻𝗱𝘀:
 • /nano filename - 𝗘𝗱𝗶𝘁 𝗮 𝗳𝗶𝗹𝗲
+• /get path - 𝗗𝗼𝘄𝗻𝗹𝗼𝗮𝗱 𝗮 𝗳𝗶𝗹𝗲 𝗼𝗿 𝗳𝗼𝗹𝗱𝗲𝗿 (𝘀𝗲𝗻𝗱 𝗮 𝗳𝗶𝗹𝗲 𝘁𝗼 𝘂𝗽𝗹𝗼𝗮𝗱)
+• /files [path] - 𝗕𝗿𝗼𝘄𝘀𝗲 𝗳𝗼𝗹𝗱𝗲𝗿𝘀 𝗮𝗻𝗱 𝗽𝗮𝗴𝗲 𝘁𝗵𝗿𝗼𝘂𝗴𝗵 𝗳𝗶𝗹𝗲𝘀
+• /find name - 𝗙𝗶𝗻𝗱 𝗳𝗶𝗹𝗲𝘀 𝗯𝘆 𝗻𝗮𝗺𝗲
+• /grep [-e] text - 𝗦𝗲𝗮𝗿𝗰𝗵 𝗳𝗶𝗹𝗲 𝗰𝗼𝗻𝘁𝗲𝗻𝘁𝘀 (-𝗲 𝗳𝗼𝗿 𝗮 𝗿𝗲𝗴𝗲𝘅)
+• /tail file [regex] - 𝗙𝗼𝗹𝗹𝗼𝘄 𝗮 𝗹𝗼𝗴 𝗶𝗻 𝗼𝗻𝗲 𝗹𝗶𝘃𝗲 𝗺𝗲𝘀𝘀𝗮𝗴𝗲 (𝘂𝗽 𝘁𝗼 {TAIL_MAX_PER_CHAT} 𝗽𝗲𝗿 𝗰𝗵𝗮𝘁)
 • /stop - 𝗦𝘁𝗼𝗽 𝗰𝘂𝗿𝗿𝗲𝗻𝘁 𝗽𝗿𝗼𝗰𝗲𝘀𝘀
 • /status - 𝗖𝗵𝗲𝗰𝗸 𝘀𝘆𝘀𝘁𝗲𝗺 𝘀𝘁𝗮𝘁𝘂𝘀
 • /admin - 𝗢𝗽𝗲𝗻 𝗮𝗱𝗺𝗶𝗻 𝗽𝗮𝗻𝗲𝗹
 • /sessions - 𝗩𝗶𝗲𝘄 𝗮𝗰𝘁𝗶𝘃𝗲 𝘀𝗲𝘀𝘀𝗶𝗼𝗻𝘀
+• /history - 𝗥𝗲𝗰𝗲𝗻𝘁 𝗰𝗼𝗺𝗺𝗮𝗻𝗱𝘀 𝗮𝗻𝗱 𝗲𝘅𝗶𝘁 𝗰𝗼𝗱𝗲𝘀
+• /screen cmd - 𝗟𝗶𝘃𝗲 𝘀𝗰𝗿𝗲𝗲𝗻 (𝘁𝗼𝗽, 𝗵𝘁𝗼𝗽)
+• /session on|off - 𝗣𝗲𝗿𝘀𝗶𝘀𝘁𝗲𝗻𝘁 𝘀𝗵𝗲𝗹𝗹 (𝗰𝗱, 𝗲𝘅𝗽𝗼𝗿𝘁)
+• {COMMAND_ESCAPE}cmd - 𝗡𝗲𝘄 𝗰𝗼𝗺𝗺𝗮𝗻𝗱 𝘄𝗵𝗶𝗹𝗲 𝗮 𝗽𝗿𝗼𝗴𝗿𝗮𝗺 𝗿𝗲𝗮𝗱𝘀 𝗶𝗻𝗽𝘂𝘁
+• ^C / ^D - 𝗖𝘁𝗿𝗹 𝗸𝗲𝘆𝘀 𝗳𝗼𝗿 𝘁𝗵𝗲 𝗿𝘂𝗻𝗻𝗶𝗻𝗴 𝗽𝗿𝗼𝗴𝗿𝗮𝗺
 
 💡 𝗧𝗶𝗽: 𝗨𝘀𝗲 𝗯𝘂𝘁𝘁𝗼𝗻𝘀 𝗯𝗲𝗹𝗼𝘄 𝗼𝗿 𝘁𝘆𝗽𝗲 𝗰𝗼𝗺𝗺𝗮𝗻𝗱𝘀 𝗱𝗶𝗿𝗲𝗰𝘁𝗹𝘆!
 ━━━━━━━━━━━━━━━━━━━━━━
 """
-    bot.send_message(cid, welcome_msg, 
-                     parse_mode="Markdown", 
-                     reply_markup=main_menu_keyboard())
+    send_text(cid, welcome_msg, 
+              parse_mode="Markdown", 
+              reply_markup=main_menu_keyboard())
 
 @bot.message_handler(commands=["admin"])
 def admin_panel(m):
     cid = m.chat.id
     if str(cid) != str(MAIN_ADMIN_ID):
-        bot.send_message(cid, "❌ Only main admin can access this panel.")
+        send_text(cid, "❌ Only main admin can access this panel.")
         return
     
-    bot.send_message(cid, "🔐 *ADMIN PANEL*", 
-                     parse_mode="Markdown", 
-                     reply_markup=admin_keyboard())
+    send_text(cid, "🔐 *ADMIN PANEL*", 
+              parse_mode="Markdown", 
+              reply_markup=admin_keyboard())
 
 @bot.message_handler(commands=["status"])
 def status_cmd(m):
     cid = m.chat.id
     if not is_admin(cid):
-        bot.send_message(cid, "❌ Not authorized!")
+        send_text(cid, "❌ Not authorized!")
         return
     
     # Calculate total processes and sessions
-    total_processes = sum(len(procs) for procs in processes.values())
-    total_sessions = sum(len(sess) for sess in active_sessions.values())
+    counts = registry.process_counts()
+    total_processes = sum(counts.values())
+    total_sessions = registry.stats()["active"]
     
     status_msg = f"""
 ━━━━━━━━━━━━━━━━━━━━━━
@@ -227,132 +4357,408 @@ def status_cmd(m):
 📌 𝗔𝗰𝘁𝗶𝘃𝗲 𝗣𝗿𝗼𝗰𝗲𝘀𝘀𝗲𝘀 𝗯𝘆 𝗔𝗱𝗺𝗶𝗻:
 """
     
-    for admin_id, procs in processes.items():
-        if procs:
-            status_msg += f"\n👤 Admin {admin_id}: {len(procs)} process(es)"
+    for admin_id, count in counts.items():
+        status_msg += f"\n👤 Admin {admin_id}: {count} process(es)"
+
+    if recent_exits:
+        status_msg += "\n\n🏁 𝗥𝗲𝗰𝗲𝗻𝘁𝗹𝘆 𝗙𝗶𝗻𝗶𝘀𝗵𝗲𝗱:"
+        for chat_id, cmd, info in reversed(recent_exits):
+            short_cmd = cmd[:40].replace("`", "'")
+            status_msg += f"\n• `{short_cmd}` — {info.describe()}"
+
+    shells = registry.shells()
+    if shells:
+        busy = sum(1 for session in shells if session.busy())
+        status_msg += f"\n\n🐚 Shell sessions: {len(shells)} ({busy} busy)"
+
+    sched = scheduler.stats()
+    status_msg += (f"\n\n⏳ Scheduler: {sched['running']}/{MAX_RUNNING_COMMANDS} running, "
+                   f"{sched['queued']} queued")
+
+    expiry = expirer.stats()
+    expired = ", ".join(f"{count} {kind}" for kind, count in expiry["expired"].items())
+    status_msg += (f"\n\n⏲️ Expiry: {expiry['pending']} pending, {expiry['sweeps']} sweeps "
+                   f"(last {expiry['last_sweep_ms']:.2f} ms), expired {expired}")
+
+    updates = bot.update_stats()
+    status_msg += (f"\n\n📥 Updates: {updates['handled']} handled, {updates['waiting']} waiting "
+                   f"in {updates['lanes']} chats, {updates['dropped']} dropped")
+
+    guard = ingress_guard.stats()
+    status_msg += (f"\n\n🛡️ Ingress: {guard['passed']} passed, {guard['stale']} stale, "
+                   f"{guard['rate_limited']} rate-limited, {guard['collapsed']} collapsed")
+
+    if WEBHOOK_URL:
+        status_msg += (f"\n\n🔗 Webhook: {webhook_feeder.received} received, "
+                       f"{webhook_feeder.rejected} refused, {webhook_feeder.queue.qsize()} waiting")
+
+    api = sorted(api_transport.stats().items(), key=lambda item: -item[1]["calls"])[:4]
+    if api:
+        status_msg += "\n\n🌐 Bot API:"
+        for name, st in api:
+            status_msg += (f"\n• {name}: {st['calls']} calls, p50 {st['p50_ms']:.0f} ms, "
+                           f"p99 {st['p99_ms']:.0f} ms, {st['errors']} errors, {st['retries']} retries")
+
+    listings = dir_cache.stats()
+    status_msg += (f"\n\n📂 File browser: {listings['cached']} folders cached, "
+                   f"{listings['hits']} hits, {listings['misses']} scans")
+
+    index = search_index.stats()
+    if index["error"]:
+        status_msg += f"\n\n🔎 Index: disabled ({index['error']})"
+    else:
+        last = index["last_scan"]
+        status_msg += (f"\n\n🔎 Index: {index['files']} files, {index['scans']} scans"
+                       + (f" (last {last[0]:.1f}s, {last[1]} changed)" if last else "")
+                       + (", building" if index["building"] else ""))
+
+    followed = tails.stats()
+    if followed["following"]:
+        status_msg += (f"\n\n📜 Tails: {followed['following']} following, "
+                       f"{followed['events']} file events ({followed['watcher']})")
+
+    with transfer_lock:
+        moved = dict(transfer_stats)
+    status_msg += (f"\n\n📦 Transfers: {moved['running']} running, {human_size(moved['sent_bytes'])} sent, "
+                   f"{human_size(moved['received_bytes'])} received, {moved['failed']} failed")
+
+    out = dispatcher.stats()
+    status_msg += (f"\n\n📤 Outbound: {out['queued']} queued, {out['sent']} sent, "
+                   f"{out['dropped']} dropped, {out['rate_limited']} rate-limited, {out['failed']} failed")
     
-    bot.send_message(cid, status_msg, parse_mode="Markdown")
+    send_text(cid, status_msg, parse_mode="Markdown")
 
 @bot.message_handler(commands=["sessions"])
 def sessions_cmd(m):
     cid = m.chat.id
     if not is_admin(cid):
-        bot.send_message(cid, "❌ Not authorized!")
+        send_text(cid, "❌ Not authorized!")
         return
     
     sessions_msg = "🔄 *ACTIVE SESSIONS*\n"
-    for admin_id, sess_dict in active_sessions.items():
-        if sess_dict:
-            sessions_msg += f"\n👤 Admin {admin_id}:"
-            for chat_id, last_active in sess_dict.items():
-                elapsed = int(time.time() - last_active)
-                sessions_msg += f"\n  • Chat {chat_id}: {elapsed}s ago"
+    for admin_id, sess_dict in registry.activity().items():
+        sessions_msg += f"\n👤 Admin {admin_id}:"
+        for chat_id, last_active in sess_dict.items():
+            elapsed = int(time.time() - last_active)
+            sessions_msg += f"\n  • Chat {chat_id}: {elapsed}s ago"
+            target = registry.input_target(chat_id)
+            if target is not None and target.waiting:
+                sessions_msg += " ⌨️ waiting for input"
     
-    bot.send_message(cid, sessions_msg, parse_mode="Markdown")
+    send_text(cid, sessions_msg, parse_mode="Markdown")
+
+@bot.message_handler(commands=["history"])
+def history_cmd(m):
+    cid = m.chat.id
+    if not is_admin(cid):
+        send_text(cid, "❌ Not authorized!")
+        return
+
+    args = m.text.strip().split(maxsplit=1)
+    limit = int(args[1]) if len(args) > 1 and args[1].isdigit() else 10
+    rows = store.history(cid, min(limit, 50))
+    if not rows:
+        send_text(cid, "📜 No commands recorded in this chat yet.")
+        return
+
+    history_msg = "📜 *COMMAND HISTORY*\n"
+    for cmd, started, duration, exit_code in rows:
+        when = datetime.fromtimestamp(started).strftime("%d.%m %H:%M:%S")
+        if exit_code is None:
+            result = "🔌"
+        elif exit_code == 0:
+            result = "✅"
+        elif exit_code < 0:
+            result = f"⚠️ {signal_name(-exit_code)}"
+        else:
+            result = f"❌ {exit_code}"
+        short_cmd = cmd[:40].replace("`", "'")
+        history_msg += f"\n{when} `{short_cmd}` {result} • {duration:.1f}s"
+    send_text(cid, history_msg, parse_mode="Markdown")
 
 @bot.message_handler(commands=["stop"])
 def stop_cmd(m):
     cid = m.chat.id
     if not is_admin(cid):
-        bot.send_message(cid, "❌ Not authorized!")
+        send_text(cid, "❌ Not authorized!")
         return
     
-    # Check all admin's processes for this chat_id
     found = False
-    for admin_id in list(processes.keys()):
-        proc_dict = processes.get(admin_id, {})
-        if cid in proc_dict:
-            pid, fd, _, _ = proc_dict[cid]
-            try:
-                os.kill(pid, signal.SIGTERM)
-                time.sleep(0.5)
-                os.kill(pid, signal.SIGKILL)
-            except:
-                pass
-            
-            # Cleanup from all dictionaries
-            if cid in proc_dict:
-                del proc_dict[cid]
-            input_dict = input_wait.get(admin_id, {})
-            if cid in input_dict:
-                del input_dict[cid]
-            sess_dict = active_sessions.get(admin_id, {})
-            if cid in sess_dict:
-                del sess_dict[cid]
-            
-            found = True
+    record = registry.detach(cid)
+    if record is not None:
+        # SIGTERM now, SIGKILL after STOP_GRACE; the reaper reports the exit
+        reaper.terminate(record.pid)
+        registry.forget(cid)
+        found = True
     
+    if scheduler.cancel(cid):
+        found = True
+
+    session = registry.get_shell(cid)
+    if session and session.interrupt():
+        found = True
+
     if found:
-        bot.send_message(cid, "✅ Process stopped successfully!")
+        send_text(cid, "✅ Process stopped successfully!")
     else:
-        bot.send_message(cid, "⚠️ No running process to stop.")
+        send_text(cid, "⚠️ No running process to stop.")
 
 @bot.message_handler(commands=["nano"])
 def nano_cmd(m):
     cid = m.chat.id
     if not is_admin(cid):
-        bot.send_message(cid, "❌ Not authorized!")
+        send_text(cid, "❌ Not authorized!")
         return
 
     args = m.text.strip().split(maxsplit=1)
     if len(args) < 2:
-        bot.send_message(cid, "Usage: /nano <filename>")
+        send_text(cid, "Usage: /nano <filename>")
         return
 
     filename = args[1].strip()
-    path = os.path.join(BASE_DIR, filename)
+    path = resolve_path(filename)
+    if path is None:
+        send_text(cid, "❌ Path is outside the base directory")
+        return
 
     # Create file if it doesn't exist
     if not os.path.exists(path):
         open(path, 'w').close()
 
-    sid = str(uuid.uuid4())
-    edit_sessions[sid] = {
-        "file": path, 
-        "admin_id": cid, 
-        "timestamp": time.time()
-    }
+    sid = registry.add_edit(path, cid)
 
     link = f"https://tuitui-tui-bot.onrender.com/edit/{sid}?admin_id={cid}"
 
     markup = types.InlineKeyboardMarkup()
     markup.add(
         types.InlineKeyboardButton("✏️ Edit in Browser", url=link),
-        types.InlineKeyboardButton("📄 View Content", callback_data=f"view_{filename}")
+        types.InlineKeyboardButton("📄 View Content", callback_data=f"fv:{path_tokens.token(path)}:0:n")
     )
 
-    bot.send_message(
+    send_text(
         cid,
         f"📝 *EDIT FILE*\n\n*File:* `{filename}`\n*Path:* `{path}`",
         parse_mode="Markdown",
         reply_markup=markup
     )
 
+@bot.message_handler(commands=["files"])
+def files_cmd(m):
+    cid = m.chat.id
+    if not is_admin(cid):
+        send_text(cid, "❌ Not authorized!")
+        return
+
+    args = m.text.strip().split(maxsplit=1)
+    path = resolve_path(args[1].strip() if len(args) > 1 else ".")
+    if path is None:
+        send_text(cid, "❌ Path is outside the base directory")
+        return
+
+    kind = "fb" if os.path.isdir(path) else "fv"
+    error = show_browser_page(cid, f"{kind}:{path_tokens.token(path)}:0")
+    if error:
+        send_text(cid, error)
+
+@bot.message_handler(commands=["find", "grep"])
+def search_cmd(m):
+    cid = m.chat.id
+    if not is_admin(cid):
+        send_text(cid, "❌ Not authorized!")
+        return
+
+    command, _, query = m.text.partition(" ")
+    kind = command.lstrip("/").split("@")[0]
+    regex = kind == "grep" and query.startswith("-e ")
+    query = (query[3:] if regex else query).strip()
+    if not query:
+        send_text(cid, "Usage: /find <part of a name> or /grep [-e regex] <text>")
+        return
+    search_index.start()
+    if search_index.error:
+        send_text(cid, f"❌ Search is unavailable: {search_index.error}")
+        return
+    try:
+        results = SearchResults(kind, query, regex)
+    except (re.error, ValueError) as e:
+        send_text(cid, f"❌ Bad search: {e}")
+        return
+    show_search_page(cid, f"sq:{search_cache.add(results)}:0")
+
+@bot.message_handler(commands=["tail"])
+def tail_cmd(m):
+    cid = m.chat.id
+    if not is_admin(cid):
+        send_text(cid, "❌ Not authorized!")
+        return
+
+    args = m.text.strip().split(maxsplit=2)
+    if len(args) < 2:
+        following = tails.following(cid)
+        if not following:
+            send_text(cid, "Usage: /tail <file> [regex]  ·  /tail stop")
+            return
+        markup = types.InlineKeyboardMarkup()
+        for follower in following:
+            markup.add(types.InlineKeyboardButton(f"⏹️ {display_path(follower.path)}",
+                                                  callback_data=f"ts:{follower.id}"))
+        send_text(cid, f"📜 Following {len(following)} file(s):", reply_markup=markup)
+        return
+    if args[1] == "stop":
+        stopped = tails.stop(cid)
+        send_text(cid, f"✅ Stopped {stopped} follower(s)" if stopped else "⚠️ Not following any file.")
+        return
+
+    path = resolve_path(args[1])
+    if path is None:
+        send_text(cid, "❌ Path is outside the base directory")
+        return
+    if os.path.isdir(path) or not os.path.isdir(os.path.dirname(path)):
+        send_text(cid, f"❌ Not a file: {args[1]}")
+        return
+    regex = None
+    if len(args) > 2:
+        try:
+            # Smart case, like /grep
+            regex = re.compile(args[2], 0 if any(c.isupper() for c in args[2]) else re.IGNORECASE)
+        except re.error as e:
+            send_text(cid, f"❌ Bad filter: {e}")
+            return
+
+    try:
+        tails.follow(cid, path, regex)
+    except ValueError as e:
+        send_text(cid, f"❌ {e}")
+
+@bot.message_handler(commands=["get"])
+def get_cmd(m):
+    cid = m.chat.id
+    if not is_admin(cid):
+        send_text(cid, "❌ Not authorized!")
+        return
+
+    args = m.text.strip().split(maxsplit=1)
+    if len(args) < 2:
+        send_text(cid, "Usage: /get <file or folder>")
+        return
+    path = resolve_path(args[1].strip())
+    if path is None:
+        send_text(cid, "❌ Path is outside the base directory")
+        return
+
+    if os.path.isdir(path):
+        run_transfer(cid, send_directory, path)
+    elif os.path.isfile(path):
+        run_transfer(cid, send_file, path)
+    else:
+        send_text(cid, f"❌ Not found: {args[1].strip()}")
+
+@bot.message_handler(content_types=["document"])
+def document_upload(m):
+    """
+    Saves a document under BASE_DIR: as its own name, or at the path (file or
+    folder/) in the caption. An existing file is only replaced once confirmed.
+    """
+    cid = m.chat.id
+    if not is_admin(cid):
+        send_text(cid, "❌ Not authorized!")
+        return
+
+    document = m.document
+    name = os.path.basename(document.file_name or f"upload-{document.file_unique_id}")
+    target = (m.caption or "").strip() or name
+    path = resolve_path(target)
+    if path is not None and (target.endswith("/") or os.path.isdir(path)):
+        path = resolve_path(os.path.join(path, name))
+    if path is None:
+        send_text(cid, "❌ Path is outside the base directory")
+        return
+    if TRANSFER_DOWNLOAD_LIMIT and (document.file_size or 0) > TRANSFER_DOWNLOAD_LIMIT:
+        send_text(cid, f"❌ {name} is {human_size(document.file_size)}; the Bot API only lets bots download "
+                       f"{human_size(TRANSFER_DOWNLOAD_LIMIT)} (a self-hosted Bot API server lifts this)")
+        return
+    if os.path.lexists(path):
+        token = pending_uploads.add(cid, document, path)
+        markup = types.InlineKeyboardMarkup()
+        markup.add(types.InlineKeyboardButton("♻️ Overwrite", callback_data=f"uo:{token}"))
+        send_text(cid, f"⚠️ {display_path(path)} already exists. Overwrite it?", reply_markup=markup)
+        return
+
+    run_transfer(cid, receive_document, document, path)
+
+@bot.message_handler(commands=["screen"])
+def screen_cmd(m):
+    cid = m.chat.id
+    if not is_admin(cid):
+        send_text(cid, "❌ Not authorized!")
+        return
+
+    args = m.text.strip().split(maxsplit=1)
+    if len(args) < 2:
+        send_text(cid, "Usage: /screen <command>  (e.g. /screen htop)")
+        return
+
+    admin_id = m.from_user.id if m.from_user else cid
+    start_command(cid, args[1].strip(), admin_id, screen=True)
+
+@bot.message_handler(commands=["session"])
+def session_cmd(m):
+    cid = m.chat.id
+    if not is_admin(cid):
+        send_text(cid, "❌ Not authorized!")
+        return
+
+    args = m.text.strip().split(maxsplit=1)
+    action = args[1].strip().lower() if len(args) > 1 else "status"
+    session = registry.get_shell(cid)
+
+    if action == "on":
+        admin_id = m.from_user.id if m.from_user else cid
+        try:
+            session, started = registry.open_shell(cid, lambda: ShellSession(cid, admin_id))
+        except OSError as e:
+            send_text(cid, f"❌ Cannot start shell session: {e}")
+            return
+        if not started:
+            send_text(cid, "🐚 Shell session is already running.")
+            return
+        send_text(cid, f"🐚 Shell session started in `{BASE_DIR}`\n"
+                       "Directory and environment now persist between commands. /session off to end it.",
+                  parse_mode="Markdown")
+    elif action == "off":
+        if not session:
+            send_text(cid, "⚠️ No shell session in this chat.")
+            return
+        session.close()
+    elif action == "status":
+        if session:
+            elapsed = int(time.time() - session.started)
+            state = "running a command" if session.busy() else "idle"
+            send_text(cid, f"🐚 Shell session up for {elapsed}s, {state}, {len(session.pending)} waiting.")
+        else:
+            send_text(cid, "🐚 No shell session. /session on starts one.")
+    else:
+        send_text(cid, "Usage: /session on | off | status")
+
 @bot.message_handler(func=lambda m: True)
 def shell(m):
     cid = m.chat.id
     text = m.text.strip()
     
     if not is_admin(cid):
-        bot.send_message(cid, "❌ You are not authorized to use this bot.")
+        send_text(cid, "❌ You are not authorized to use this bot.")
         return
     
-    # Update session activity (use MAIN_ADMIN_ID as default)
-    get_admin_dict(MAIN_ADMIN_ID, active_sessions)[cid] = time.time()
-    
-    # Handle input response
-    input_dict = get_admin_dict(MAIN_ADMIN_ID, input_wait)
-    if cid in input_dict:
-        fd = input_dict.pop(cid)
-        os.write(fd, (text + "\n").encode())
-        return
+    # Commands are owned by the admin who sent them
+    admin_id = m.from_user.id if m.from_user else cid
+    registry.touch(admin_id, cid)
     
     # Quick command mapping
     quick_map = {
         "📁 ls": "ls -la",
         "📂 pwd": "pwd",
         "💿 df -h": "df -h",
-        "📊 top": "top -b -n 1 | head -20",
+        "📊 top": None,
         "📜 ps aux": "ps aux | head -15",
         "🗑️ clear": None,
         "🛑 stop": None,
@@ -360,32 +4766,56 @@ def shell(m):
         "🔄 ping 8.8.8.8": "ping -c 4 8.8.8.8",
         "🌐 ifconfig": "ifconfig || ip addr"
     }
+
+    if COMMAND_ESCAPE and text.startswith(COMMAND_ESCAPE):
+        # Explicit new command, even while a program is reading the chat
+        text = text[len(COMMAND_ESCAPE):].strip()
+        if not text:
+            return
+    elif text not in quick_map and registry.input_target(cid) is not None:
+        # A program is attached: the message is its input
+        reactor.call_soon(send_input, cid, m.text, m.message_id)
+        return
     
     if text in quick_map:
         if text == "🗑️ clear":
-            bot.send_message(cid, "🗑️ Chat cleared (bot-side)")
+            send_text(cid, "🗑️ Chat cleared (bot-side)")
             return
         elif text == "🛑 stop":
             stop_cmd(m)
             return
         elif text == "📝 nano":
-            bot.send_message(cid, "Usage: /nano filename")
+            send_text(cid, "Usage: /nano filename")
+            return
+        elif text == "📊 top":
+            start_command(cid, "top", admin_id, screen=True)
             return
         else:
             text = quick_map[text]
     
-    # Stop any existing process for this chat_id
-    proc_dict = get_admin_dict(MAIN_ADMIN_ID, processes)
-    if cid in proc_dict:
-        pid, fd, _, _ = proc_dict[cid]
-        try:
-            os.kill(pid, signal.SIGTERM)
-        except:
-            pass
-        del proc_dict[cid]
+    start_command(cid, text, admin_id)
+
+def start_command(cid, text, admin_id, screen=False):
+    # Chats with a shell session run commands inside it, one after another
+    session = registry.get_shell(cid)
+    if session and not screen:
+        send_text(cid, md_code_block(f"$ {text}"), parse_mode="MarkdownV2")
+        if session.busy():
+            send_text(cid, "⏳ Runs after the current command. /stop interrupts it.")
+        session.run(text)
+        return
+
+    # Stop any existing or queued process for this chat_id
+    scheduler.cancel(cid)
+    record = registry.detach(cid)
+    if record is not None:
+        reaper.terminate(record.pid)
     
-    bot.send_message(cid, f"```\n$ {text}\n```", parse_mode="Markdown")
-    run_cmd(text, MAIN_ADMIN_ID, cid)
+    position = scheduler.submit(admin_id, cid, text, screen=screen)
+    if position is None:
+        send_text(cid, "🚫 Too many commands waiting, try again later.")
+    elif position:
+        send_text(cid, f"⏳ Queued at position {position}. It starts when a slot frees up.")
 
 # ================= CALLBACK HANDLERS =================
 @bot.callback_query_handler(func=lambda call: True)
@@ -393,100 +4823,97 @@ def callback_handler(call):
     cid = call.message.chat.id
     
     if not is_admin(cid):
-        bot.answer_callback_query(call.id, "❌ Not authorized!")
+        answer_callback(call.id, "❌ Not authorized!")
         return
     
     # ---------- STATUS ----------
     if call.data == "status":
         status_cmd(call.message)
-        bot.answer_callback_query(call.id)
+        answer_callback(call.id)
     
     # ---------- STOP ALL ----------
     elif call.data == "stop_all":
         if str(cid) != str(MAIN_ADMIN_ID):
-            bot.answer_callback_query(call.id, "❌ Main admin only!")
+            answer_callback(call.id, "❌ Main admin only!")
             return
         
         stopped = 0
-        for admin_id, proc_dict in list(processes.items()):
-            for chat_id, (pid, fd, start_time, cmd) in list(proc_dict.items()):
-                try:
-                    os.kill(pid, signal.SIGKILL)
-                    stopped += 1
-                except:
-                    pass
+        for record in registry.detach_all():
+            try:
+                os.killpg(record.pid, signal.SIGKILL)
+                stopped += 1
+            except:
+                pass
         
-        processes.clear()
-        input_wait.clear()
-        active_sessions.clear()
+        stopped += scheduler.cancel()
+        registry.forget()
         
-        bot.answer_callback_query(call.id, f"✅ Stopped {stopped} processes")
-        bot.send_message(cid, f"🛑 Stopped all {stopped} processes")
+        answer_callback(call.id, f"✅ Stopped {stopped} processes")
+        send_text(cid, f"🛑 Stopped all {stopped} processes")
     
     # ---------- ADMIN LIST ----------
     elif call.data == "admin_list":
         if str(cid) != str(MAIN_ADMIN_ID):
-            bot.answer_callback_query(call.id, "❌ Main admin only!")
+            answer_callback(call.id, "❌ Main admin only!")
             return
         
         admin_list_text = "\n".join([f"👤 {a}" for a in sorted(admins)])
-        bot.answer_callback_query(call.id)
-        bot.send_message(cid, f"*ADMIN LIST:*\n{admin_list_text}", parse_mode="Markdown")
+        answer_callback(call.id)
+        send_text(cid, f"*ADMIN LIST:*\n{admin_list_text}", parse_mode="Markdown")
     
     # ---------- ADD ADMIN ----------
     elif call.data == "add_admin":
         if str(cid) != str(MAIN_ADMIN_ID):
-            bot.answer_callback_query(call.id, "❌ Main admin only!")
+            answer_callback(call.id, "❌ Main admin only!")
             return
         
-        msg = bot.send_message(cid, "Send the user ID to add as admin:")
+        msg = send_text(cid, "Send the user ID to add as admin:", wait=True)
         bot.register_next_step_handler(msg, add_admin_step)
-        bot.answer_callback_query(call.id)
+        answer_callback(call.id)
     
     # ---------- REMOVE ADMIN ----------
     elif call.data == "remove_admin":
         if str(cid) != str(MAIN_ADMIN_ID):
-            bot.answer_callback_query(call.id, "❌ Main admin only!")
+            answer_callback(call.id, "❌ Main admin only!")
             return
         
-        msg = bot.send_message(cid, "Send the user ID to remove from admins:")
+        msg = send_text(cid, "Send the user ID to remove from admins:", wait=True)
         bot.register_next_step_handler(msg, remove_admin_step)
-        bot.answer_callback_query(call.id)
+        answer_callback(call.id)
     
-    # ---------- LIST FILES ----------
+    # ---------- FILE BROWSER ----------
     elif call.data == "list_files":
-        try:
-            files = os.listdir(BASE_DIR)
-            file_list = "\n".join([f"📄 {f}" for f in files[:20]])
-            if len(files) > 20:
-                file_list += f"\n... and {len(files)-20} more"
-            bot.answer_callback_query(call.id)
-            bot.send_message(cid, f"*FILES IN {BASE_DIR}:*\n{file_list}", parse_mode="Markdown")
-        except Exception as e:
-            bot.answer_callback_query(call.id, f"❌ Error: {e}")
+        error = show_browser_page(cid, f"fb:{path_tokens.token(os.path.realpath(BASE_DIR))}:0")
+        answer_callback(call.id, error)
+
+    elif call.data.startswith(("fb:", "fv:")):
+        error = show_browser_page(cid, call.data, call.message.message_id)
+        answer_callback(call.id, error)
+
+    elif call.data.startswith("sq:"):
+        error = show_search_page(cid, call.data, call.message.message_id)
+        answer_callback(call.id, error)
+
+    elif call.data.startswith("uo:"):
+        upload = pending_uploads.pop(cid, call.data[3:])
+        if upload is None:
+            answer_callback(call.id, "Expired, send the file again")
+        else:
+            run_transfer(cid, receive_document, *upload, True)
+            answer_callback(call.id, "♻️ Overwriting")
+
+    elif call.data.startswith("ts:"):
+        stopped = tails.stop(cid, int(call.data[3:]))
+        answer_callback(call.id, "⏹️ Stopped" if stopped else "Already stopped")
     
     # ---------- CLEAN LOGS ----------
     elif call.data == "clean_logs":
-        current_time = time.time()
-        cleaned = 0
-        for admin_id, sess_dict in list(active_sessions.items()):
-            for chat_id, last_active in list(sess_dict.items()):
-                if current_time - last_active > 3600:
-                    del sess_dict[chat_id]
-                    cleaned += 1
-        bot.answer_callback_query(call.id, f"✅ Cleaned {cleaned} old sessions")
-    
-    # ---------- VIEW FILE CONTENT ----------
-    elif call.data.startswith("view_"):
-        filename = call.data[5:]
-        path = os.path.join(BASE_DIR, filename)
-        try:
-            with open(path, 'r', encoding='utf-8') as f:
-                content = f.read(1000)
-            bot.send_message(cid, f"```\n{content}\n```", parse_mode="Markdown")
-            bot.answer_callback_query(call.id)
-        except Exception as e:
-            bot.answer_callback_query(call.id, f"❌ Cannot read file: {e}")
+        cleaned = registry.forget(older_than=3600)
+        answer_callback(call.id, f"✅ Cleaned {cleaned} old sessions")
+
+    # Buttons of older versions of the bot, or of pages that are gone
+    else:
+        answer_callback(call.id, "Expired")
 
 # ---------- ADD / REMOVE ADMIN STEPS ----------
 def add_admin_step(m):
@@ -495,11 +4922,11 @@ def add_admin_step(m):
         return
     try:
         new_admin = int(m.text.strip())
+        store.add_admin(new_admin)
         admins.add(new_admin)
-        save_data()
-        bot.send_message(cid, f"✅ Added admin: {new_admin}")
+        send_text(cid, f"✅ Added admin: {new_admin}")
     except:
-        bot.send_message(cid, "❌ Invalid user ID")
+        send_text(cid, "❌ Invalid user ID")
 
 def remove_admin_step(m):
     cid = m.chat.id
@@ -509,102 +4936,267 @@ def remove_admin_step(m):
     try:
         admin_id = int(m.text.strip())
     except ValueError:
-        bot.send_message(cid, "❌ Invalid user ID. Please send numeric ID only.")
+        send_text(cid, "❌ Invalid user ID. Please send numeric ID only.")
         return
 
     if admin_id == MAIN_ADMIN_ID:
-        bot.send_message(cid, "❌ Cannot remove the main admin.")
+        send_text(cid, "❌ Cannot remove the main admin.")
         return
 
     if admin_id in admins:
-        admins.remove(admin_id)
-        save_data()
-        bot.send_message(cid, f"✅ Removed admin: {admin_id}")
+        store.remove_admin(admin_id)
+        admins.discard(admin_id)
+        send_text(cid, f"✅ Removed admin: {admin_id}")
     else:
-        bot.send_message(cid, f"❌ Admin ID {admin_id} not found in the list.")
+        send_text(cid, f"❌ Admin ID {admin_id} not found in the list.")
+
+# ================= WEB RESPONSES =================
+# Static pages and assets are rendered and compressed once and answered
+# with an ETag; other text responses are compressed on the way out.
+COMPRESSIBLE = ("text/", "application/json", "application/javascript", "image/svg+xml", "font/ttf")
+CDN_ASSETS = {
+    "ace/ace.js": "https://cdnjs.cloudflare.com/ajax/libs/ace/1.23.0/ace.js",
+    "font-awesome/css/all.min.css": "https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css",
+}
+
+def compress(data, encoding, static=False):
+    if encoding == "br":
+        return brotli.compress(data, quality=11 if static else 4)
+    return gzip.compress(data, compresslevel=9 if static else 6, mtime=0)
+
+def accepted_encoding():
+    """Best encoding the client accepts: br (when brotli is installed), gzip or None."""
+    accept = request.accept_encodings
+    if brotli is not None and accept["br"]:
+        return "br"
+    if accept["gzip"]:
+        return "gzip"
+    return None
+
+class StaticBody:
+    """A fixed response body with its ETag and precompressed variants."""
+
+    def __init__(self, data, mimetype):
+        self.mimetype = mimetype
+        self.etag = hashlib.sha256(data).hexdigest()[:20]
+        self.variants = {None: data}
+        if len(data) >= COMPRESS_MIN_SIZE and mimetype.startswith(COMPRESSIBLE):
+            self.variants["gzip"] = compress(data, "gzip", static=True)
+            if brotli is not None:
+                self.variants["br"] = compress(data, "br", static=True)
+
+    def response(self, cache_control):
+        """The best variant for this request, or 304 when the client already has it."""
+        encoding = accepted_encoding()
+        if encoding not in self.variants:
+            encoding = None
+        headers = {"ETag": f'"{self.etag}"', "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+        if request.if_none_match.contains_weak(self.etag):
+            return app.response_class(status=304, headers=headers)
+        response = app.response_class(self.variants[encoding], mimetype=self.mimetype, headers=headers)
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+        return response
+
+def scan_assets(root):
+    """{relative path: absolute path} of the files under root, and a version hash over all of them."""
+    files = {}
+    digest = hashlib.sha256()
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            rel = os.path.relpath(path, root).replace(os.sep, "/")
+            files[rel] = path
+            digest.update(rel.encode())
+            with open(path, "rb") as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+    return files, digest.hexdigest()[:12]
+
+# The version hash is part of every asset URL, so assets can be cached forever
+asset_files, ASSET_VERSION = scan_assets(ASSET_DIR)
+asset_bodies = {}
+asset_lock = threading.Lock()
+
+def asset_url(name):
+    if name in asset_files:
+        return f"/assets/{ASSET_VERSION}/{name}"
+    return CDN_ASSETS[name]
+
+def asset_base(name):
+    """URL of the directory holding a local asset (Ace loads its modes from there), else None."""
+    if name in asset_files:
+        return asset_url(name).rsplit("/", 1)[0]
+    return None
+
+@app.route("/assets/<version>/<path:name>")
+def asset(version, name):
+    if version != ASSET_VERSION or name not in asset_files:
+        return "Not found", 404
+    with asset_lock:
+        body = asset_bodies.get(name)
+        if body is None:
+            with open(asset_files[name], "rb") as f:
+                data = f.read()
+            mimetype = mimetypes.guess_type(name)[0] or "application/octet-stream"
+            if name.endswith(".woff2"):
+                mimetype = "font/woff2"
+            body = asset_bodies[name] = StaticBody(data, mimetype)
+    return body.response("public, max-age=31536000, immutable")
+
+@app.after_request
+def compress_response(response):
+    """Compresses text responses that were not compressed already."""
+    if (response.status_code != 200 or response.direct_passthrough or "Content-Encoding" in response.headers
+            or not (response.mimetype or "").startswith(COMPRESSIBLE)):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = accepted_encoding()
+    data = response.get_data()
+    if encoding is None or len(data) < COMPRESS_MIN_SIZE:
+        return response
+    response.set_data(compress(data, encoding))
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)  # the compressed bytes differ from the ones a strong ETag names
+    return response
 
 # ================= ENHANCED EDITOR =================
-@app.route("/edit/<sid>", methods=["GET", "POST"])
-def edit(sid):
-    # Check if session exists
-    if sid not in edit_sessions:
-        return """
+# The page itself carries no file content: the browser loads the file in
+# EDITOR_CHUNK pieces from /edit/<sid>/range and saves by sending only the
+# changed byte range to /edit/<sid>/save, guarded by the file's ETag.
+def error_page(text, color="#f00"):
+    return f"""
         <html>
-        <body style="background:#111;color:#fff;padding:20px;">
-        <h2>❌ Invalid or expired session</h2>
+        <body style="background:#111;color:{color};padding:20px;">
+        <h2>{text}</h2>
         </body>
         </html>
         """
 
-    session_data = edit_sessions[sid]
-    file = session_data.get("file")
-    admin_id = session_data.get("admin_id")
+def editor_file(sid):
+    """(absolute path, None) for a valid editor request, else (None, (message, HTTP status))."""
+    session_data = registry.get_edit(sid)
+    if session_data is None:
+        return None, ("❌ Invalid or expired session", 404)
 
     # Ensure only the assigned admin can access
-    current_user_id = request.args.get("admin_id")
-    if str(current_user_id) != str(admin_id):
-        return """
-        <html>
-        <body style="background:#111;color:#f00;padding:20px;">
-        <h2>❌ Unauthorized access</h2>
-        </body>
-        </html>
-        """
+    if str(request.args.get("admin_id")) != str(session_data.admin_id):
+        return None, ("❌ Unauthorized access", 403)
 
     # Security: Ensure file is inside BASE_DIR
-    abs_path = os.path.abspath(file)
-    if not abs_path.startswith(os.path.abspath(BASE_DIR)):
-        return """
-        <html>
-        <body style="background:#111;color:#f00;padding:20px;">
-        <h2>❌ Unauthorized file access</h2>
-        </body>
-        </html>
-        """
+    abs_path = resolve_path(session_data.path)
+    if abs_path is None:
+        return None, ("❌ Unauthorized file access", 403)
+    return abs_path, None
 
-    if request.method == "POST":
-        try:
-            code_content = request.form.get("code", "")
-            with open(abs_path, "w", encoding='utf-8') as f:
-                f.write(code_content)
+edit_save_lock = threading.Lock()
 
-            # Remove session after save
-            edit_sessions.pop(sid, None)
+@app.route("/edit/<sid>")
+def edit(sid):
+    abs_path, error = editor_file(sid)
+    if error:
+        return error_page(error[0], "#fff" if error[1] == 404 else "#f00"), error[1]
+    try:
+        st = os.stat(abs_path)
+    except OSError as e:
+        return error_page(f"❌ Cannot open file: {e}"), 404
+    html = EDITOR_TEMPLATE.render(file=abs_path, size=st.st_size, sid=sid,
+                                  admin_id=request.args.get("admin_id"), chunk=EDITOR_CHUNK,
+                                  ace_js=asset_url("ace/ace.js"), ace_base=asset_base("ace/ace.js"),
+                                  fa_css=asset_url("font-awesome/css/all.min.css"))
+    return html, 200, {"Cache-Control": "private, no-store"}
 
-            return """
-            <html>
-            <body style="background:#111;color:#0f0;padding:20px;text-align:center;">
-            <h2>✅ File Saved Successfully!</h2>
-            <p>You can close this window.</p>
-            </body>
-            </html>
-            """
-        except Exception as e:
-            return f"""
-            <html>
-            <body style="background:#111;color:#f00;padding:20px;">
-            <h2>❌ Error saving file: {e}</h2>
-            </body>
-            </html>
-            """
-
-    # GET request: load file content
+@app.route("/edit/<sid>/range")
+def edit_range(sid):
+    """
+    Up to `length` bytes from `offset`, cut back to a whole UTF-8 character
+    and never between the CR and LF of a line break; `next` is where to continue.
+    """
+    abs_path, error = editor_file(sid)
+    if error:
+        return {"error": error[0]}, error[1]
     try:
-        with open(abs_path, "r", encoding='utf-8') as f:
-            code = f.read()
-    except Exception as e:
-        code = ""
-        print(f"⚠️ Error reading file {abs_path}: {e}")
+        offset = max(0, int(request.args.get("offset", 0)))
+        length = min(max(1, int(request.args.get("length", EDITOR_CHUNK))), EDITOR_CHUNK * 4)
+    except ValueError:
+        return {"error": "offset and length must be integers"}, 400
+
+    try:
+        with open(abs_path, "rb") as f:
+            st = os.fstat(f.fileno())
+            f.seek(offset)
+            data = f.read(length)
+    except OSError as e:
+        return {"error": f"Cannot read file: {e}"}, 404
+
+    eof = offset + len(data) >= st.st_size
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    try:
+        text = decoder.decode(data, final=eof)
+    except UnicodeDecodeError:
+        return {"error": "Not a UTF-8 text file"}, 415
+    pending = len(decoder.getstate()[0])  # bytes of a character split by the chunk end
+    if not eof and text.endswith("\r") and len(text) > 1:
+        # Ace would turn a lone \r into a line break of its own, and the next
+        # chunk's \n into another, which a save then writes back
+        text = text[:-1]
+        pending += 1
+    headers = {"ETag": file_etag(st), "Cache-Control": "no-store"}
+    return {"offset": offset, "next": offset + len(data) - pending, "size": st.st_size,
+            "eof": eof, "etag": file_etag(st), "data": text}, 200, headers
+
+@app.route("/edit/<sid>/save", methods=["POST"])
+def edit_save(sid):
+    """
+    Body: {"etag": ..., "patches": [{"offset": n, "length": n, "data": text}]},
+    byte offsets into the version the ETag names. 409 when the file changed since.
+    """
+    abs_path, error = editor_file(sid)
+    if error:
+        return {"error": error[0]}, error[1]
+    body = request.get_json(silent=True)
+    if body is None:
+        body = {}
+    elif not isinstance(body, dict):
+        return {"error": "Body must be a JSON object"}, 400
+    etag = request.headers.get("If-Match") or body.get("etag")
+    try:
+        patches = sorted((int(p["offset"]), int(p["length"]), str(p["data"]).encode("utf-8"))
+                         for p in body.get("patches", []))
+    except (KeyError, TypeError, ValueError):
+        return {"error": "Malformed patches"}, 400
+
+    with edit_save_lock:
+        try:
+            st = os.stat(abs_path)
+        except OSError as e:
+            return {"error": f"Cannot open file: {e}"}, 404
+        if etag != file_etag(st):
+            return {"error": "The file was changed by someone else; reload to see the new version",
+                    "etag": file_etag(st), "size": st.st_size}, 409
+        pos = 0
+        for offset, length, _ in patches:
+            if offset < pos or length < 0 or offset + length > st.st_size:
+                return {"error": "Patches overlap or leave the file"}, 400
+            pos = offset + length
+        if patches:
+            try:
+                st = write_patched(abs_path, patches)
+            except OSError as e:
+                return {"error": f"Error saving file: {e}"}, 500
+    return {"etag": file_etag(st), "size": st.st_size}, 200, {"ETag": file_etag(st)}
 
-    return render_template_string("""
+EDITOR_PAGE = """
 <!DOCTYPE html>
 <html lang="en">
 <head>
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Pro IDE | {{ file.split('/')[-1] }}</title>
-    <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css">
-    <script src="https://cdnjs.cloudflare.com/ajax/libs/ace/1.23.0/ace.js"></script>
+    <link rel="stylesheet" href="{{ fa_css }}">
+    <script src="{{ ace_js }}"></script>
     <style>
         :root {
             --bg-dark: #0d1117;
@@ -648,9 +5240,12 @@ def edit(sid):
             background: var(--card-bg);
             border-top: 1px solid var(--border);
             display: flex;
-            justify-content: flex-end;
+            justify-content: space-between;
+            align-items: center;
         }
 
+        #status { font-size: 14px; }
+
         .btn-save {
             background: #238636;
             color: white;
@@ -663,6 +5258,7 @@ def edit(sid):
         }
 
         .btn-save:hover { background: #2ea043; }
+        .btn-save:disabled { background: #30363d; cursor: default; }
     </style>
 </head>
 <body>
@@ -676,24 +5272,23 @@ def edit(sid):
     </div>
 </div>
 
-<div id="editor">{{ code }}</div>
+<div id="editor"></div>
 
-<form id="saveForm" method="post">
-    <input type="hidden" name="code" id="hiddenCode">
-    <div class="footer">
-        <button type="button" onclick="saveData()" class="btn-save">
-            <i class="fas fa-cloud-upload-alt"></i> SAVE CHANGES
-        </button>
-    </div>
-</form>
+<div class="footer">
+    <span id="status">Loading...</span>
+    <button type="button" id="saveBtn" onclick="saveData()" class="btn-save" disabled>
+        <i class="fas fa-cloud-upload-alt"></i> SAVE CHANGES
+    </button>
+</div>
 
 <script>
     // Ace Editor Setup
+    {% if ace_base %}ace.config.set("basePath", {{ ace_base|tojson }});{% endif %}
     var editor = ace.edit("editor");
     editor.setTheme("ace/theme/one_dark"); // Premium Dark Theme
     
     // File Extension ke hisaab se mode set karna
-    var filename = "{{ file }}";
+    var filename = {{ file|tojson }};
     var ext = filename.split('.').pop().toLowerCase();
     
     if(ext === 'py') editor.session.setMode("ace/mode/python");
@@ -712,28 +5307,105 @@ def edit(sid):
         tabSize: 4
     });
 
-    // Save Function
+    // Lazy loading: `base` is the loaded part of the file as last saved,
+    // covering bytes [0, loaded) of the version named by `etag`
+    var api = "/edit/{{ sid }}/";
+    var auth = "admin_id={{ admin_id|urlencode }}";
+    var chunk = {{ chunk }};
+    var size = {{ size }}, loaded = 0, etag = null, base = "", loading = false;
+    var status = document.getElementById('status');
+    var utf8 = new TextEncoder();
+
+    function bytes(text) { return utf8.encode(text).length; }
+
+    function showProgress() {
+        status.textContent = loaded >= size ? "Loaded " + size + " bytes"
+            : "Loaded " + loaded + " of " + size + " bytes (scroll down for more)";
+    }
+
+    function loadMore() {
+        if (loading || (etag !== null && loaded >= size)) return;
+        loading = true;
+        fetch(api + "range?offset=" + loaded + "&length=" + chunk + "&" + auth)
+            .then(function (r) { return r.json().then(function (j) { return [r.status, j]; }); })
+            .then(function (res) {
+                loading = false;
+                var j = res[1];
+                if (res[0] !== 200) { status.textContent = "❌ " + j.error; return; }
+                if (etag !== null && j.etag !== etag) {
+                    status.textContent = "❌ The file changed on disk, reload the page";
+                    return;
+                }
+                etag = j.etag; size = j.size; loaded = j.eof ? size : j.next;
+                base += j.data;
+                var last = editor.session.getLength() - 1;
+                editor.session.insert({row: last, column: editor.session.getLine(last).length}, j.data);
+                if (editor.session.getUndoManager) editor.session.getUndoManager().reset();
+                document.getElementById('saveBtn').disabled = false;
+                showProgress();
+            })
+            .catch(function (e) { loading = false; status.textContent = "❌ " + e; });
+    }
+
+    // Fetch the next chunk when the view nears the end of what is loaded
+    editor.session.on("changeScrollTop", function () {
+        if (editor.renderer.getLastVisibleRow() > editor.session.getLength() - 50) loadMore();
+    });
+
+    // Save Function: one patch covering everything between the unchanged head and tail
     function saveData() {
-        document.getElementById('hiddenCode').value = editor.getValue();
-        document.getElementById('saveForm').submit();
+        var text = editor.getValue();
+        var head = 0, max = Math.min(text.length, base.length);
+        while (head < max && text.charCodeAt(head) === base.charCodeAt(head)) head++;
+        var tail = 0;
+        while (tail < max - head && text.charCodeAt(text.length - 1 - tail) === base.charCodeAt(base.length - 1 - tail)) tail++;
+        // Never split a surrogate pair
+        if (head > 0 && (base.charCodeAt(head - 1) & 0xFC00) === 0xD800) head--;
+        if (tail > 0 && (base.charCodeAt(base.length - tail) & 0xFC00) === 0xDC00) tail--;
+
+        var removed = base.slice(head, base.length - tail);
+        var added = text.slice(head, text.length - tail);
+        var patches = (removed || added) ? [{offset: bytes(base.slice(0, head)), length: bytes(removed), data: added}] : [];
+        status.textContent = "Saving...";
+        fetch(api + "save?" + auth, {
+            method: "POST",
+            headers: {"Content-Type": "application/json", "If-Match": etag},
+            body: JSON.stringify({etag: etag, patches: patches})
+        })
+            .then(function (r) { return r.json().then(function (j) { return [r.status, j]; }); })
+            .then(function (res) {
+                var j = res[1];
+                if (res[0] !== 200) { status.textContent = "❌ " + j.error; return; }
+                loaded += j.size - size;
+                etag = j.etag; size = j.size; base = text;
+                status.textContent = "✅ Saved (" + bytes(added) + " bytes sent)";
+            })
+            .catch(function (e) { status.textContent = "❌ " + e; });
     }
+
+    editor.commands.addCommand({
+        name: "save", bindKey: {win: "Ctrl-S", mac: "Command-S"},
+        exec: saveData
+    });
+
+    loadMore();
 </script>
 
 </body>
 </html>
-""", code=code, file=file)
+"""
+
+EDITOR_TEMPLATE = app.jinja_env.from_string(EDITOR_PAGE)
 
 # ================= HOME PAGE =================
-@app.route('/')
-def home():
-    return """
+HOME_PAGE = """
 <!DOCTYPE html>
 <html lang="en">
 <head>
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Termux Pro | Active</title>
-    <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css">
+    <link rel="stylesheet" href="{{ fa_css }}">
     <style>
         * { margin: 0; padding: 0; box-sizing: border-box; }
         
@@ -871,7 +5543,221 @@ def home():
 </body>
 </html>
 """
-    
+
+# Rendered once: the page only changes with the asset version
+home_body = StaticBody(app.jinja_env.from_string(HOME_PAGE).render(
+    fa_css=asset_url("font-awesome/css/all.min.css")).encode(), "text/html")
+
+@app.route('/')
+def home():
+    return home_body.response("public, max-age=300")
+
+# ================= WEBHOOK =================
+class UpdateFeeder:
+    """
+    Bounded queue between the webhook route and the bot handlers, so the
+    route can answer Telegram at once. When the queue is full the update is
+    refused with 503 and Telegram delivers it again later. One thread hands
+    the updates on in arrival order; ChatOrderedBot only queues them in the
+    chat's lane, and its workers run the handlers.
+    """
+
+    def __init__(self, size=WEBHOOK_QUEUE):
+        self.queue = queue.Queue(maxsize=size)
+        self.received = 0
+        self.rejected = 0
+        threading.Thread(target=self._work, name="webhook", daemon=True).start()
+
+    def submit(self, update):
+        try:
+            self.queue.put_nowait(update)
+        except queue.Full:
+            self.rejected += 1
+            return False
+        self.received += 1
+        return True
+
+    def _work(self):
+        while True:
+            update = self.queue.get()
+            try:
+                bot.process_new_updates([update])
+            except Exception as e:
+                print(f"⚠️ Update {update.update_id} failed: {e}")
+
+webhook_feeder = UpdateFeeder()
+
+@app.route("/webhook/<secret>", methods=["POST"])
+def webhook(secret):
+    # Telegram sends the secret back in a header as well; both must match
+    header = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not (hmac.compare_digest(secret, WEBHOOK_SECRET) and hmac.compare_digest(header, WEBHOOK_SECRET)):
+        return "Forbidden", 403
+    try:
+        update = types.Update.de_json(request.get_data(as_text=True))
+    except (ValueError, KeyError, TypeError):
+        return "Bad Request", 400
+    if not webhook_feeder.submit(update):
+        return "Busy", 503
+    return "", 200
+
+def run_polling():
+    # getUpdates fails while a webhook is set
+    try:
+        bot.remove_webhook()
+    except Exception as e:
+        print(f"⚠️ Cannot remove webhook: {e}")
+    while True:
+        try:
+            bot.infinity_polling(timeout=60, long_polling_timeout=60)
+        except Exception as e:
+            print(f"⚠️ Bot error: {e}. Retrying in 5 seconds...")
+            time.sleep(5)
+
+async def poll_async():
+    """Long polling as a coroutine on the reactor loop (ENGINE=asyncio); handlers still run in the chat lanes."""
+    try:
+        await async_bot.delete_webhook()
+    except Exception as e:
+        print(f"⚠️ Cannot remove webhook: {e}")
+    offset = None
+    while True:
+        try:
+            updates = await async_bot.get_updates(offset=offset, timeout=60, request_timeout=API_READ_TIMEOUT + 60)
+        except Exception as e:
+            print(f"⚠️ Bot error: {e}. Retrying in 5 seconds...")
+            await asyncio.sleep(5)
+            continue
+        if updates:
+            offset = updates[-1].update_id + 1
+            bot.process_new_updates(updates)  # only queues them in the chat lanes
+
+def start_bot():
+    """Receive updates through the webhook when WEBHOOK_URL is set, by long polling otherwise."""
+    search_index.start()
+    if WEBHOOK_URL:
+        try:
+            bot.set_webhook(url=f"{WEBHOOK_URL.rstrip('/')}/webhook/{WEBHOOK_SECRET}",
+                            secret_token=WEBHOOK_SECRET, max_connections=WEBHOOK_MAX_CONNECTIONS,
+                            allowed_updates=["message", "callback_query"])
+            print(f"🔗 Webhook registered at {WEBHOOK_URL}")
+            return "webhook"
+        except Exception as e:
+            print(f"⚠️ Webhook setup failed: {e}. Falling back to polling.")
+    if ENGINE == "asyncio":
+        print("🤖 Starting Telegram bot (asyncio polling)...")
+        reactor.submit(poll_async())
+        return "polling"
+    print("🤖 Starting Telegram bot (polling)...")
+    threading.Thread(target=run_polling, name="bot-polling", daemon=True).start()
+    return "polling"
+
+def create_app():
+    """Entry point for gunicorn ("app:create_app()"): one process serves the editor and the bot."""
+    start_bot()
+    return app
+
+# ================= ASYNC WEB SERVER =================
+class AsyncWsgiServer:
+    """
+    Serves the Flask app from the reactor loop (ENGINE=asyncio). aiohttp owns
+    the sockets, so idle keep-alive and slow connections cost no thread; each
+    request runs the app on one of WEB_WORKERS threads, and the response body
+    is pulled from it on those threads too, so a large file never blocks the
+    loop.
+    """
+
+    HOP_BY_HOP = {"connection", "keep-alive", "transfer-encoding"}
+    PULL_SIZE = 64 * 1024  # response bytes gathered per trip to a worker thread
+
+    def __init__(self, wsgi_app, workers=WEB_WORKERS):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="web")
+
+    async def serve(self, port, host="0.0.0.0"):
+        server = web.Application(client_max_size=WEB_MAX_BODY)
+        server.router.add_route("*", "/{path:.*}", self.handle)
+        runner = web.AppRunner(server, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+
+    @staticmethod
+    def _environ(request, body):
+        raw_path = request.raw_path.split("?", 1)[0]
+        server_name, server_port = (request.transport.get_extra_info("sockname") or ("", 0))[:2]
+        environ = {
+            "REQUEST_METHOD": request.method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": urllib.parse.unquote_to_bytes(raw_path).decode("latin-1"),
+            "QUERY_STRING": request.query_string,
+            "CONTENT_TYPE": request.headers.get("Content-Type", ""),
+            "CONTENT_LENGTH": str(len(body)),
+            "SERVER_NAME": str(server_name),
+            "SERVER_PORT": str(server_port),
+            "SERVER_PROTOCOL": f"HTTP/{request.version.major}.{request.version.minor}",
+            "REMOTE_ADDR": request.remote or "",
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": request.scheme,
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        for name, value in request.headers.items():
+            key = "HTTP_" + name.upper().replace("-", "_")
+            if key in ("HTTP_CONTENT_TYPE", "HTTP_CONTENT_LENGTH"):
+                continue
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+    def _pull(self, chunks):
+        """Next PULL_SIZE bytes or so of the body, b"" at its end. Worker thread."""
+        data = []
+        size = 0
+        for chunk in chunks:
+            data.append(chunk)
+            size += len(chunk)
+            if size >= self.PULL_SIZE:
+                break
+        return b"".join(data)
+
+    async def handle(self, request):
+        body = await request.read()
+        environ = self._environ(request, body)
+        started = []
+        written = []  # through the legacy write() callable
+
+        def start_response(status, headers, exc_info=None):
+            started[:] = [status, headers]
+            return written.append
+
+        def call():
+            result = self.wsgi_app(environ, start_response)
+            chunks = iter(result)
+            # start_response may only be called once the first chunk is asked for
+            return result, chunks, self._pull(chunks)
+
+        loop = asyncio.get_running_loop()
+        result, chunks, data = await loop.run_in_executor(self.executor, call)
+        try:
+            status, headers = started
+            response = web.StreamResponse(status=int(status[:3]), reason=status[4:])
+            for name, value in headers:
+                if name.lower() not in self.HOP_BY_HOP:
+                    response.headers.add(name, value)
+            await response.prepare(request)
+            for chunk in written:
+                await response.write(chunk)
+            while data:
+                await response.write(data)
+                data = await loop.run_in_executor(self.executor, self._pull, chunks)
+            await response.write_eof()
+            return response
+        finally:
+            if hasattr(result, "close"):
+                await loop.run_in_executor(self.executor, result.close)
+
 # ================= START SERVER =================
 if __name__ == "__main__":
     print("🤖 Starting Termux Controller Pro...")
@@ -897,26 +5783,21 @@ if __name__ == "__main__":
         except Exception as e:
             print(f"⚠️ Flask server error: {e}")
     
-    # Start bot in a separate thread
-    def run_bot():
-        print("🤖 Starting Telegram bot...")
-        while True:
-            try:
-                bot.infinity_polling(timeout=60, long_polling_timeout=60)
-            except Exception as e:
-                print(f"⚠️ Bot error: {e}. Retrying in 5 seconds...")
-                time.sleep(5)
-    
-    # Start both services
-    flask_thread = threading.Thread(target=run_flask, daemon=True)
-    bot_thread = threading.Thread(target=run_bot, daemon=True)
-    
-    flask_thread.start()
-    bot_thread.start()
+    # Start both services; the bot uses the webhook served by Flask or polls
+    if ENGINE == "asyncio":
+        print(f"🚀 Starting web server on port {PORT} (asyncio)...")
+        reactor.submit(AsyncWsgiServer(app).serve(PORT)).result()
+        flask_thread = None
+    else:
+        flask_thread = threading.Thread(target=run_flask, daemon=True)
+        flask_thread.start()
+    start_bot()
     
     # Keep main thread alive
     try:
-        flask_thread.join()
-        bot_thread.join()
+        if flask_thread is not None:
+            flask_thread.join()
+        else:
+            threading.Event().wait()
     except KeyboardInterrupt:
         print("\n👋 Shutting down...")
@@ -0,0 +1,134 @@
+# ================= OUTBOUND DISPATCHER BENCHMARK =================
+# Synthetic load: N chats stream bulk output faster than Telegram allows,
+# against a fake client that enforces the Bot API flood limits with 429s.
+# Meanwhile every chat presses a button once a second; the callback answers
+# only count against the global limit and should come back right away.
+# The first [uploads] chats also send slow documents back to back, which
+# must not hold up the other chats or the answers.
+#
+#   python benchmarks/bench_dispatcher.py [chats] [seconds] [uploads]
+
+import os
+import sys
+import threading
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+os.environ.setdefault("MAIN_ADMIN_ID", "1")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import app  # noqa: E402
+from telebot.apihelper import ApiTelegramException  # noqa: E402
+
+API_LATENCY = 0.05
+UPLOAD_LATENCY = 3  # a large document over a slow uplink
+GLOBAL_PER_SEC = 30
+CHAT_PER_SEC = 1
+CHAT_BURST = 3
+
+
+class FakeTelegram:
+    """Accepts calls like the Bot API and answers 429 when a limit is exceeded."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.global_bucket = app.TokenBucket(GLOBAL_PER_SEC, GLOBAL_PER_SEC)
+        self.chat_buckets = {}
+        self.ok = 0
+        self.limited = 0
+
+    def _check(self, chat_id):
+        now = time.monotonic()
+        with self.lock:
+            chat = None
+            if chat_id is not None:
+                chat = self.chat_buckets.setdefault(chat_id, app.TokenBucket(CHAT_PER_SEC, CHAT_BURST))
+            if self.global_bucket.wait_time(now) > 0 or (chat and chat.wait_time(now) > 0):
+                self.limited += 1
+                raise ApiTelegramException("sendMessage", None, {
+                    "ok": False, "error_code": 429, "description": "Too Many Requests",
+                    "parameters": {"retry_after": 1}})
+            self.global_bucket.take()
+            if chat:
+                chat.take()
+            self.ok += 1
+
+    def send_message(self, chat_id, text, **kwargs):
+        time.sleep(API_LATENCY)
+        self._check(chat_id)
+        return None
+
+    def send_document(self, chat_id, document, **kwargs):
+        time.sleep(UPLOAD_LATENCY)
+        self._check(chat_id)
+        return None
+
+    def answer_callback_query(self, callback_query_id, text=None):
+        time.sleep(API_LATENCY)
+        self._check(None)
+        return True
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0.0
+
+
+def main():
+    chats = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    uploads = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+
+    fake = FakeTelegram()
+    dispatcher = app.OutboundDispatcher(fake)
+    stop = time.monotonic() + seconds
+
+    def producer(chat_id):
+        while time.monotonic() < stop:
+            dispatcher.submit("send_message", chat_id, text="x" * 100)
+            time.sleep(0.2)  # 5 msg/s per chat, far above the limit
+
+    uploaded = []
+
+    def uploader(chat_id):
+        while time.monotonic() < stop:
+            dispatcher.submit("send_document", chat_id, wait=True, transfer=True, document=b"x")
+            uploaded.append(chat_id)
+
+    answer_latency = []
+
+    def clicker(chat_id):
+        while time.monotonic() < stop:
+            pressed = time.monotonic()
+            dispatcher.submit("answer_callback_query", priority=app.PRIORITY_INTERACTIVE,
+                              on_done=lambda _, pressed=pressed: answer_latency.append(time.monotonic() - pressed),
+                              callback_query_id=str(chat_id))
+            time.sleep(1)
+
+    threads = [threading.Thread(target=producer, args=(c,)) for c in range(chats)]
+    threads += [threading.Thread(target=clicker, args=(c,)) for c in range(chats)]
+    threads += [threading.Thread(target=uploader, args=(c,)) for c in range(min(uploads, chats))]
+    start = time.monotonic()
+    for t in threads:
+        t.start()
+    depth = []
+    while time.monotonic() < stop:
+        time.sleep(1)
+        depth.append(dispatcher.stats()["queued"])
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic() - start
+
+    stats = dispatcher.stats()
+    print(f"chats={chats} seconds={seconds:.0f} uploading={min(uploads, chats)}")
+    print(f"delivered:   {fake.ok} ({fake.ok / elapsed:.1f}/s, ceiling {GLOBAL_PER_SEC}/s)")
+    print(f"uploads:     {len(uploaded)}")
+    print(f"429 replies: {fake.limited}")
+    print(f"dropped:     {stats['dropped']}")
+    print(f"queue depth: max {max(depth)}, last {depth[-1]}")
+    print(f"callback answers: {len(answer_latency)}, p50 {percentile(answer_latency, 50) * 1000:.0f}ms,"
+          f" p99 {percentile(answer_latency, 99) * 1000:.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+# ================= END-TO-END BENCHMARK =================
+# Runs the real bot (python app.py) against the fake Bot API in
+# fake_bot_api.py and simulates N chats, each cycling through
+#
+#   command   a one-shot command, until its output shows up in the chat
+#   button    the "status" button, until the callback is answered
+#   stdin     a command that prompts, then the reply, until it is echoed
+#
+# Reports end-to-end latency percentiles per operation, Bot API calls per
+# operation, and the bot's threads, open fds and RSS over time. The bot
+# keeps its own outbound pacing (~1 msg/s per chat); OUTBOUND_* and other
+# settings in the environment are passed through to it.
+#
+#   python benchmarks/bench_e2e.py [--chats 20] [--rounds 5] [--webhook]
+#                                  [--latency 30] [--p429 0.02] [--engine asyncio]
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_bot_api import FakeBotApi  # noqa: E402
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app.py")
+CHAT_BASE = 70_000
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0.0
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def proc_sample(pid):
+    """(threads, open fds, RSS in kB) of a live process."""
+    threads = rss = 0
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("Threads:"):
+                threads = int(line.split()[1])
+            elif line.startswith("VmRSS:"):
+                rss = int(line.split()[1])
+    return threads, len(os.listdir(f"/proc/{pid}/fd")), rss
+
+
+def start_bot(api, workdir, args):
+    """Starts app.py in workdir against api; returns (process, chat ids, web port)."""
+    chats = [CHAT_BASE + n for n in range(args.chats)]
+    with open(os.path.join(workdir, "bot_data.json"), "w") as f:
+        json.dump({"admins": chats}, f)  # migrated into the state DB on start
+    port = free_port()
+    env = dict(os.environ,
+               BOT_TOKEN="123456:e2e", MAIN_ADMIN_ID=str(CHAT_BASE), PORT=str(port),
+               BOT_API_URL=api.url, ENGINE=args.engine, WEBHOOK_URL="",
+               MAX_RUNNING_COMMANDS=str(args.chats * 2), MAX_QUEUED_COMMANDS=str(args.chats * 4),
+               INGRESS_DEDUP_WINDOW="0", INGRESS_CHAT_RATE="100", INGRESS_CHAT_BURST="100",
+               INGRESS_USER_RATE="100", INGRESS_USER_BURST="100", PYTHONUNBUFFERED="1")
+    if args.webhook:
+        env["WEBHOOK_URL"] = f"http://127.0.0.1:{port}"
+    log = open(os.path.join(workdir, "bot.log"), "w")
+    proc = subprocess.Popen([sys.executable, os.path.abspath(APP)], cwd=workdir, env=env,
+                            stdout=log, stderr=subprocess.STDOUT)
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"bot exited with {proc.returncode}, see {log.name}")
+        if (api.webhook if args.webhook else api.calls["getUpdates"]):
+            return proc, chats, port
+        time.sleep(0.05)
+    proc.kill()
+    raise SystemExit(f"bot did not start polling within 30s, see {log.name}")
+
+
+def simulate_chat(api, chat_id, rounds, timeout, results, lock):
+    def record(op, started, ok):
+        with lock:
+            if ok:
+                results[op].append(time.monotonic() - started)
+            else:
+                results["timeouts"].append(op)
+
+    for n in range(rounds):
+        token = f"{chat_id}-{n}"
+
+        # The command text itself never contains "out-<token>", only its output does
+        started = time.monotonic()
+        api.push_message(chat_id, f"printf 'out-%s\\n' {token}")
+        record("command", started, api.wait_for(lambda: api.chat_contains(chat_id, f"out-{token}"), timeout))
+
+        started = time.monotonic()
+        query_id = api.push_callback(chat_id, "status")
+        record("button", started, api.wait_for(lambda: query_id in api.answered, timeout))
+
+        api.push_message(chat_id, f"read -p 'name-{token}? ' x; echo hello-$x")
+        if not api.wait_for(lambda: api.chat_contains(chat_id, f"name-{token}?"), timeout):
+            record("stdin", 0, False)
+            continue
+        started = time.monotonic()
+        api.push_message(chat_id, f"r{token}")
+        record("stdin", started, api.wait_for(lambda: api.chat_contains(chat_id, f"hello-r{token}"), timeout))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end load test against the fake Bot API")
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--webhook", action="store_true", help="receive updates through the webhook")
+    parser.add_argument("--engine", default="threads", choices=("threads", "asyncio"))
+    parser.add_argument("--latency", type=float, default=0, help="ms added to every Bot API call")
+    parser.add_argument("--jitter", type=float, default=0, help="random ms on top of --latency")
+    parser.add_argument("--p429", type=float, default=0, help="chance of a 429 per send")
+    parser.add_argument("--chat-rate", type=float, default=0, help="sends per second per chat before 429s")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds to wait for each operation")
+    parser.add_argument("--keep", action="store_true", help="keep the bot's working directory and log")
+    args = parser.parse_args()
+
+    api = FakeBotApi(latency=args.latency / 1000, jitter=args.jitter / 1000,
+                     p429=args.p429, chat_rate=args.chat_rate).start()
+    workdir = tempfile.mkdtemp(prefix="bot-e2e-")
+    proc, chats, _ = start_bot(api, workdir, args)
+    print(f"{args.chats} chats x {args.rounds} rounds, {'webhook' if args.webhook else 'polling'}, "
+          f"engine {args.engine}, API latency {args.latency:.0f}+{args.jitter:.0f} ms, p429 {args.p429}")
+
+    samples = []
+    done = threading.Event()
+
+    def sampler():
+        t0 = time.monotonic()
+        while not done.is_set():
+            try:
+                samples.append((time.monotonic() - t0, *proc_sample(proc.pid)))
+            except OSError:
+                return
+            done.wait(0.5)
+
+    results = defaultdict(list)
+    lock = threading.Lock()
+    threading.Thread(target=sampler, daemon=True).start()
+    calls_before = api.total_calls()
+    started = time.monotonic()
+    users = [threading.Thread(target=simulate_chat, args=(api, chat_id, args.rounds, args.timeout, results, lock))
+             for chat_id in chats]
+    for thread in users:
+        thread.start()
+    for thread in users:
+        thread.join()
+    elapsed = time.monotonic() - started
+    calls = api.total_calls() - calls_before
+    done.set()
+
+    proc.terminate()
+    try:
+        proc.wait(10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+    api.stop()
+
+    ops = sum(len(results[op]) for op in ("command", "button", "stdin"))
+    print(f"\n{ops} operations in {elapsed:.2f}s ({ops / elapsed:.1f}/s), {len(results['timeouts'])} timed out")
+    print(f"{'operation':<10}{'count':>7}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}")
+    for op in ("command", "button", "stdin"):
+        values = results[op]
+        print(f"{op:<10}{len(values):>7}" + "".join(f"{percentile(values, p) * 1000:>8.1f}ms" for p in (50, 90, 99))
+              + f"{max(values, default=0) * 1000:>8.1f}ms")
+
+    print(f"\nBot API calls: {calls} ({calls / max(1, ops):.2f} per operation), {api.rate_limited} answered 429")
+    for method, count in sorted(api.calls.items(), key=lambda item: -item[1]):
+        print(f"   {method:<22}{count:>7}")
+
+    print(f"\n{'t':>6}{'threads':>9}{'fds':>7}{'RSS':>10}")
+    step = max(1, len(samples) // 12)
+    for t, threads, fds, rss in samples[::step]:
+        print(f"{t:>5.1f}s{threads:>9}{fds:>7}{rss / 1024:>8.1f}MB")
+    if samples:
+        print(f"{'peak':>6}{max(s[1] for s in samples):>9}{max(s[2] for s in samples):>7}"
+              f"{max(s[3] for s in samples) / 1024:>8.1f}MB")
+
+    if args.keep:
+        print(f"\nBot log and state kept in {workdir}")
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+# ================= EDITOR BENCHMARK =================
+# Opens and saves files of growing size through the editor endpoints
+# (Flask test client): page load, first range read, and a one-line patch
+# save. Open cost should not grow with the file; the save copies the
+# unchanged bytes kernel-side, so it grows far slower than the file.
+#
+#   python benchmarks/bench_editor.py [max MB]
+
+import os
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+os.environ.setdefault("MAIN_ADMIN_ID", "1")
+os.environ.setdefault("STATE_DB", ":memory:")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import app  # noqa: E402
+
+LINE = "2024-01-01 12:00:00 INFO worker-7 processed request id=42 in 3.1ms\n"
+
+
+def timed(fn, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - started)
+    return best * 1000, result
+
+
+def main():
+    max_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    workdir = tempfile.mkdtemp(prefix="bench-editor-", dir=app.BASE_DIR)
+    client = app.app.test_client()
+    auth = f"admin_id={app.MAIN_ADMIN_ID}"
+    print(f"{'size':>8}{'page':>10}{'1st range':>11}{'save':>10}")
+    mb = 1
+    while mb <= max_mb:
+        path = os.path.join(workdir, f"{mb}mb.log")
+        with open(path, "w") as f:
+            f.write(LINE * (mb * 1024 * 1024 // len(LINE)))
+        sid = app.registry.add_edit(path, app.MAIN_ADMIN_ID)
+
+        page, _ = timed(lambda: client.get(f"/edit/{sid}?{auth}"))
+        first, response = timed(lambda: client.get(f"/edit/{sid}/range?offset=0&{auth}"))
+        etag = response.json["etag"]
+
+        def save():
+            nonlocal etag
+            response = client.post(f"/edit/{sid}/save?{auth}", json={
+                "etag": etag, "patches": [{"offset": len(LINE) * 10, "length": 4, "data": "2025"}]})
+            etag = response.json["etag"]
+        saved, _ = timed(save)
+
+        print(f"{mb:>6}MB{page:>8.2f}ms{first:>9.2f}ms{saved:>8.2f}ms")
+        os.remove(path)
+        mb *= 4
+    os.rmdir(workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+# ================= ENGINE BENCHMARK =================
+# The same load under ENGINE=threads and then ENGINE=asyncio, side by side.
+# The real bot (python app.py) runs against the fake Bot API in
+# fake_bot_api.py with a slow link (--latency ms per call), and
+#
+#   - N chats each go through one bench_e2e round: a command, the status
+#     button, and a prompt that keeps a PTY session open until answered
+#   - M web clients hold connections to the editor's port that never finish
+#     their request, like phones on a bad link
+#
+# Reports per engine the operation latencies, Bot API calls per second, and
+# the bot's peak threads, RSS and CPU time.
+#
+#   python benchmarks/bench_engines.py [--chats 200] [--idle 200] [--latency 300]
+
+import argparse
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import types
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_e2e import percentile, proc_sample, simulate_chat, start_bot  # noqa: E402
+from fake_bot_api import FakeBotApi  # noqa: E402
+
+
+def cpu_seconds(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def hold_connections(port, count):
+    """count sockets that sent half a request line and then go quiet."""
+    sockets = []
+    for _ in range(count):
+        sock = socket.create_connection(("127.0.0.1", port))
+        sock.sendall(b"GET / HTTP/1.1\r\nHost: 127.0.0.1\r\n")
+        sockets.append(sock)
+    return sockets
+
+
+def run(engine, args):
+    api = FakeBotApi(latency=args.latency / 1000).start()
+    workdir = tempfile.mkdtemp(prefix=f"bench-engines-{engine}-")
+    options = types.SimpleNamespace(chats=args.chats, webhook=False, engine=engine)
+    proc, chats, port = start_bot(api, workdir, options)
+
+    samples = []
+    done = threading.Event()
+
+    def sampler():
+        while not done.is_set():
+            try:
+                samples.append(proc_sample(proc.pid))
+            except OSError:
+                return
+            done.wait(0.25)
+
+    threading.Thread(target=sampler, daemon=True).start()
+    try:
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port)).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise SystemExit(f"{engine}: web server did not come up on port {port}")
+                time.sleep(0.1)
+        idle = hold_connections(port, args.idle)
+
+        results = defaultdict(list)
+        lock = threading.Lock()
+        cpu_before = cpu_seconds(proc.pid)
+        calls_before = api.total_calls()
+        started = time.monotonic()
+        users = [threading.Thread(target=simulate_chat, args=(api, chat_id, 1, args.timeout, results, lock))
+                 for chat_id in chats]
+        for thread in users:
+            thread.start()
+        for thread in users:
+            thread.join()
+        elapsed = time.monotonic() - started
+        cpu = cpu_seconds(proc.pid) - cpu_before
+        calls = api.total_calls() - calls_before
+        for sock in idle:
+            sock.close()
+    finally:
+        done.set()
+        proc.terminate()
+        proc.wait(10)
+        api.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "elapsed": elapsed, "cpu": cpu, "calls": calls, "timeouts": len(results["timeouts"]),
+        "ops": {op: results[op] for op in ("command", "button", "stdin")},
+        "threads": max(s[0] for s in samples), "fds": max(s[1] for s in samples),
+        "rss": max(s[2] for s in samples) / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Threaded vs asyncio engine under the same load")
+    parser.add_argument("--chats", type=int, default=200)
+    parser.add_argument("--idle", type=int, default=200, help="web connections held open without a request")
+    parser.add_argument("--latency", type=float, default=300, help="ms added to every Bot API call")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds to wait for each operation")
+    args = parser.parse_args()
+
+    print(f"{args.chats} chats, {args.idle} idle web connections, API latency {args.latency:.0f} ms")
+    results = {engine: run(engine, args) for engine in ("threads", "asyncio")}
+
+    print(f"\n{'':<22}" + "".join(f"{engine:>14}" for engine in results))
+    for op in ("command", "button", "stdin"):
+        for p in (50, 99):
+            print(f"{op + f' p{p}':<22}" + "".join(f"{percentile(r['ops'][op], p) * 1000:>12.0f}ms"
+                                                  for r in results.values()))
+    rows = [
+        ("timed out", lambda r: f"{r['timeouts']}"),
+        ("wall time", lambda r: f"{r['elapsed']:.1f}s"),
+        ("Bot API calls/s", lambda r: f"{r['calls'] / r['elapsed']:.1f}"),
+        ("bot CPU", lambda r: f"{r['cpu']:.2f}s"),
+        ("peak threads", lambda r: f"{r['threads']}"),
+        ("peak fds", lambda r: f"{r['fds']}"),
+        ("peak RSS", lambda r: f"{r['rss']:.1f}MB"),
+    ]
+    for label, cell in rows:
+        print(f"{label:<22}" + "".join(f"{cell(r):>14}" for r in results.values()))
+
+
+if __name__ == "__main__":
+    main()
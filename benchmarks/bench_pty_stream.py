@@ -0,0 +1,167 @@
+# ================= PTY TEXT STREAM BENCHMARK =================
+# Bytes sent to Telegram per byte read from the PTY, old pipeline
+# (decode each 1 KB read, one message per read) vs PtyTextStream +
+# OutputAggregator (decode, strip escapes, collapse \r, edit one message).
+#
+#   python benchmarks/bench_pty_stream.py [capture.bin ...]
+#   python benchmarks/bench_pty_stream.py --record out.bin -- apt-get install -y foo
+#
+# Without arguments it runs on built-in captures shaped like apt, pip and
+# git clone output. Spilling to a document is turned off to compare messages.
+
+import os
+import pty
+import random
+import sys
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+os.environ.setdefault("MAIN_ADMIN_ID", "1")
+os.environ["OUTPUT_SPILL_THRESHOLD"] = "0"
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import app  # noqa: E402
+
+CHUNKS_PER_SECOND = 200  # arrival rate used to place flush windows
+
+
+def capture_apt():
+    out = []
+    for i in range(1, 121):
+        pkg = f"lib{'ü' if i % 7 == 0 else 'u'}package{i}"
+        out.append(f"Get:{i} http://deb.debian.org/debian bookworm/main amd64 {pkg} 1.{i}-1 [{i * 13} kB]\n")
+        for pct in range(0, 101, 5):
+            out.append(f"\r{pct}% [{i} {pkg} {i * 13 * pct // 100} kB/{i * 13} kB {pct}%]\x1b[K")
+        out.append("\r\x1b[K")
+    for i in range(1, 121):
+        out.append(f"Unpacking libupackage{i} (1.{i}-1) ...\n")
+        out.append(f"\x1b7\x1b[24;0f\x1b[42m\x1b[30mProgress: [{i * 100 // 120:3d}%]\x1b[49m\x1b[39m "
+                   f"[{'#' * (i // 4)}{'.' * (30 - i // 4)}] \x1b8")
+    return "".join(out).encode()
+
+
+def capture_pip():
+    out = []
+    for i in range(1, 41):
+        out.append(f"Collecting package-{i}==2.{i}.0\n  Downloading package_{i}-2.{i}.0-py3-none-any.whl (3.4 MB)\n")
+        for step in range(0, 41):
+            done = "━" * step
+            todo = "╺" + "━" * (40 - step) if step < 40 else ""
+            out.append(f"\r\x1b[2K     \x1b[38;2;114;156;31m{done}\x1b[0m\x1b[38;5;237m{todo}\x1b[0m "
+                       f"\x1b[32m{3.4 * step / 40:.1f}/3.4 MB\x1b[0m \x1b[31m5.6 MB/s\x1b[0m "
+                       f"eta \x1b[36m0:00:0{(40 - step) // 10}\x1b[0m")
+        out.append("\n")
+    out.append("Installing collected packages: " + ", ".join(f"package-{i}" for i in range(1, 41)) + "\n")
+    out.append("Successfully installed " + " ".join(f"package-{i}-2.{i}.0" for i in range(1, 41)) + "\n")
+    return "".join(out).encode()
+
+
+def capture_git_clone():
+    out = ["Cloning into 'linux'...\n"]
+    total = 8000
+    for phase, unit in (("Counting objects", False), ("Compressing objects", False),
+                        ("Receiving objects", True), ("Resolving deltas", False)):
+        for n in range(0, total + 1, 20):
+            pct = n * 100 // total
+            line = f"\rremote: {phase}: {pct:3d}% ({n}/{total})" if "Counting" in phase or "Compressing" in phase \
+                else f"\r{phase}: {pct:3d}% ({n}/{total})"
+            if unit:
+                line += f", {n * 0.0125:.2f} MiB | 2.40 MiB/s"
+            out.append(line)
+        out.append(", done.\n")
+    return "".join(out).encode()
+
+
+BUILTIN = {"apt": capture_apt, "pip": capture_pip, "git clone": capture_git_clone}
+
+
+def chunked(data, max_size, seed=1):
+    rnd = random.Random(seed)
+    i = 0
+    while i < len(data):
+        n = rnd.randint(1, max_size)
+        yield data[i:i + n]
+        i += n
+
+
+def legacy_pipeline(data):
+    calls = sent = 0
+    for chunk in chunked(data, 1024):
+        out = chunk.decode(errors="ignore")
+        if out:
+            calls += 1
+            sent += len(f"```\n{out}\n```".encode())
+    return calls, sent
+
+
+class _StubReactor:
+    def call_later(self, delay, fn, *args):
+        return [float("inf"), 0, fn, args, False]
+
+    def call_soon(self, fn, *args):
+        fn(*args)
+
+    @staticmethod
+    def cancel(timer):
+        timer[4] = True
+
+
+class _RecordingDispatcher:
+    def __init__(self):
+        self.calls = 0
+        self.sent = 0
+
+    def submit(self, method, chat_id=None, on_done=None, **kwargs):
+        kwargs.pop("key", None)
+        self.calls += 1
+        self.sent += len(kwargs.get("text", "").encode())
+        if on_done is not None:
+            on_done(type("Msg", (), {"message_id": self.calls})())
+
+
+def stream_pipeline(data):
+    app.reactor, app.dispatcher = _StubReactor(), _RecordingDispatcher()
+    stream = app.PtyTextStream()
+    aggregator = app.OutputAggregator(chat_id=1)
+    started = time.perf_counter()
+    for n, chunk in enumerate(chunked(data, 1024), 1):
+        aggregator.feed(stream.feed(chunk), stream.partial())
+        if n % CHUNKS_PER_SECOND == 0:
+            aggregator.flush()
+    aggregator.feed(stream.finish())
+    while aggregator.pending or aggregator.timer:
+        aggregator.flush()
+    elapsed = time.perf_counter() - started
+    return app.dispatcher.calls, app.dispatcher.sent, elapsed
+
+
+def record(path, argv):
+    with open(path, "wb") as f:
+        def master_read(fd):
+            data = os.read(fd, 1024)
+            f.write(data)
+            return data
+        pty.spawn(argv, master_read)
+    print(f"recorded {os.path.getsize(path)} bytes to {path}")
+
+
+def main():
+    args = sys.argv[1:]
+    if args[:1] == ["--record"]:
+        record(args[1], args[args.index("--") + 1:])
+        return
+
+    captures = {os.path.basename(p): open(p, "rb").read() for p in args} or \
+        {name: make() for name, make in BUILTIN.items()}
+    print(f"{'capture':<12}{'read':>10} | {'old calls':>9}{'old sent':>10}{'B/B':>7} | "
+          f"{'new calls':>9}{'new sent':>10}{'B/B':>7}{'MB/s':>8}")
+    for name, data in captures.items():
+        old_calls, old_sent = legacy_pipeline(data)
+        new_calls, new_sent, elapsed = stream_pipeline(data)
+        print(f"{name:<12}{len(data):>10} | {old_calls:>9}{old_sent:>10}{old_sent / len(data):>7.2f} | "
+              f"{new_calls:>9}{new_sent:>10}{new_sent / len(data):>7.2f}"
+              f"{len(data) / elapsed / 1e6:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
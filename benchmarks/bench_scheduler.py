@@ -0,0 +1,72 @@
+# ================= COMMAND SCHEDULER LOAD TEST =================
+# Fires a burst of CPU-bound commands from several admins through the
+# scheduler and reports throughput plus how responsive the bot stays,
+# measured as the lateness of a 50 ms reactor timer while the burst runs.
+#
+#   MAX_RUNNING_COMMANDS=4 python benchmarks/bench_scheduler.py [commands] [admins]
+
+import os
+import sys
+import threading
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+os.environ.setdefault("MAIN_ADMIN_ID", "1")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import app  # noqa: E402
+
+WORK = "i=0; while [ $i -lt 50000 ]; do i=$((i+1)); done; echo done"
+
+
+class NullBot:
+    def __getattr__(self, name):
+        return lambda **kwargs: type("Msg", (), {"message_id": 1})()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0.0
+
+
+def main():
+    commands = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    admins = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    app.dispatcher.client = NullBot()
+
+    finished = threading.Semaphore(0)
+    original_release = app.scheduler.release
+
+    def release(admin_id):
+        original_release(admin_id)
+        finished.release()
+    app.scheduler.release = release
+
+    lateness = []
+    stop = threading.Event()
+
+    def tick(due):
+        lateness.append(time.monotonic() - due)
+        if not stop.is_set():
+            app.reactor.call_later(0.05, tick, time.monotonic() + 0.05)
+    app.reactor.call_later(0.05, tick, time.monotonic() + 0.05)
+
+    started = time.monotonic()
+    for n in range(commands):
+        admin_id = 1000 + n % admins
+        app.start_command(10_000 + n, WORK, admin_id)
+    for _ in range(commands):
+        finished.acquire()
+    elapsed = time.monotonic() - started
+    stop.set()
+
+    print(f"commands={commands} admins={admins} cap={app.MAX_RUNNING_COMMANDS} "
+          f"per_admin={app.MAX_COMMANDS_PER_ADMIN}")
+    print(f"wall time:        {elapsed:.2f}s ({commands / elapsed:.1f} commands/s)")
+    print(f"timer lateness:   p50 {percentile(lateness, 50) * 1000:.1f} ms, "
+          f"p99 {percentile(lateness, 99) * 1000:.1f} ms, max {max(lateness) * 1000:.1f} ms")
+    print(f"load average:     {os.getloadavg()[0]:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+# ================= SEARCH INDEX BENCHMARK =================
+# Builds a synthetic source tree (100k files by default), indexes it with
+# the bot's SearchIndex and reports: the first build, an unchanged rescan,
+# a rescan after touching some files, index size on disk, and /find and
+# /grep latency percentiles (first page, as the bot renders it) next to
+# `grep -rl` over the same tree. "grep absent" is the index's worst case.
+#
+#   python benchmarks/bench_search.py [files] [queries]
+
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+os.environ.setdefault("MAIN_ADMIN_ID", "1")
+os.environ.setdefault("STATE_DB", ":memory:")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import app  # noqa: E402
+
+WORDS = ("request", "handler", "session", "buffer", "config", "socket", "render", "parse", "cache", "token",
+         "stream", "worker", "queue", "timer", "screen", "packet", "signal", "record", "update", "window")
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0.0
+
+
+def make_tree(root, files, rng):
+    """files small source files, 100 per folder, each with a few identifiers made of WORDS."""
+    for n in range(files):
+        folder = os.path.join(root, f"pkg{n // 10000:02d}", f"mod{n // 100:04d}")
+        if n % 100 == 0:
+            os.makedirs(folder, exist_ok=True)
+        lines = [f"# file {n}"]
+        for _ in range(rng.randint(20, 60)):
+            a, b = rng.sample(WORDS, 2)
+            lines.append(f"def {a}_{b}_{rng.randint(0, 999)}(self, {b}):\n    return self.{a}.get({b!r})")
+        if n % 1000 == 0:
+            lines.append(f"RARE_MARKER_{n} = True")
+        with open(os.path.join(folder, f"{rng.choice(WORDS)}_{n}.py"), "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - started, result
+
+
+def main():
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    queries = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    rng = random.Random(1)
+    workdir = tempfile.mkdtemp(prefix="bench-search-")
+    tree = os.path.join(workdir, "tree")
+    db = os.path.join(workdir, "index.db")
+    try:
+        print(f"writing {files} files under {tree} ...")
+        make_tree(tree, files, rng)
+
+        index = app.search_index = app.SearchIndex(db, root=tree)
+        seconds, _ = timed(index.refresh)
+        size = sum(os.path.getsize(db + suffix) for suffix in ("", "-wal") if os.path.exists(db + suffix))
+        print(f"first build      {seconds:>8.2f}s  {files / seconds:>8.0f} files/s, index {size / (1 << 20):.0f} MB")
+        seconds, _ = timed(index.refresh)
+        print(f"rescan, no change{seconds:>8.2f}s")
+        touched = rng.sample(range(files), 100)
+        for root_, _, names in os.walk(tree):
+            for name in names:
+                if int(name.rsplit("_", 1)[1][:-3]) in touched:
+                    with open(os.path.join(root_, name), "a") as f:
+                        f.write("fresh_marker = 1\n")
+        seconds, _ = timed(index.refresh)
+        print(f"rescan, 100 edits{seconds:>8.2f}s  ({index.last_scan[1]} files re-indexed)")
+
+        cases = {
+            "find by number": ("find", lambda: f"_{rng.randrange(files)}.py", False),
+            "find substring": ("find", lambda: rng.choice(WORDS)[:4], False),
+            "grep rare": ("grep", lambda: f"RARE_MARKER_{rng.randrange(files // 1000) * 1000}", False),
+            "grep common": ("grep", lambda: "_".join(rng.sample(WORDS, 2)), False),
+            # Never in the tree, yet every trigram is in nearly every file: the
+            # worst case, where each candidate's text has to be read to rule it out
+            "grep absent": ("grep", lambda: f"{rng.choice(WORDS)}_" * 2, False),
+            "grep regex": ("grep", lambda: rf"def {rng.choice(WORDS)}_\w+_7\d\d\(", True),
+        }
+        print(f"\n{'query':<18}{'hits/page':>10}{'p50':>10}{'p99':>10}{'max':>10}")
+        for label, (kind, make_query, regex) in cases.items():
+            latencies, hits = [], 0
+            for _ in range(queries):
+                query = make_query()
+                started = time.perf_counter()
+                results = app.SearchResults(kind, query, regex)
+                page, _ = results.page(0)
+                latencies.append(time.perf_counter() - started)
+                hits += len(page)
+            print(f"{label:<18}{hits / queries:>10.1f}" + "".join(
+                f"{percentile(latencies, p) * 1000:>8.2f}ms" for p in (50, 99)) + f"{max(latencies) * 1000:>8.2f}ms")
+
+        for label, pattern in (("grep -rl rare", "RARE_MARKER_5000"), ("grep -rl common", "request_handler")):
+            seconds, _ = timed(lambda: subprocess.run(["grep", "-rl", pattern, tree], stdout=subprocess.DEVNULL))
+            print(f"{label:<18}{'':>10}{seconds * 1000:>8.0f}ms")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+# ================= LOG FOLLOWER BENCHMARK =================
+# Follows N logs (20 by default) in one chat through /tail's TailManager,
+# against the fake Bot API in fake_bot_api.py, which answers 429 once a
+# chat goes over ~1 message/s. A writer thread appends lines to every log,
+# rotates one and truncates another halfway; then the logs go quiet.
+# Reports the bot's CPU time while the logs are busy and (once the last
+# updates are out) while they are idle, Bot API calls per second and 429s,
+# and checks that every final message shows its log's last line. Runs once
+# with inotify and once with the stat poll fallback at 100 ms, the old
+# `tail -f` cadence. TAIL_MAX_PER_CHAT is raised to the number of logs,
+# well past the default, to load the watcher and the per-chat slots.
+#
+#   python benchmarks/bench_tail.py [logs] [busy seconds] [lines/s per log]
+
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+CHAT = 1
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def child(workdir, logs, poll):
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    os.chdir(workdir)
+    import app
+
+    if poll:
+        def no_inotify():
+            raise OSError("disabled by the benchmark")
+        app.Inotify = no_inotify
+    for n in range(logs):
+        app.tails.follow(CHAT, os.path.join(workdir, f"log{n:02d}.log"))
+    for line in sys.stdin:
+        if line.strip() == "stop":
+            app.tails.stop(CHAT)
+        print(json.dumps({"cpu": cpu_seconds(), **app.tails.stats()}), flush=True)
+
+
+def write_logs(workdir, logs, seconds, rate, last_lines):
+    """Appends rate lines/s to every log; log00 is rotated and log01 truncated halfway."""
+    files = [open(os.path.join(workdir, f"log{n:02d}.log"), "a") for n in range(logs)]
+    started = time.monotonic()
+    tick, count = 0.05, 0
+    while time.monotonic() - started < seconds:
+        count += 1
+        if count == int(seconds / tick / 2) and logs >= 2:
+            path = os.path.join(workdir, "log00.log")
+            os.rename(path, path + ".1")
+            files[0].close()
+            files[0] = open(path, "a")
+            files[1].truncate(0)
+        for n, f in enumerate(files):
+            for i in range(max(1, int(rate * tick))):
+                last_lines[n] = f"log{n:02d} line {count}.{i} GET /api/items status=200 took=12ms"
+                f.write(last_lines[n] + "\n")
+            f.flush()
+        time.sleep(max(0, started + count * tick - time.monotonic()))
+    for f in files:
+        f.close()
+
+
+def run(label, logs, seconds, rate, poll):
+    from fake_bot_api import FakeBotApi
+
+    workdir = tempfile.mkdtemp(prefix="bench-tail-")
+    for n in range(logs):
+        open(os.path.join(workdir, f"log{n:02d}.log"), "w").close()
+    api = FakeBotApi(chat_rate=1).start()
+    env = dict(os.environ, BOT_TOKEN="123456:bench", MAIN_ADMIN_ID=str(CHAT), STATE_DB=":memory:",
+               BOT_API_URL=api.url, TAIL_POLL_INTERVAL="0.1", TAIL_MAX_PER_CHAT=str(logs))
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--child", workdir, str(logs)]
+                            + (["--poll"] if poll else []),
+                            env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+
+    def ask(command=""):
+        proc.stdin.write(command + "\n")
+        proc.stdin.flush()
+        while True:
+            line = proc.stdout.readline()
+            if line.startswith("{"):
+                return json.loads(line)
+
+    try:
+        api.wait_for(lambda: len(api.messages[CHAT]) >= logs, 30)
+        before = ask()
+        calls_before, limited_before = api.total_calls(), api.rate_limited
+        last_lines = {}
+        writer = threading.Thread(target=write_logs, args=(workdir, logs, seconds, rate, last_lines))
+        writer.start()
+        writer.join()
+        busy = ask()
+        busy_calls = api.total_calls() - calls_before
+        busy_limited = api.rate_limited - limited_before
+        # Let the last updates go out (the tails of a chat take turns, 2 s apart)
+        time.sleep(logs * 2 + 5)
+        settled = ask()
+        time.sleep(seconds / 2)
+        idle = ask()
+        stopped = ask("stop")
+        # Final states drain at the chat's rate: about one edit per log
+        shown = lambda: sum(1 for n in range(logs) if api.chat_contains(CHAT, last_lines[n]))  # noqa: E731
+        api.wait_for(lambda: shown() == logs, logs * 2 + 10)
+
+        print(f"{label:<20}{(busy['cpu'] - before['cpu']) / seconds * 100:>9.2f}%"
+              f"{(idle['cpu'] - settled['cpu']) / (seconds / 2) * 100:>9.2f}%"
+              f"{busy_calls / seconds:>10.2f}{busy_limited:>6}/{api.rate_limited:<4}{stopped['events']:>8}"
+              f"{shown():>5}/{logs}")
+    finally:
+        proc.stdin.close()
+        proc.terminate()
+        proc.wait()
+        api.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    if len(sys.argv) > 3 and sys.argv[1] == "--child":
+        child(sys.argv[2], int(sys.argv[3]), "--poll" in sys.argv)
+        return
+
+    logs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 30
+    rate = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+    print(f"{logs} logs in one chat, {rate} lines/s each for {seconds:g}s, then idle for {seconds / 2:g}s")
+    # 429s: while the logs were busy / in total, with the start and the final edits
+    print(f"{'watcher':<20}{'busy CPU':>10}{'idle CPU':>9}{'calls/s':>10}{'429s':>9}{'events':>9}{'final':>9}")
+    run("inotify", logs, seconds, rate, poll=False)
+    run("stat poll, 100 ms", logs, seconds, rate, poll=True)
+
+
+if __name__ == "__main__":
+    main()
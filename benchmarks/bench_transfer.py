@@ -0,0 +1,114 @@
+# ================= FILE TRANSFER BENCHMARK =================
+# Moves a large file through the Bot API and back with the fake server in
+# fake_bot_api.py: /get of a file (split into parts), /get of a folder
+# (tar.gz on the fly) and a document sent to the bot (streamed to disk).
+# The bot side runs in its own interpreter; reports throughput and the
+# peak RSS of each transfer over the RSS before it. Outbound pacing is
+# lifted so the numbers show the transfer path itself.
+#
+#   python benchmarks/bench_transfer.py [file MB] [folder MB]
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+CHAT = 1
+
+
+def memory_kb(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    return 0
+
+
+def reset_peak():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")  # resets VmHWM to the current RSS
+    except OSError:
+        pass
+
+
+def child(workdir, file_id, download_size):
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    os.chdir(workdir)
+    import app
+
+    def measure(label, func, *args):
+        reset_peak()
+        base = memory_kb("VmRSS")
+        started = time.monotonic()
+        func(CHAT, *args)
+        elapsed = time.monotonic() - started
+        print(json.dumps({"label": label, "seconds": elapsed, "rss_mb": (memory_kb("VmHWM") - base) / 1024}),
+              flush=True)
+
+    measure("get file", app.send_file, os.path.join(workdir, "big.bin"))
+    measure("get folder (tar.gz)", app.send_directory, os.path.join(workdir, "folder"))
+    document = types.SimpleNamespace(file_id=file_id, file_size=download_size)
+    measure("receive document", app.receive_document, document, os.path.join(workdir, "received.bin"))
+
+
+def write_file(path, mb, compressible=False):
+    block = (b"line of log output 0123456789\n" * 40000)[:1 << 20] if compressible else os.urandom(1 << 20)
+    with open(path, "wb") as f:
+        for _ in range(mb):
+            f.write(block)
+
+
+def main():
+    if len(sys.argv) > 4 and sys.argv[1] == "--child":
+        child(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+        return
+
+    from fake_bot_api import FakeBotApi
+
+    file_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+    folder_mb = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+    workdir = tempfile.mkdtemp(prefix="bench-transfer-")
+    print(f"preparing a {file_mb} MB file and a {folder_mb} MB folder in {workdir} ...")
+    write_file(os.path.join(workdir, "big.bin"), file_mb)
+    folder = os.path.join(workdir, "folder")
+    os.makedirs(folder)
+    for n in range(folder_mb // 16):
+        write_file(os.path.join(folder, f"part{n:03d}.{'log' if n % 2 else 'bin'}"), 16, compressible=n % 2)
+
+    api = FakeBotApi().start()
+    api.files["bench-download"] = file_mb << 20
+    env = dict(os.environ, BOT_TOKEN="123456:bench", MAIN_ADMIN_ID=str(CHAT), STATE_DB=":memory:",
+               BOT_API_URL=api.url, OUTBOUND_CHAT_RATE="1000", OUTBOUND_CHAT_BURST="1000",
+               OUTBOUND_GLOBAL_RATE="1000", OUTBOUND_GLOBAL_BURST="1000")
+    sizes = {"get file": file_mb, "get folder (tar.gz)": folder_mb, "receive document": file_mb}
+    try:
+        proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--child", workdir, "bench-download",
+                                 str(file_mb << 20)], env=env, stdout=subprocess.PIPE, text=True)
+        print(f"{'transfer':<22}{'MB':>7}{'seconds':>9}{'MB/s':>9}{'+peak RSS':>11}")
+        for line in proc.stdout:
+            if not line.startswith("{"):
+                continue
+            result = json.loads(line)
+            mb = sizes[result["label"]]
+            print(f"{result['label']:<22}{mb:>7}{result['seconds']:>9.2f}{mb / result['seconds']:>9.1f}"
+                  f"{result['rss_mb']:>9.1f}MB")
+        proc.wait()
+        documents = api.calls["sendDocument"]
+        print(f"\n{documents} documents, {api.uploaded_bytes / (1 << 20):.0f} MB uploaded to the fake Bot API")
+        received = os.path.join(workdir, "received.bin")
+        if os.path.exists(received):
+            print(f"received file: {os.path.getsize(received) >> 20} MB on disk")
+    finally:
+        api.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
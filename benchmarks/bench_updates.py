@@ -0,0 +1,108 @@
+# ================= UPDATE DISPATCH BENCHMARK =================
+# A few chats flood the bot with slow handlers (a burst each) while one
+# probe chat sends a quick message every 20 ms. Reports the probe chat's
+# handler latency and ordering for the per-chat ordered dispatcher and
+# for stock TeleBot with the same number of worker threads.
+#
+#   python benchmarks/bench_updates.py [slow chats] [burst per chat] [workers]
+
+import os
+import sys
+import threading
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+os.environ.setdefault("MAIN_ADMIN_ID", "1")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import telebot  # noqa: E402
+from telebot import types  # noqa: E402
+
+import app  # noqa: E402
+
+SLOW_HANDLER = 0.3
+PROBE_CHAT = 1
+PROBE_INTERVAL = 0.02
+DURATION = 4.0
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0.0
+
+
+def make_update(update_id, chat_id, text):
+    return types.Update.de_json({
+        "update_id": update_id,
+        "message": {"message_id": update_id, "date": int(time.time()), "text": text,
+                    "chat": {"id": chat_id, "type": "private"},
+                    "from": {"id": chat_id, "is_bot": False, "first_name": "bench"}},
+    })
+
+
+def run(bot, slow_chats, burst):
+    lock = threading.Lock()
+    latencies = []
+    probe_seen = []
+
+    @bot.message_handler(func=lambda m: m.chat.id != PROBE_CHAT)
+    def slow(m):
+        time.sleep(SLOW_HANDLER)
+
+    @bot.message_handler(func=lambda m: m.chat.id == PROBE_CHAT)
+    def probe(m):
+        seq, sent = m.text.split()
+        with lock:
+            latencies.append(time.monotonic() - float(sent))
+            probe_seen.append(int(seq))
+
+    update_id = 0
+    for chat in range(slow_chats):
+        batch = []
+        for _ in range(burst):
+            update_id += 1
+            batch.append(make_update(update_id, 100 + chat, "slow"))
+        bot.process_new_updates(batch)
+
+    sent = 0
+    deadline = time.monotonic() + DURATION
+    while time.monotonic() < deadline:
+        update_id += 1
+        bot.process_new_updates([make_update(update_id, PROBE_CHAT, f"{sent} {time.monotonic()}")])
+        sent += 1
+        time.sleep(PROBE_INTERVAL)
+
+    # Wait for the probe chat to drain
+    wait_until = time.monotonic() + slow_chats * burst * SLOW_HANDLER + 5
+    while time.monotonic() < wait_until:
+        with lock:
+            if len(probe_seen) >= sent:
+                break
+        time.sleep(0.05)
+
+    out_of_order = sum(1 for a, b in zip(probe_seen, probe_seen[1:]) if b < a)
+    return sent, latencies, out_of_order
+
+
+def report(name, sent, latencies, out_of_order):
+    print(f"{name:<22} probe {len(latencies)}/{sent}  "
+          f"p50 {percentile(latencies, 50) * 1000:7.1f} ms  p99 {percentile(latencies, 99) * 1000:7.1f} ms  "
+          f"max {max(latencies, default=0) * 1000:7.1f} ms  out of order {out_of_order}")
+
+
+def main():
+    slow_chats = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    burst = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+    print(f"{slow_chats} chats x {burst} handlers of {SLOW_HANDLER}s, probe every "
+          f"{PROBE_INTERVAL * 1000:.0f} ms, {workers} workers")
+
+    ordered = app.ChatOrderedBot("123456:bench", workers=workers, lane_limit=burst + 1000)
+    report("per-chat ordered", *run(ordered, slow_chats, burst))
+
+    stock = telebot.TeleBot("123456:bench", threaded=True, num_threads=workers)
+    report("stock thread pool", *run(stock, slow_chats, burst))
+
+
+if __name__ == "__main__":
+    main()
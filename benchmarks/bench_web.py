@@ -0,0 +1,143 @@
+# ================= WEB PAGE BENCHMARK =================
+# Serves the app over real HTTP and opens the editor the way a browser
+# does: the page, every self-hosted asset it needs, and the first range of
+# the file. Reports time to first byte per request and bytes on the wire
+# per editor open, uncompressed, compressed, and with a warm browser cache
+# (immutable assets skipped, the home page revalidated). Also compares
+# rendering the editor template per request with the precompiled one.
+#
+# Assets count only when they are local: run fetch_assets.py first, or
+# point ASSET_DIR at a directory holding them.
+#
+#   python benchmarks/bench_web.py [opens]
+
+import http.client
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+os.environ.setdefault("MAIN_ADMIN_ID", "1")
+os.environ.setdefault("STATE_DB", ":memory:")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from flask import render_template_string  # noqa: E402
+from werkzeug.serving import make_server  # noqa: E402
+
+import app  # noqa: E402
+
+EDITOR_ASSETS = ["ace/ace.js", "ace/ext-language_tools.js", "ace/theme-one_dark.js", "ace/mode-python.js",
+                 "font-awesome/css/all.min.css", "font-awesome/webfonts/fa-solid-900.woff2",
+                 "font-awesome/webfonts/fa-regular-400.woff2"]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0.0
+
+
+def fetch(conn, path, headers):
+    """(status, bytes on the wire, seconds to the response headers, response headers)."""
+    started = time.perf_counter()
+    conn.request("GET", path, headers=headers)
+    response = conn.getresponse()
+    ttfb = time.perf_counter() - started
+    body = response.read()
+    head = sum(len(k) + len(v) + 4 for k, v in response.getheaders())
+    return response.status, len(body) + head, ttfb, dict(response.getheaders())
+
+
+def open_editor(conn, sid, encoding, cache):
+    """One editor open; cache maps URL -> ETag for what the browser already has."""
+    auth = f"admin_id={app.MAIN_ADMIN_ID}"
+    headers = {"Accept-Encoding": encoding} if encoding else {}
+    total = 0
+    ttfbs = {}
+
+    status, size, ttfb, _ = fetch(conn, f"/edit/{sid}?{auth}", headers)
+    total += size
+    ttfbs["page"] = ttfb
+    for name in EDITOR_ASSETS:
+        if name not in app.asset_files:
+            continue
+        url = app.asset_url(name)
+        if cache is not None and url in cache:
+            continue  # immutable: the browser does not even ask
+        status, size, ttfb, response_headers = fetch(conn, url, headers)
+        total += size
+        ttfbs.setdefault("asset", []).append(ttfb)
+        if cache is not None:
+            cache[url] = response_headers.get("ETag")
+    status, size, ttfb, _ = fetch(conn, f"/edit/{sid}/range?offset=0&{auth}", headers)
+    total += size
+    ttfbs["range"] = ttfb
+
+    home_headers = dict(headers)
+    if cache is not None and "/" in cache:
+        home_headers["If-None-Match"] = cache["/"]
+    status, size, ttfb, response_headers = fetch(conn, "/", home_headers)
+    total += size
+    ttfbs["home"] = ttfb
+    if cache is not None:
+        cache["/"] = response_headers.get("ETag")
+    return total, ttfbs
+
+
+def main():
+    opens = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    workdir = tempfile.mkdtemp(prefix="bench-web-", dir=app.BASE_DIR)
+    path = os.path.join(workdir, "script.py")
+    with open(path, "w") as f:
+        f.write("def handler(event):\n    return {'ok': True, 'items': list(range(10))}\n" * 20000)
+    sid = app.registry.add_edit(path, app.MAIN_ADMIN_ID)
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    conn = http.client.HTTPConnection("127.0.0.1", server.server_port)
+
+    local = [name for name in EDITOR_ASSETS if name in app.asset_files]
+    print(f"{len(local)} of {len(EDITOR_ASSETS)} editor assets self-hosted (version {app.ASSET_VERSION}), "
+          f"brotli {'on' if app.brotli else 'off'}, {opens} opens each")
+    if len(local) < len(EDITOR_ASSETS):
+        print("   the rest come from cdnjs and are not counted; run fetch_assets.py to self-host them")
+
+    print(f"{'scenario':<22}{'bytes/open':>12}{'page':>10}{'range':>10}{'home':>10}{'asset p50':>11}")
+    for label, encoding, warm in (("uncompressed", None, False), ("gzip", "gzip", False),
+                                  ("br, gzip", "br, gzip", False), ("br, gzip + warm cache", "br, gzip", True)):
+        cache = {} if warm else None
+        if warm:
+            open_editor(conn, sid, encoding, cache)
+        sizes, page, rng, home, assets = [], [], [], [], []
+        for _ in range(opens):
+            total, ttfbs = open_editor(conn, sid, encoding, cache)
+            sizes.append(total)
+            page.append(ttfbs["page"])
+            rng.append(ttfbs["range"])
+            home.append(ttfbs["home"])
+            assets += ttfbs.get("asset", [])
+        print(f"{label:<22}{percentile(sizes, 50) / 1024:>10.1f}KB"
+              + "".join(f"{percentile(v, 50) * 1000:>8.2f}ms" for v in (page, rng, home))
+              + (f"{percentile(assets, 50) * 1000:>9.2f}ms" if assets else f"{'-':>11}"))
+
+    # Template cost alone: parsed per request before, compiled once now
+    context = dict(file=path, size=0, sid=sid, admin_id=1, chunk=app.EDITOR_CHUNK, ace_js="a.js",
+                   ace_base=None, fa_css="a.css")
+    with app.app.test_request_context():
+        for label, render in (("render_template_string", lambda: render_template_string(app.EDITOR_PAGE, **context)),
+                              ("precompiled template", lambda: app.EDITOR_TEMPLATE.render(**context))):
+            started = time.perf_counter()
+            for _ in range(200):
+                render()
+            print(f"{label:<24}{(time.perf_counter() - started) / 200 * 1e6:>8.1f} µs per render")
+
+    server.shutdown()
+    os.remove(path)
+    os.rmdir(workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,413 @@
+# ================= FAKE BOT API =================
+# A local stand-in for api.telegram.org, good enough to run the bot
+# against: point it here with BOT_API_URL=http://127.0.0.1:<port>.
+#
+# Implements getMe, getUpdates (long polling), setWebhook / deleteWebhook /
+# getWebhookInfo (updates are then POSTed to the webhook), sendMessage,
+# editMessageText, deleteMessage, sendDocument, answerCallbackQuery, and
+# getFile plus /file/ downloads of generated files; any other method answers
+# ok. Uploads are counted and dropped as they arrive, never kept in memory.
+# Latency and 429s can be injected, either at random or from Telegram-like
+# per-chat and global rate limits.
+#
+# Used as a library by bench_e2e.py, or standalone:
+#   python benchmarks/fake_bot_api.py --port 8081 --latency 30 --chat-rate 1
+
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Termux Bot", "username": "termux_bench_bot"}
+
+
+class Bucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def take(self):
+        """Seconds to wait when no token is left, else 0 (and the token is taken)."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens < 1:
+            return (1 - self.tokens) / self.rate
+        self.tokens -= 1
+        return 0
+
+
+def read_multipart(rfile, length, boundary):
+    """
+    Text fields of a multipart/form-data body of length bytes, read in 1 MB
+    blocks. File parts are skipped as they stream past, never buffered whole.
+    """
+    delimiter = b"\r\n--" + boundary
+    buf = b"\r\n"  # so the first delimiter looks like the others
+    fields = {}
+    name = None  # field being read; None before the first part and for files
+    in_headers = False
+    while True:
+        if length > 0:
+            block = rfile.read(min(length, 1 << 20))
+            length = length - len(block) if block else 0
+            buf += block
+        while True:
+            if in_headers:
+                end = buf.find(b"\r\n\r\n")
+                if end < 0:
+                    break
+                headers = buf[:end].decode("latin-1")
+                buf = buf[end + 4:]
+                in_headers = False
+                disposition = next((line for line in headers.split("\r\n")
+                                    if line.lower().startswith("content-disposition:")), "")
+                params = dict(item.strip().split("=", 1) for item in disposition.split(";")[1:] if "=" in item)
+                name = None if "filename" in params else params.get("name", "").strip('"')
+                if name is not None:
+                    fields[name] = b""
+            at = buf.find(delimiter)
+            if at < 0:
+                # Keep what could be the start of a delimiter, drop or keep the rest
+                cut = max(0, len(buf) - len(delimiter))
+                if not in_headers:
+                    if name is not None:
+                        fields[name] += buf[:cut]
+                    buf = buf[cut:]
+                break
+            if name is not None:
+                fields[name] += buf[:at]
+            buf = buf[at + len(delimiter):]
+            if buf.startswith(b"--"):
+                return {key: value.decode() for key, value in fields.items()}
+            name, in_headers = None, True
+        if length <= 0:  # truncated body: what was complete
+            return {key: value.decode() for key, value in fields.items()}
+
+
+class QuietServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass  # clients hanging up on keep-alive connections is expected
+
+
+class FakeBotApi:
+    """
+    In-memory Bot API. Users are simulated with push_message() and
+    push_callback(); what the bot sends is kept per chat (edits replace the
+    text) and can be waited for with wait_for().
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, jitter=0.0, p429=0.0,
+                 chat_rate=0.0, global_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.p429 = p429
+        self.chat_buckets = defaultdict(lambda: Bucket(chat_rate, 3)) if chat_rate else None
+        self.global_bucket = Bucket(global_rate, 5) if global_rate else None
+        self.cond = threading.Condition()
+        self.updates = []  # pending update dicts, oldest first
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1000)
+        self.messages = defaultdict(dict)  # chat_id -> {message_id: text}
+        self.answered = set()  # callback query ids
+        self.calls = defaultdict(int)
+        self.rate_limited = 0
+        self.uploaded_bytes = 0
+        self.files = {}  # file_id -> size of generated content
+        self.webhook = None  # (url, secret)
+        self.server = QuietServer((host, port), self._handler_class())
+        self.url = f"http://{host}:{self.server.server_port}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="fake-bot-api", daemon=True).start()
+        threading.Thread(target=self._deliver_webhook, name="fake-webhook", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    # ---------- simulated users ----------
+    def push_message(self, chat_id, text, user_id=None):
+        message = {"message_id": next(self.message_ids), "date": int(time.time()), "text": text,
+                   "chat": {"id": chat_id, "type": "private"},
+                   "from": {"id": user_id or chat_id, "is_bot": False, "first_name": f"user{chat_id}"}}
+        return self._push({"message": message})
+
+    def push_callback(self, chat_id, data, user_id=None):
+        query_id = f"cb{next(self.update_ids)}"
+        query = {"id": query_id, "chat_instance": str(chat_id), "data": data,
+                 "from": {"id": user_id or chat_id, "is_bot": False, "first_name": f"user{chat_id}"},
+                 "message": {"message_id": next(self.message_ids), "date": int(time.time()),
+                             "chat": {"id": chat_id, "type": "private"}, "text": "menu"}}
+        self._push({"callback_query": query})
+        return query_id
+
+    def _push(self, update):
+        with self.cond:
+            update["update_id"] = next(self.update_ids)
+            self.updates.append(update)
+            self.cond.notify_all()
+        return update["update_id"]
+
+    def push_document(self, chat_id, size, file_name="upload.bin", caption=None, user_id=None):
+        """A user sends a document of size generated bytes; returns the file_id."""
+        file_id = f"doc{next(self.update_ids)}"
+        self.files[file_id] = size
+        message = {"message_id": next(self.message_ids), "date": int(time.time()),
+                   "chat": {"id": chat_id, "type": "private"},
+                   "from": {"id": user_id or chat_id, "is_bot": False, "first_name": f"user{chat_id}"},
+                   "document": {"file_id": file_id, "file_unique_id": file_id, "file_name": file_name,
+                                "file_size": size}}
+        if caption:
+            message["caption"] = caption
+        self._push({"message": message})
+        return file_id
+
+    def wait_for(self, predicate, timeout=30):
+        """Block until predicate() is true (checked on every bot call); returns whether it was."""
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while not predicate():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+    def chat_contains(self, chat_id, needle):
+        """For wait_for(): does any message in the chat contain needle? Call with the lock held."""
+        return any(needle in text for text in self.messages[chat_id].values())
+
+    def total_calls(self):
+        with self.cond:
+            return sum(count for method, count in self.calls.items() if method != "getUpdates")
+
+    # ---------- API methods ----------
+    def call(self, method, params):
+        """Returns (HTTP status, JSON answer)."""
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+        with self.cond:
+            self.calls[method] += 1
+
+        chat_id = params.get("chat_id")
+        chat_id = int(chat_id) if chat_id not in (None, "") else None
+        if method in ("sendMessage", "editMessageText", "sendDocument"):
+            retry_after = 0
+            if self.p429 and random.random() < self.p429:
+                retry_after = 1
+            elif self.global_bucket is not None or self.chat_buckets is not None:
+                with self.cond:
+                    if self.global_bucket is not None:
+                        retry_after = self.global_bucket.take()
+                    if not retry_after and self.chat_buckets is not None and chat_id is not None:
+                        retry_after = self.chat_buckets[chat_id].take()
+            if retry_after:
+                with self.cond:
+                    self.rate_limited += 1
+                seconds = max(1, round(retry_after))
+                return 429, {"ok": False, "error_code": 429, "parameters": {"retry_after": seconds},
+                             "description": f"Too Many Requests: retry after {seconds}"}
+
+        handler = getattr(self, f"_api_{method}", None)
+        if handler is None:
+            return 200, {"ok": True, "result": True}
+        return handler(params, chat_id)
+
+    def _message(self, chat_id, message_id, text=None, **extra):
+        result = {"message_id": message_id, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}}
+        if text is not None:
+            result["text"] = text
+        result.update(extra)
+        return 200, {"ok": True, "result": result}
+
+    def _api_getMe(self, params, chat_id):
+        return 200, {"ok": True, "result": BOT_USER}
+
+    def _api_getUpdates(self, params, chat_id):
+        offset = int(params.get("offset") or 0)
+        timeout = float(params.get("timeout") or 0)
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            # Confirmed updates are gone for good, like on the real API
+            self.updates = [update for update in self.updates if update["update_id"] >= offset]
+            while not self.updates and time.monotonic() < deadline and self.webhook is None:
+                self.cond.wait(deadline - time.monotonic())
+            batch = [] if self.webhook else self.updates[:100]
+        return 200, {"ok": True, "result": batch}
+
+    def _api_setWebhook(self, params, chat_id):
+        with self.cond:
+            self.webhook = (params["url"], params.get("secret_token", "")) if params.get("url") else None
+            self.cond.notify_all()
+        return 200, {"ok": True, "result": True}
+
+    def _api_deleteWebhook(self, params, chat_id):
+        with self.cond:
+            self.webhook = None
+            self.cond.notify_all()
+        return 200, {"ok": True, "result": True}
+
+    def _api_getWebhookInfo(self, params, chat_id):
+        url = self.webhook[0] if self.webhook else ""
+        return 200, {"ok": True, "result": {"url": url, "has_custom_certificate": False,
+                                            "pending_update_count": len(self.updates)}}
+
+    def _api_sendMessage(self, params, chat_id):
+        message_id = next(self.message_ids)
+        with self.cond:
+            self.messages[chat_id][message_id] = params.get("text", "")
+            self.cond.notify_all()
+        return self._message(chat_id, message_id, params.get("text", ""))
+
+    def _api_editMessageText(self, params, chat_id):
+        message_id = int(params["message_id"])
+        with self.cond:
+            if self.messages[chat_id].get(message_id) == params.get("text"):
+                return 400, {"ok": False, "error_code": 400,
+                             "description": "Bad Request: message is not modified"}
+            self.messages[chat_id][message_id] = params.get("text", "")
+            self.cond.notify_all()
+        return self._message(chat_id, message_id, params.get("text", ""))
+
+    def _api_deleteMessage(self, params, chat_id):
+        with self.cond:
+            self.messages[chat_id].pop(int(params["message_id"]), None)
+        return 200, {"ok": True, "result": True}
+
+    def _api_sendDocument(self, params, chat_id):
+        message_id = next(self.message_ids)
+        with self.cond:
+            self.messages[chat_id][message_id] = f"[document] {params.get('caption', '')}"
+            self.cond.notify_all()
+        return self._message(chat_id, message_id, document={"file_id": f"f{message_id}",
+                                                            "file_unique_id": f"u{message_id}"})
+
+    def _api_getFile(self, params, chat_id):
+        file_id = params.get("file_id")
+        if file_id not in self.files:
+            return 400, {"ok": False, "error_code": 400, "description": "Bad Request: invalid file_id"}
+        return 200, {"ok": True, "result": {"file_id": file_id, "file_unique_id": file_id,
+                                            "file_size": self.files[file_id], "file_path": f"documents/{file_id}"}}
+
+    def _api_answerCallbackQuery(self, params, chat_id):
+        with self.cond:
+            self.answered.add(params.get("callback_query_id"))
+            self.cond.notify_all()
+        return 200, {"ok": True, "result": True}
+
+    # ---------- plumbing ----------
+    def _deliver_webhook(self):
+        while True:
+            with self.cond:
+                while not (self.webhook and self.updates):
+                    self.cond.wait()
+                url, secret = self.webhook
+                update = self.updates.pop(0)
+            request = urllib.request.Request(url, data=json.dumps(update).encode(), method="POST",
+                                             headers={"Content-Type": "application/json",
+                                                      "X-Telegram-Bot-Api-Secret-Token": secret})
+            try:
+                urllib.request.urlopen(request, timeout=10).read()
+            except Exception:
+                with self.cond:
+                    self.updates.insert(0, update)  # delivered again, like Telegram does
+                time.sleep(0.5)
+
+    def _handler_class(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                self._serve()
+
+            def do_POST(self):
+                self._serve()
+
+            def _serve(self):
+                url = urllib.parse.urlsplit(self.path)
+                if url.path.startswith("/file/"):
+                    self._download(url.path.rsplit("/", 1)[-1])
+                    return
+                params = {key: values[-1] for key, values in urllib.parse.parse_qs(url.query).items()}
+                length = int(self.headers.get("Content-Length") or 0)
+                content_type = self.headers.get("Content-Type", "")
+                if content_type.startswith("multipart/form-data"):
+                    # telebot sends only the file here and the rest in the query
+                    # string, AsyncTeleBot every field
+                    boundary = content_type.split("boundary=", 1)[1].split(";")[0].strip('"')
+                    params.update(read_multipart(self.rfile, length, boundary.encode()))
+                    with api.cond:
+                        api.uploaded_bytes += length
+                    body = b""
+                else:
+                    body = self.rfile.read(length)
+                if body and content_type.startswith("application/x-www-form-urlencoded"):
+                    params.update((key, values[-1]) for key, values in urllib.parse.parse_qs(body.decode()).items())
+                elif body and content_type.startswith("application/json"):
+                    params.update(json.loads(body))
+
+                method = url.path.rsplit("/", 1)[-1]
+                status, answer = api.call(method, params)
+                data = json.dumps(answer).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _download(self, file_id):
+                size = api.files.get(file_id)
+                if size is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(size))
+                self.end_headers()
+                block = bytes(range(256)) * 4096  # 1 MB
+                while size > 0:
+                    self.wfile.write(block[:size])
+                    size -= len(block)
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local fake Telegram Bot API")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0, help="ms added to every call")
+    parser.add_argument("--jitter", type=float, default=0, help="random ms on top of --latency")
+    parser.add_argument("--p429", type=float, default=0, help="chance of a 429 per send")
+    parser.add_argument("--chat-rate", type=float, default=0, help="sends per second per chat before 429s")
+    parser.add_argument("--global-rate", type=float, default=0, help="sends per second overall before 429s")
+    args = parser.parse_args()
+
+    api = FakeBotApi(port=args.port, latency=args.latency / 1000, jitter=args.jitter / 1000,
+                     p429=args.p429, chat_rate=args.chat_rate, global_rate=args.global_rate).start()
+    print(f"Fake Bot API on {api.url} (BOT_API_URL={api.url})")
+    try:
+        while True:
+            time.sleep(10)
+            print(f"calls: {dict(api.calls)}, 429s: {api.rate_limited}")
+    except KeyboardInterrupt:
+        api.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+# ================= FETCH EDITOR ASSETS =================
+# Downloads the Ace editor and Font Awesome files the web pages use into
+# ./assets, so the bot serves them itself (with content-hashed, cacheable
+# URLs) instead of linking cdnjs. Run once at build time, e.g. on Render:
+#
+#   pip install -r requirements.txt && python fetch_assets.py
+#
+# Without ./assets the pages keep loading these files from cdnjs.
+
+import os
+import sys
+import urllib.request
+
+ACE = "https://cdnjs.cloudflare.com/ajax/libs/ace/1.23.0/"
+FONT_AWESOME = "https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/"
+
+ASSETS = {
+    # Ace and the modes, theme and syntax-check workers the editor picks from
+    "ace/ace.js": ACE + "ace.js",
+    "ace/ext-language_tools.js": ACE + "ext-language_tools.js",
+    "ace/theme-one_dark.js": ACE + "theme-one_dark.js",
+    "ace/mode-text.js": ACE + "mode-text.js",
+    "ace/mode-python.js": ACE + "mode-python.js",
+    "ace/mode-javascript.js": ACE + "mode-javascript.js",
+    "ace/mode-php.js": ACE + "mode-php.js",
+    "ace/mode-html.js": ACE + "mode-html.js",
+    "ace/mode-css.js": ACE + "mode-css.js",
+    "ace/worker-javascript.js": ACE + "worker-javascript.js",
+    "ace/worker-php.js": ACE + "worker-php.js",
+    "ace/worker-html.js": ACE + "worker-html.js",
+    "ace/worker-css.js": ACE + "worker-css.js",
+    # Font Awesome; the stylesheet finds the fonts at ../webfonts/
+    "font-awesome/css/all.min.css": FONT_AWESOME + "css/all.min.css",
+    "font-awesome/webfonts/fa-solid-900.woff2": FONT_AWESOME + "webfonts/fa-solid-900.woff2",
+    "font-awesome/webfonts/fa-regular-400.woff2": FONT_AWESOME + "webfonts/fa-regular-400.woff2",
+    "font-awesome/webfonts/fa-brands-400.woff2": FONT_AWESOME + "webfonts/fa-brands-400.woff2",
+}
+
+
+def main():
+    root = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets")
+    failed = 0
+    for name, url in ASSETS.items():
+        path = os.path.join(root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            with urllib.request.urlopen(url, timeout=30) as response:
+                data = response.read()
+        except OSError as e:
+            print(f"⚠️ {name}: {e}")
+            failed += 1
+            continue
+        with open(path + ".part", "wb") as f:
+            f.write(data)
+        os.replace(path + ".part", path)
+        print(f"✅ {name} ({len(data) // 1024} KB)")
+    if failed:
+        print(f"❌ {failed} of {len(ASSETS)} assets missing; the pages fall back to cdnjs for Ace and Font Awesome")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+# ================= SESSION REGISTRY TESTS =================
+# Hammer the session registry from many threads and assert that no entry
+# is lost or left behind.
+#
+#   1. Raw registry: threads add, replace, detach and remove fake records
+#      for a small set of chats while others take snapshots.
+#   2. Shell sessions: threads race to open the same chats' sessions.
+#   3. Handlers: threads fire start/stop/status/sessions for real short
+#      commands through the bot handlers, then wait for every exit.
+#
+#   python -m pytest tests/test_registry.py
+
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import types
+import unittest
+
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+os.environ.setdefault("MAIN_ADMIN_ID", "1")
+os.environ.setdefault("STATE_DB", ":memory:")
+os.environ.setdefault("INDEX_DB", os.path.join(tempfile.mkdtemp(prefix="test-registry-"), "search_index.db"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import app  # noqa: E402
+
+CHATS = 16
+ADMINS = 4
+THREADS = 16
+OPS = 2000
+
+
+class NullBot:
+    def __getattr__(self, name):
+        reply = types.SimpleNamespace(message_id=1)
+        if app.ENGINE == "asyncio":  # AsyncOutboundDispatcher awaits its client
+            async def call(**kwargs):
+                return reply
+            return call
+        return lambda **kwargs: reply
+
+
+def run_threads(worker, threads=THREADS):
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+
+def message(text, chat_id, admin_id):
+    return types.SimpleNamespace(chat=types.SimpleNamespace(id=chat_id), from_user=types.SimpleNamespace(id=admin_id),
+                                 text=text, message_id=1, date=int(time.time()), content_type="text")
+
+
+class RegistryTestCase(unittest.TestCase):
+    def assertIndexesAgree(self, registry, expected_pids=None):
+        with registry._proc_lock:
+            by_chat = dict(registry._by_chat)
+            by_pid = dict(registry._by_pid)
+            by_admin = {admin_id: dict(chats) for admin_id, chats in registry._by_admin.items()}
+        for chat_id, record in by_chat.items():
+            self.assertIs(by_pid.get(record.pid), record, f"chat {chat_id}: pid {record.pid} not indexed")
+            self.assertIs(by_admin.get(record.admin_id, {}).get(chat_id), record,
+                          f"chat {chat_id}: missing from admin {record.admin_id}")
+        for admin_id, chats in by_admin.items():
+            self.assertTrue(chats, f"admin {admin_id}: empty index left behind")
+            for chat_id, record in chats.items():
+                self.assertIs(by_chat.get(chat_id), record, f"admin {admin_id}: phantom chat {chat_id}")
+        if expected_pids is not None:
+            self.assertEqual(set(by_pid), expected_pids, "pid index has lost or phantom entries")
+
+
+class RawRegistryTest(RegistryTestCase):
+    def test_concurrent_add_detach_remove(self):
+        registry = app.SessionRegistry()
+        pids = iter(range(10**6, 10**9))
+        pid_lock = threading.Lock()
+        live = set()  # pids added and not yet removed
+        live_lock = threading.Lock()
+
+        def worker(seed):
+            rnd = random.Random(seed)
+            mine = []
+            for _ in range(OPS):
+                op = rnd.random()
+                if op < 0.4 or not mine:
+                    with pid_lock:
+                        pid = next(pids)
+                    record = app.ProcessRecord(pid, -1, rnd.randrange(CHATS), rnd.randrange(ADMINS), "x")
+                    with live_lock:
+                        live.add(pid)
+                    registry.add(record)
+                    mine.append(pid)
+                elif op < 0.6:
+                    registry.detach(rnd.randrange(CHATS))
+                elif op < 0.9:
+                    pid = mine.pop(rnd.randrange(len(mine)))
+                    registry.remove(pid)
+                    with live_lock:
+                        live.discard(pid)
+                else:
+                    registry.process_counts()
+                    registry.for_admin(rnd.randrange(ADMINS))
+                    registry.stats()
+
+        run_threads(worker)
+        self.assertIndexesAgree(registry, live)
+
+    def test_concurrent_shell_sessions(self):
+        registry = app.SessionRegistry()
+
+        def factory(chat_id):
+            return types.SimpleNamespace(chat_id=chat_id)
+
+        def worker(seed):
+            rnd = random.Random(seed)
+            for _ in range(OPS):
+                chat_id = rnd.randrange(CHATS)
+                session = registry.get_shell(chat_id)
+                if session is not None and rnd.random() < 0.3:
+                    registry.drop_shell(session)
+                else:
+                    registry.open_shell(chat_id, lambda: factory(chat_id))
+
+        run_threads(worker)
+        shells = registry.shells()
+        self.assertEqual(len({session.chat_id for session in shells}), len(shells), "two sessions for one chat")
+        self.assertEqual(registry.stats()["shells"], len(shells))
+        for session in shells:
+            self.assertIs(registry.get_shell(session.chat_id), session)
+
+        # An ended session never unregisters a newer one of the same chat
+        old, _ = registry.open_shell(0, lambda: factory(0))
+        registry.drop_shell(old)
+        newer, created = registry.open_shell(old.chat_id, lambda: factory(old.chat_id))
+        self.assertTrue(created)
+        registry.drop_shell(old)
+        self.assertIs(registry.get_shell(old.chat_id), newer)
+
+
+class HandlersTest(RegistryTestCase):
+    def test_start_stop_settles(self):
+        app.dispatcher.client = NullBot()
+        admin_ids = [app.MAIN_ADMIN_ID] + [900 + n for n in range(ADMINS - 1)]
+        app.admins.update(admin_ids)
+
+        def worker(seed):
+            rnd = random.Random(seed)
+            for _ in range(OPS // 100):
+                chat_id = 5000 + rnd.randrange(CHATS)
+                admin_id = rnd.choice(admin_ids)
+                app.admins.add(chat_id)
+                op = rnd.random()
+                if op < 0.5:
+                    app.start_command(chat_id, f"sleep 0.{rnd.randrange(1, 5)}", admin_id)
+                elif op < 0.8:
+                    app.stop_cmd(message("/stop", chat_id, admin_id))
+                elif op < 0.9:
+                    app.status_cmd(message("/status", chat_id, admin_id))
+                else:
+                    app.sessions_cmd(message("/sessions", chat_id, admin_id))
+
+        run_threads(worker)
+
+        # Everything started must exit and be forgotten again
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            stats = app.registry.stats()
+            sched = app.scheduler.stats()
+            if not (stats["processes"] or stats["pids"] or stats["inputs"] or sched["running"] or sched["queued"]):
+                break
+            time.sleep(0.05)
+
+        self.assertIndexesAgree(app.registry, set())
+        self.assertEqual(app.registry.stats()["inputs"], 0, "input targets left behind")
+        sched = app.scheduler.stats()
+        self.assertEqual((sched["running"], sched["queued"]), (0, 0), "scheduler did not drain")
+        self.assertFalse(app.reaper.children, "reaper still watches children")
+
+
+if __name__ == "__main__":
+    unittest.main()
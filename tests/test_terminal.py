@@ -0,0 +1,149 @@
+# ================= TERMINAL PARSER TESTS =================
+# The escape tokenizer and its two consumers: PtyTextStream (chat text)
+# and TerminalScreen (/screen grid). Every input is also fed one byte at
+# a time, the worst split a PTY read can produce.
+#
+#   python -m pytest tests/test_terminal.py
+
+import os
+import sys
+import tempfile
+import unittest
+
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+os.environ.setdefault("MAIN_ADMIN_ID", "1")
+os.environ.setdefault("STATE_DB", ":memory:")
+os.environ.setdefault("INDEX_DB", os.path.join(tempfile.mkdtemp(prefix="test-terminal-"), "search_index.db"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import app  # noqa: E402
+
+T = app.EscapeTokenizer
+
+
+def tokens(*chunks):
+    tokenizer = T()
+    events = []
+    for chunk in chunks:
+        events.extend(tokenizer.feed(chunk))
+    # Adjacent text runs are one run however the input was split
+    merged = []
+    for event in events:
+        if merged and event[0] == T.TEXT and merged[-1][0] == T.TEXT:
+            merged[-1] = (T.TEXT, merged[-1][1] + event[1], "")
+        else:
+            merged.append(event)
+    return merged
+
+
+def bytewise(data):
+    return [data[i:i + 1] for i in range(len(data))]
+
+
+def stream_text(*chunks):
+    stream = app.PtyTextStream()
+    out = "".join(stream.feed(chunk) for chunk in chunks)
+    return out + stream.finish()
+
+
+def screen(data, rows=4, cols=20, split=False):
+    term = app.TerminalScreen(rows, cols)
+    for chunk in (bytewise(data) if split else [data]):
+        term.feed(chunk)
+    return term
+
+
+class TokenizerTest(unittest.TestCase):
+    def test_text_and_controls(self):
+        self.assertEqual(tokens(b"ab\r\ncd\x07"),
+                         [(T.TEXT, "ab", ""), (T.CONTROL, "\r", ""), (T.CONTROL, "\n", ""),
+                          (T.TEXT, "cd", ""), (T.CONTROL, "\x07", "")])
+
+    def test_csi_split_across_chunks(self):
+        expected = [(T.CSI, "m", "1;31"), (T.TEXT, "red", "")]
+        self.assertEqual(tokens(b"\x1b", b"[1;", b"31", b"mred"), expected)
+        self.assertEqual(tokens(*bytewise(b"\x1b[1;31mred")), expected)
+        self.assertEqual(tokens(b"\xc2\x9b1;31mred"), expected)  # 8-bit CSI
+
+    def test_utf8_split_across_chunks(self):
+        self.assertEqual(tokens(*bytewise("grün ✓".encode())), [(T.TEXT, "grün ✓", "")])
+
+    def test_escape(self):
+        self.assertEqual(tokens(b"\x1b7x\x1b8"),
+                         [(T.ESCAPE, "7", ""), (T.TEXT, "x", ""), (T.ESCAPE, "8", "")])
+        self.assertEqual(tokens(b"\x1b(Bx"), [(T.TEXT, "x", "")])  # charset designation
+
+    def test_osc_terminated_by_bel(self):
+        data = b"a\x1b]0;title \xe2\x9c\x93\x07b"
+        self.assertEqual(tokens(data), [(T.TEXT, "ab", "")])
+        self.assertEqual(tokens(*bytewise(data)), [(T.TEXT, "ab", "")])
+
+    def test_osc_terminated_by_st(self):
+        data = b"a\x1b]2;title\x1b\\b"
+        self.assertEqual(tokens(data), [(T.TEXT, "ab", "")])
+        self.assertEqual(tokens(*bytewise(data)), [(T.TEXT, "ab", "")])
+        # An ESC inside the string that is not ST does not end it
+        self.assertEqual(tokens(b"a\x1b]2;x\x1bqy\x07b"), [(T.TEXT, "ab", "")])
+        self.assertEqual(tokens(b"a\x1bPdcs\x1b\\b"), [(T.TEXT, "ab", "")])
+
+
+class PtyTextStreamTest(unittest.TestCase):
+    def assertStream(self, data, expected):
+        self.assertEqual(stream_text(data), expected)
+        self.assertEqual(stream_text(*bytewise(data)), expected)
+
+    def test_carriage_return_overwrites(self):
+        self.assertStream(b"10%\r50%\r100%\ndone\n", "100%\ndone\n")
+        self.assertStream(b"long line\rshort\n", "shortline\n")
+        self.assertStream(b"long line\rshort\x1b[K\n", "short\n")
+
+    def test_backspace(self):
+        self.assertStream(b"abc\b\bX\n", "aXc\n")
+        self.assertStream(b"\b\bab\n", "ab\n")
+
+    def test_escapes_are_dropped(self):
+        self.assertStream(b"\x1b[1;32mok\x1b[0m \x1b]0;title\x07\x1b(Bdone\n", "ok done\n")
+        self.assertStream(b"a\x1b]8;;http://x\x1b\\link\x1b]8;;\x1b\\b\n", "alinkb\n")
+
+    def test_cursor_moves(self):
+        self.assertStream(b"abcdef\x1b[3DX\n", "abcXef\n")
+        self.assertStream(b"ab\x1b[3CX\n", "ab   X\n")
+        self.assertStream(b"abcdef\x1b[2GX\n", "aXcdef\n")
+
+    def test_partial_and_finish(self):
+        stream = app.PtyTextStream()
+        self.assertEqual(stream.feed(b"one\ntw"), "one\n")
+        self.assertEqual(stream.partial(), "tw")
+        self.assertEqual(stream.finish(), "tw")
+
+
+class TerminalScreenTest(unittest.TestCase):
+    def test_carriage_return_and_backspace(self):
+        for split in (False, True):
+            term = screen(b"hello\rJ\nabc\b\bX", split=split)
+            self.assertEqual(term.display(), "Jello\n aXc")  # \n keeps the column
+
+    def test_cursor_addressing_split(self):
+        for split in (False, True):
+            term = screen(b"\x1b[2J\x1b[3;5Hmid\x1b[1;1Htop", split=split)
+            self.assertEqual(term.display(), "top\n\n    mid")
+
+    def test_osc_is_not_printed(self):
+        for data in (b"a\x1b]0;title\x07b", b"a\x1b]0;title\x1b\\b"):
+            for split in (False, True):
+                self.assertEqual(screen(data, split=split).display(), "ab")
+
+    def test_save_restore_and_reverse_index(self):
+        term = screen(b"\x1b[2;3H\x1b7\x1b[4;1Hx\x1b8y\x1b[1;1H\x1bMz")
+        # ESC M on the top row scrolls down, pushing x off the bottom
+        self.assertEqual(term.display(), "z\n\n  y")
+
+    def test_wrap_and_scroll(self):
+        term = screen(b"1\r\n2\r\n3\r\n4\r\n5", rows=4, cols=5)
+        self.assertEqual(term.display(), "2\n3\n4\n5")
+        term = screen(b"abcdefg", rows=2, cols=5)
+        self.assertEqual(term.display(), "abcde\nfg")
+
+
+if __name__ == "__main__":
+    unittest.main()